@@ -7,8 +7,12 @@ instance = ve.instance.Instance(verbose=False)
 for i in range(len(instance.getDeviceList())):
     device = instance.getDevice(i)
 
+    ve.compute_pipeline.test(device=device)
     ve.math.arith.test(device=device)
-    #ve.examples.simple_graph.test(device=device)
+    ve.math.fusion.test(device=device)
+    ve.math.reduce.test(device=device)
+    ve.lazy_array.test(device=device)
+    ve.examples.simple_graph.test(device=device)
     # ve.math.machine_learning.resnet.test(device=device)
 
 instance.release()
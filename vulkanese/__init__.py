@@ -2,13 +2,23 @@
 from . import instance
 from . import descriptorPool
 from . import descriptorSet
+from . import cache
+from . import autotune
+from . import memory
+from . import submission
+from . import transfer
+from . import profiler
 from . import device
 from . import buffer
 from . import graphics_pipeline
 from . import shapes
 from . import shader
+from . import compute_graph
 from . import screen
 from . import math
+from . import lazy_array
+from .lazy_array import Array, array, evaluate
+from . import trace
 from . import image
 from . import synchronization
 from . import examples
@@ -0,0 +1,159 @@
+import os
+import json
+import time
+import threading
+import numpy as np
+
+from . import cache
+
+# Tuning constants (workgroup sizes, tiling), picked by benchmarking
+# and kept in $VULKANESE_CACHE_DIR/autotune.json.
+# Entries are keyed by device name, driver version and kernel signature,
+# so another GPU, or a driver update, tunes again.
+# Kernels consult the cache when they are constructed:
+#   params = ve.autotune.lookup(device, "ARITH float 2^20", {"LG_WG_SIZE": 7})
+# and tune() benchmarks the candidates, and saves the fastest:
+#   ve.autotune.tune(device, signature, candidates, make)
+
+
+class TuningCache:
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = os.path.join(cache.getCacheHome(), "autotune.json")
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.entries = None
+
+    def getKey(self, device, signature):
+        return "%s|%08x|%s" % (
+            device.name,
+            device.pipelineCache.driverVersion,
+            signature,
+        )
+
+    def load(self):
+        if self.entries is None:
+            try:
+                with open(self.filename, "r") as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                self.entries = {}
+        return self.entries
+
+    def get(self, device, signature):
+        with self.lock:
+            return self.load().get(self.getKey(device, signature))
+
+    def put(self, device, signature, params):
+        with self.lock:
+            # keep what other processes saved in the meantime
+            self.entries = None
+            entries = self.load()
+            entries[self.getKey(device, signature)] = params
+            cache.atomicWrite(
+                self.filename, json.dumps(entries, indent=2, sort_keys=True).encode()
+            )
+
+
+tuningCache = None
+
+
+def getTuningCache():
+    global tuningCache
+    if tuningCache is None:
+        tuningCache = TuningCache()
+    return tuningCache
+
+
+# signatures share a tuning across lengths of the same power of two
+def getSizeClass(n):
+    return "2^" + str(int(np.ceil(np.log2(max(int(n), 1)))))
+
+
+# LG_WG_SIZE candidates the device can run, with at most maxThreads threads
+def getWorkgroupCandidates(device, lgMin=5, lgMax=10, maxThreads=None):
+    maxInvocations = device.limits["maxComputeWorkGroupInvocations"]
+    if maxThreads is not None:
+        maxInvocations = min(maxInvocations, maxThreads)
+    return [
+        {"LG_WG_SIZE": lg}
+        for lg in range(lgMin, lgMax + 1)
+        if 1 << lg <= maxInvocations
+    ]
+
+
+# the tuned parameters of a kernel on this device, over the defaults
+def lookup(device, signature, default):
+    params = dict(default)
+    params.update(getTuningCache().get(device, signature) or {})
+    return params
+
+
+def releaseKernel(kernel):
+    kernel.release()
+    if kernel in kernel.device.shaders:
+        kernel.device.shaders.remove(kernel)
+
+
+# release the buffers made on device since it had the buffers in before
+# (what a candidate allocated: its results, scratch, rings)
+def releaseBuffersSince(device, before):
+    before = set(id(b) for b in before)
+    for buffer in [b for b in device.buffers if id(b) not in before]:
+        buffer.release()
+        device.buffers.remove(buffer)
+
+
+# benchmark each candidate (a dict of parameters) and save the fastest.
+# make(params) returns a finalized kernel, and run(kernel) runs it to completion
+# (kernel.run() by default). each candidate runs warmup times, then is timed
+# over runs, by its median. candidates that fail to build or run are skipped.
+# each candidate is released, with every buffer it allocated.
+# returns the cached choice without benchmarking, unless force
+def tune(
+    device,
+    signature,
+    candidates,
+    make,
+    run=None,
+    runs=10,
+    warmup=2,
+    force=False,
+    verbose=False,
+):
+    if not force:
+        cached = getTuningCache().get(device, signature)
+        if cached is not None:
+            return cached
+    if run is None:
+        run = lambda kernel: kernel.run(blocking=True)
+
+    timings = []
+    for params in candidates:
+        kernel = None
+        buffersBefore = list(device.buffers)
+        try:
+            kernel = make(params)
+            for i in range(warmup):
+                run(kernel)
+            samples = []
+            for i in range(runs):
+                start = time.perf_counter()
+                run(kernel)
+                samples += [time.perf_counter() - start]
+        except Exception as e:
+            device.instance.debug(signature + " " + str(params) + " failed: " + str(e))
+            continue
+        finally:
+            if kernel is not None:
+                releaseKernel(kernel)
+            releaseBuffersSince(device, buffersBefore)
+        timings += [(float(np.median(samples)), params)]
+        if verbose:
+            print(signature + " " + str(params) + ": " + str(timings[-1][0]) + " s")
+
+    if not timings:
+        raise Exception("no candidate ran for " + signature)
+    best = min(timings, key=lambda t: t[0])[1]
+    getTuningCache().put(device, signature, best)
+    return best
@@ -98,6 +98,9 @@ class Buffer(sinode.Sinode):
                 "stride": 4,
                 "compress": True,
                 "released": False,
+                "hostVisible": True,
+                "intent": None,
+                "memoryTypeIndex": None,
             }
         )
 
@@ -106,6 +109,40 @@ class Buffer(sinode.Sinode):
         self.device = self.fromAbove("device")
         self.device.buffers += [self]
         self.vkDevice = self.device.vkDevice
+
+        # an intent ("upload", "readback" or "device") overrides memProperties
+        self.preferredMemProperties = 0
+        self.avoidedMemProperties = 0
+        if self.intent is not None:
+            (
+                self.memProperties,
+                self.preferredMemProperties,
+                self.avoidedMemProperties,
+            ) = self.device.getMemoryIntent(self.intent)
+            if self.intent == "device":
+                self.hostVisible = False
+
+        # device-only buffers live in memory the CPU can't map.
+        # set/get go through a staging buffer instead
+        if not self.hostVisible:
+            if self.intent is None:
+                self.memProperties = vk.VK_MEMORY_PROPERTY_DEVICE_LOCAL_BIT
+            self.usage |= (
+                vk.VK_BUFFER_USAGE_TRANSFER_SRC_BIT | vk.VK_BUFFER_USAGE_TRANSFER_DST_BIT
+            )
+            self.readFromCPU = False
+
+        # storage buffers can be copied asynchronously, on the transfer queue
+        if self.usage & vk.VK_BUFFER_USAGE_STORAGE_BUFFER_BIT:
+            self.usage |= (
+                vk.VK_BUFFER_USAGE_TRANSFER_SRC_BIT | vk.VK_BUFFER_USAGE_TRANSFER_DST_BIT
+            )
+        # the async upload not yet waited on by a compute submission, and its Submission
+        self.uploadSemaphore = None
+        self.uploadFuture = None
+        # the last compute submission that wrote this buffer
+        self.lastWrite = None
+
         self.itemSizeBytes = glsltype2bytesize(self.memtype)
         self.pythonType = glsltype2python(self.memtype)
         self.getSkipval()
@@ -118,12 +155,22 @@ class Buffer(sinode.Sinode):
 
         self.debug("creating buffer " + self.name)
 
+        # when the device uses several queue families, buffers are shared by all of them
+        # instead of having their ownership transferred between them
+        queueFamilyIndices = self.device.sharedQueueFamilyIndices
+        if len(queueFamilyIndices) > 1:
+            self.sharingMode = vk.VK_SHARING_MODE_CONCURRENT
+        else:
+            queueFamilyIndices = []
+
         # We will now create a buffer with these options
         self.bufferCreateInfo = vk.VkBufferCreateInfo(
             sType=vk.VK_STRUCTURE_TYPE_BUFFER_CREATE_INFO,
             size=self.sizeBytes,  # buffer size in bytes.
             usage=self.usage,  # buffer is used as a storage buffer.
             sharingMode=self.sharingMode,  # buffer is exclusive to a single queue family at a time.
+            queueFamilyIndexCount=len(queueFamilyIndices),
+            pQueueFamilyIndices=queueFamilyIndices if queueFamilyIndices else None,
         )
         self.debug(self.vkDevice)
         self.debug(self.bufferCreateInfo)
@@ -143,38 +190,45 @@ class Buffer(sinode.Sinode):
         # Also, by setting vk.VK_MEMORY_PROPERTY_HOST_COHERENT_BIT, memory written by the device(GPU) will be easily
         # visible to the host(CPU), without having to call any extra flushing commands. So mainly for convenience, we set
         # this flag.
-        index = self.device.findMemoryType(
-            memoryRequirements.memoryTypeBits, self.memProperties
-        )
+        if self.memoryTypeIndex is not None:
+            # the caller picked the memory type explicitly
+            index = self.memoryTypeIndex
+            if not memoryRequirements.memoryTypeBits & (1 << index):
+                index = -1
+        else:
+            index = self.device.findMemoryType(
+                memoryRequirements.memoryTypeBits,
+                self.memProperties,
+                self.preferredMemProperties,
+                self.avoidedMemProperties,
+            )
 
         if index < 0:
             raise Exception("Requested memory type not available on this device")
 
-        # Now use obtained memory requirements info to allocate the memory for the buffer.
-        self.allocateInfo = vk.VkMemoryAllocateInfo(
-            sType=vk.VK_STRUCTURE_TYPE_MEMORY_ALLOCATE_INFO,
-            allocationSize=memoryRequirements.size,  # specify required memory.
-            memoryTypeIndex=index,
-        )
-
-        # allocate memory on device.
+        # Now use obtained memory requirements info to sub-allocate the memory for the buffer
+        # from the device's memory pool.
         self.debug("allocating")
-        self.vkDeviceMemory = vk.vkAllocateMemory(
-            self.vkDevice, self.allocateInfo, None
+        self.allocation = self.device.memoryPool.allocate(memoryRequirements, index)
+        self.vkDeviceMemory = self.allocation.vkDeviceMemory
+        self.memoryOffset = self.allocation.offset
+
+        # coherent memory never needs explicit flushes or invalidates
+        self.memoryTypeIndex = index
+        self.memoryPropertyFlags = self.device.memoryProperties["memoryTypes"][index][
+            "propertyFlags"
+        ]
+        self.hostCoherent = bool(
+            self.memoryPropertyFlags & vk.VK_MEMORY_PROPERTY_HOST_COHERENT_BIT
         )
+        # byte ranges written since the last flush
+        self.dirtyRanges = []
 
         self.debug("done allocating")
 
-        self.debug("mapping")
-        # Map the buffer memory, so that we can read from it on the CPU.
-        self.pmap = vk.vkMapMemory(
-            device=self.vkDevice,
-            memory=self.vkDeviceMemory,
-            offset=0,
-            size=self.sizeBytes,
-            flags=0,
-        )
-        self.debug("done mapping")
+        # The pool keeps host-visible blocks mapped,
+        # so we just take a window into that mapping
+        self.pmap = self.allocation.getMap(self.sizeBytes)
 
         # these debug prints take forever
         # self.debug(len(self.pmap[:]))
@@ -182,7 +236,6 @@ class Buffer(sinode.Sinode):
 
         # sometimes you may want to unmap from CPU
         if not self.readFromCPU:
-            vk.vkUnmapMemory(self.vkDevice, self.vkDeviceMemory)
             self.pmap = None
 
         self.debug("binding to device")
@@ -191,18 +244,10 @@ class Buffer(sinode.Sinode):
             device=self.vkDevice,
             buffer=self.vkBuffer,
             memory=self.vkDeviceMemory,
-            memoryOffset=0,
+            memoryOffset=self.memoryOffset,
         )
         self.debug("done binding to device")
 
-        self.vkMappedMemoryRange = vk.VkMappedMemoryRange(
-            sType=vk.VK_STRUCTURE_TYPE_MAPPED_MEMORY_RANGE,
-            pNext=None,
-            memory=self.vkDeviceMemory,
-            offset=0,
-            size=int(self.sizeBytes),
-        )
-
         # initialize to zero
         self.zeroInitialize()
         self.flush()
@@ -218,19 +263,104 @@ class Buffer(sinode.Sinode):
         # Maintain an address pointer for feed operations
         self.addrPtr = 0
 
-    def flush(self):
+    # record that bytes [startByte, endByte) were written from the CPU
+    def markDirty(self, startByte=0, endByte=None):
+        if endByte is None:
+            endByte = self.sizeBytes
+        if self.hostCoherent or endByte <= startByte:
+            return
+        self.dirtyRanges += [(startByte, endByte)]
+
+    # VkMappedMemoryRanges covering the given byte ranges.
+    # overlapping ranges (after atom alignment) are merged
+    def getMappedMemoryRanges(self, byteRanges):
+        merged = []
+        for startByte, endByte in sorted(byteRanges):
+            offset, size = self.allocation.getMappedRange(startByte, endByte)
+            if merged and offset <= merged[-1][0] + merged[-1][1]:
+                lastOffset, lastSize = merged[-1]
+                if size == vk.VK_WHOLE_SIZE or lastSize == vk.VK_WHOLE_SIZE:
+                    merged[-1] = (lastOffset, vk.VK_WHOLE_SIZE)
+                else:
+                    merged[-1] = (
+                        lastOffset,
+                        max(lastOffset + lastSize, offset + size) - lastOffset,
+                    )
+            else:
+                merged += [(offset, size)]
+
+        return [
+            vk.VkMappedMemoryRange(
+                sType=vk.VK_STRUCTURE_TYPE_MAPPED_MEMORY_RANGE,
+                pNext=None,
+                memory=self.vkDeviceMemory,
+                offset=offset,
+                size=size,
+            )
+            for offset, size in merged
+        ]
+
+    # make CPU writes visible to the GPU.
+    # without arguments, only the ranges marked dirty since the last flush are touched
+    def flush(self, startByte=None, endByte=None):
+        if startByte is not None or endByte is not None:
+            self.markDirty(startByte or 0, endByte)
+        byteRanges = self.dirtyRanges
+        self.dirtyRanges = []
+        return self.flushRanges(byteRanges)
+
+    # flush the given byte ranges, without touching dirtyRanges
+    def flushRanges(self, byteRanges):
+        if self.hostCoherent or not byteRanges or self.pmap is None:
+            return vk.VK_SUCCESS
+        ranges = self.getMappedMemoryRanges(byteRanges)
         return vk.vkFlushMappedMemoryRanges(
             device=self.device.vkDevice,
-            memoryRangeCount=1,
-            pMemoryRanges=[self.vkMappedMemoryRange],
+            memoryRangeCount=len(ranges),
+            pMemoryRanges=ranges,
         )
 
+    # make GPU writes visible to the CPU
+    def invalidate(self, startByte=0, endByte=None):
+        if self.hostCoherent or self.pmap is None:
+            return vk.VK_SUCCESS
+        if endByte is None:
+            endByte = self.sizeBytes
+        ranges = self.getMappedMemoryRanges([(startByte, endByte)])
+        return vk.vkInvalidateMappedMemoryRanges(
+            device=self.device.vkDevice,
+            memoryRangeCount=len(ranges),
+            pMemoryRanges=ranges,
+        )
+
+    # a writable numpy array aliased onto the mapped memory. no copies are made.
+    # after writing through it, call markDirty (or flush with a range)
+    # for the elements you touched
+    def view(self):
+        if self.pmap is None:
+            raise Exception("Buffer " + self.name + " is not mapped")
+        if self.skipval != 1:
+            raise Exception(
+                "Buffer " + self.name + " is padded and can't be viewed directly"
+            )
+        shape = list(self.shape)
+        if self.memtype == "vec4":
+            shape += [4]
+        return np.frombuffer(
+            self.pmap, dtype=self.pythonType, count=self.itemCount
+        ).reshape(shape)
+
+    # element index range -> byte range, for use with markDirty/flush
+    def getByteRange(self, startIndex, endIndex):
+        itemStride = self.itemSizeBytes * self.skipval
+        return startIndex * itemStride, endIndex * itemStride
+
     # in some cases, memory access from the shader must be in increments of 16 bytes
     # so if we have a 4-byte float, we need to skip every 4th memory element
     def getSkipval(self):
         if (
             self.compress
-            and self.usage == vk.VK_BUFFER_USAGE_STORAGE_BUFFER_BIT
+            and self.usage & vk.VK_BUFFER_USAGE_STORAGE_BUFFER_BIT
             and (
                 self.memtype == "float64_t"
                 or self.memtype == "float"
@@ -259,13 +389,13 @@ class Buffer(sinode.Sinode):
         self.debug("sizeBytes " + str(self.sizeBytes))
 
     def zeroInitialize(self, flush=True):
-        if self.skipval == 1:
-            self.pmap[:] = np.zeros((self.itemCount), dtype=self.pythonType)
-        else:
-            self.debug(len(self.pmap))
-            self.debug(self.pythonType)
-            #self.pmap[:] = np.zeros((self.itemCount), dtype=self.pythonType)
-            self.set(np.zeros((self.itemCount), dtype=self.pythonType))
+        if not self.hostVisible:
+            self.device.transfer.fill(self, 0)
+            return
+        if self.pmap is None:
+            return
+        np.frombuffer(self.pmap, np.uint8)[:] = 0
+        self.markDirty()
         if flush:
             self.flush()
 
@@ -273,25 +403,22 @@ class Buffer(sinode.Sinode):
         self.set(np.ones((self.itemCount), dtype=self.pythonType))
 
     def get(self, asComplex=False, flat=False, order="C"):
-        # glsl to python
-        flatArray = np.frombuffer(self.pmap, self.pythonType)
+        if self.hostVisible:
+            self.invalidate()
+            # glsl to python
+            flatArray = np.frombuffer(self.pmap, self.pythonType)
+        else:
+            flatArray = self.device.transfer.download(self)
         # because GLSL only allows 16-byte access,
         # we need to skip a few values in the memory
         if asComplex:
-            rcvdArray = list(flatArray.astype(float))
-            rcvdArrayReal = rcvdArray[::4]
-            rcvdArrayImag = 1j * flatArray[1::4].astype(complex)
-            rcvdArrayComplex = rcvdArrayReal + rcvdArrayImag
+            rcvdArray = np.empty(len(flatArray[::4]), dtype=complex)
+            rcvdArray.real = flatArray[::4]
+            rcvdArray.imag = flatArray[1::4]
             # finally, reshape according to the expected dims
-            rcvdArray = np.array(rcvdArrayComplex).reshape(self.shape)
+            rcvdArray = rcvdArray.reshape(self.shape)
         elif self.memtype == "vec2":
-            rcvdArrayList = list(flatArray.astype(float))
-            rcvdArray = np.zeros(self.shape + [2])
-            rcvdArray = np.append(
-                np.expand_dims(rcvdArrayList[::4], 1),
-                np.expand_dims(rcvdArrayList[1::4], 1),
-                axis=1,
-            )
+            rcvdArray = np.stack((flatArray[::4], flatArray[1::4]), axis=1).astype(float)
 
         else:
             if self.compress:
@@ -301,8 +428,7 @@ class Buffer(sinode.Sinode):
                     rcvdArray = flatArray.reshape(self.shape, order=order)
 
             else:
-                indices = np.arange(0, len(flatArray), self.skipval).astype(int)
-                rcvdArray = np.array(flatArray[indices]).reshape(self.shape)
+                rcvdArray = flatArray[:: self.skipval].reshape(self.shape)
         return rcvdArray
 
     def saveAsImage(self, height, width, path="mandelbrot.png"):
@@ -328,8 +454,9 @@ class Buffer(sinode.Sinode):
         self.debug("releasing buffer " + self.name)
         if not self.released:
             self.debug("destroying buffer " + self.name)
-            vk.vkFreeMemory(self.vkDevice, self.vkDeviceMemory, None)
             vk.vkDestroyBuffer(self.vkDevice, self.vkBuffer, None)
+            # return the range to the device's memory pool
+            self.allocation.free()
             self.released = True
 
     def getDeclaration(self):
@@ -367,6 +494,7 @@ class Buffer(sinode.Sinode):
         self.addrPtr = endByte
 
         self.pmap[startByte:endByte] = data
+        self.markDirty(startByte, endByte)
         return startByte
 
     def setByIndexVec(self, index, data):
@@ -374,6 +502,7 @@ class Buffer(sinode.Sinode):
         startByte = index * self.itemSizeBytes * self.skipval
         self.pmap[startByte : startByte + 4] = np.real(data).astype(np.float32)
         self.pmap[startByte + 4 : startByte + 8] = np.imag(data).astype(np.float32)
+        self.markDirty(startByte, startByte + 8)
 
         # self.debug("setting " + str(index) + " to " + str(np.real(data).astype(np.float32)))
         # self.debug("setting " + str(index) + ".i to " + str(np.imag(data).astype(np.float32)))
@@ -382,7 +511,10 @@ class Buffer(sinode.Sinode):
         # self.debug(self.name + " setting " + str(index) + " to " + str(data))
         startByte = index * self.itemSizeBytes * self.skipval
         endByte = index * self.itemSizeBytes * self.skipval + self.itemSizeBytes
+        if not self.hostVisible:
+            return self.device.transfer.upload(self, np.ravel(data)[:1], startByte)
         self.pmap[startByte:endByte] = np.array(data, dtype=self.pythonType)
+        self.markDirty(startByte, endByte)
 
     def setByIndexStart(self, startIndex, data):
         # if self.skipval != 1:
@@ -393,36 +525,55 @@ class Buffer(sinode.Sinode):
             startIndex * self.itemSizeBytes * self.skipval
             + self.itemSizeBytes * len(data)
         )
+        if not self.hostVisible:
+            return self.device.transfer.upload(self, data, startByte)
         self.pmap[startByte:endByte] = np.array(data, dtype=self.pythonType)
+        self.markDirty(startByte, endByte)
 
     def getByIndex(self, index):
         # self.debug(self.name + " setting " + str(index) + " to " + str(data))
         startByte = index * self.itemSizeBytes * self.skipval
         endByte = index * self.itemSizeBytes * self.skipval + self.itemSizeBytes
+        if not self.hostVisible:
+            return self.device.transfer.download(self, startByte, 1)
         return np.frombuffer(self.pmap[startByte:endByte], dtype=self.pythonType)
 
-    def set(self, data, flush=True):
-        # self.pmap[:] = data.astype(self.pythonType)
+    # copy data in on the transfer queue, without waiting for it.
+    # the next compute submission using this buffer waits for the copy on the GPU
+    def uploadAsync(self, data):
+        if np.size(data) != self.itemCount:
+            raise Exception("Wrong Size")
+        if self.skipval != 1:
+            raise Exception("Async uploads need a compressed buffer")
+        return self.device.asyncTransfer.uploadAsync(self, data)
+
+    # read back on the transfer queue, after the last compute write.
+    # result() of the returned Submission is the data
+    def downloadAsync(self):
+        if self.skipval != 1:
+            raise Exception("Async downloads need a compressed buffer")
+        return self.device.asyncTransfer.downloadAsync(self)
 
-        if len(self.pmap[:]) != np.prod(data.shape) * self.itemSizeBytes:
+    def set(self, data, flush=True):
+        if np.size(data) != self.itemCount:
             self.debug("WRONG SIZE")
-            self.debug("pmap (bytes): " + str(len(self.pmap[:])))
+            self.debug("pmap (bytes): " + str(len(self.pmap)))
             self.debug("item size (bytes): " + str(self.itemSizeBytes))
             self.debug(self.sizeBytes)
-            self.debug(
-                "data (bytes): "
-                + str(np.prod(data.shape) * self.itemSizeBytes)
-            )
+            self.debug("data (bytes): " + str(np.size(data) * self.itemSizeBytes))
             raise Exception("Wrong Size")
 
-        if self.skipval == 1:
-            # self.pmap[:] = data.astype(self.pythonType).flatten()
-            self.pmap[:] = data.astype(self.pythonType).flatten()
-        else:
-            indices = np.arange(0, len(data), 1.0 / self.skipval).astype(int)
-            data = data[indices]
-            # print(self.pythonType)
-            self.pmap[:] = data.astype(self.pythonType).flatten()
+        if not self.hostVisible:
+            if self.skipval != 1:
+                raise Exception("Device-only buffers must be compressed")
+            self.device.transfer.upload(self, data)
+            return
+
+        # convert straight into the mapped memory.
+        # (ravel doesn't copy contiguous input, copyto casts in a single pass)
+        flatArray = np.frombuffer(self.pmap, self.pythonType)
+        np.copyto(flatArray[:: self.skipval], np.ravel(data), casting="unsafe")
+        self.markDirty()
 
         if flush:
             self.flush()
@@ -431,7 +582,8 @@ class Buffer(sinode.Sinode):
         # self.pmap[: data.size * data.itemSize] = data
         a = np.array([value])
         # self.pmap[:a] = data[:int(a/(data.itemSize))]
-        self.pmap[:] = np.tile(a, int(len(self.pmap[:]) / a.itemSize))
+        self.pmap[:] = np.tile(a, int(len(self.pmap) / a.itemSize))
+        self.markDirty()
 
     def getSize(self):
         with open(os.path.join(here, "derivedtypes.json"), "r") as f:
@@ -475,6 +627,101 @@ class StorageBuffer(Buffer):
 
         Buffer.__init__(self, **kwargs)
 
+# A circular StorageBuffer for streaming input.
+# One producer appends with write(), which splits at the wrap point,
+# while previously submitted dispatches keep reading older samples.
+# The consumer calls publish() once per dispatch and passes the returned
+# head to the shader, which reads the window ending there:
+#   x[(head + RING_LENGTH - windowLength + n) % RING_LENGTH]
+# Make the ring longer than the window by at least as many samples
+# as the producer can append while one dispatch is in flight.
+class RingBuffer(StorageBuffer):
+    def __init__(self, **kwargs):
+        StorageBuffer.__init__(self, **kwargs)
+        if self.skipval != 1:
+            raise Exception("RingBuffer " + self.name + " must be compressed")
+        self.ringLength = self.itemCount
+        # only the producer moves writeHead.
+        # it is updated after the data is flushed, so any head a consumer
+        # reads covers fully written samples
+        self.writeHead = 0
+        self.publishedHead = 0
+        self.totalWritten = 0
+
+    # append data at the write head. safe to call from one producer thread
+    # while a dispatch reading the previously published window is in flight
+    def write(self, data):
+        data = np.ravel(data)
+        # only the newest ringLength samples can be kept
+        if data.size > self.ringLength:
+            self.totalWritten += data.size - self.ringLength
+            data = data[-self.ringLength :]
+        start = self.writeHead
+        firstCount = min(data.size, self.ringLength - start)
+        secondCount = data.size - firstCount
+
+        parts = [(start, data[:firstCount])]
+        if secondCount:
+            parts += [(0, data[firstCount:])]
+
+        if self.hostVisible:
+            flatArray = np.frombuffer(self.pmap, self.pythonType)
+            byteRanges = []
+            for startIndex, part in parts:
+                np.copyto(
+                    flatArray[startIndex : startIndex + part.size],
+                    part,
+                    casting="unsafe",
+                )
+                byteRanges += [self.getByteRange(startIndex, startIndex + part.size)]
+            self.flushRanges(byteRanges)
+        else:
+            for startIndex, part in parts:
+                self.device.transfer.upload(
+                    self, part, startIndex * self.itemSizeBytes
+                )
+
+        self.totalWritten += data.size
+        self.writeHead = (start + data.size) % self.ringLength
+        return self.writeHead
+
+    # filling the whole ring restarts it, so the newest sample ends at the head
+    def set(self, data, flush=True):
+        self.writeHead = 0
+        self.write(data)
+
+    # snapshot the write head for the next dispatch
+    def publish(self):
+        self.publishedHead = self.writeHead
+        return self.publishedHead
+
+
+# host-visible scratch memory for copies to and from device-only buffers.
+# owned by the device's StagingPool
+class StagingBuffer(Buffer):
+    def __init__(self, device, sizeBytes, intent="upload"):
+        self.device = device
+        Buffer.__init__(
+            self,
+            device=device,
+            name="staging",
+            shape=[int(sizeBytes / 4)],
+            memtype="uint",
+            usage=vk.VK_BUFFER_USAGE_TRANSFER_SRC_BIT
+            | vk.VK_BUFFER_USAGE_TRANSFER_DST_BIT,
+            intent=intent,
+            compress=True,
+        )
+
+    # staging memory is raw bytes
+    def getSkipval(self):
+        self.skipval = 1
+
+    # the first itemCount items, reinterpreted as pythonType
+    def view(self, pythonType, itemCount):
+        return np.frombuffer(self.pmap, dtype=pythonType, count=itemCount)
+
+
 class DebugBuffer(StorageBuffer):
     def __init__(self, **kwargs):
         sinode.Sinode.__init__(self, **kwargs)
@@ -0,0 +1,277 @@
+import os
+import shutil
+import struct
+import hashlib
+import tempfile
+import threading
+import subprocess
+import vulkan as vk
+
+# On-disk caches shared by every process on the machine:
+# SPIR-V from glslc, and the driver's VkPipelineCache.
+# The root directory is $VULKANESE_CACHE_DIR, or ~/.cache/vulkanese.
+# Entries are written to a temp file and renamed into place,
+# so concurrent processes never see a partial file.
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def getCacheHome():
+    return os.environ.get(
+        "VULKANESE_CACHE_DIR",
+        os.path.join(os.path.expanduser("~"), ".cache", "vulkanese"),
+    )
+
+
+def atomicWrite(filename, data):
+    directory = os.path.dirname(filename)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmpFilename = tempfile.mkstemp(dir=directory, prefix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmpFilename, filename)
+    except BaseException:
+        if os.path.exists(tmpFilename):
+            os.remove(tmpFilename)
+        raise
+
+
+# prefer the glslc shipped next to this file
+def getGlslc():
+    glslcbin = os.path.join(here, "glslc")
+    if os.path.exists(glslcbin):
+        return glslcbin
+    return "glslc"
+
+
+# identifies the compiler build without running it:
+# a different glslc binary gives a different path, size or mtime
+def getCompilerVersion(glslcbin):
+    path = shutil.which(glslcbin)
+    if path is None:
+        raise Exception("glslc not found: " + glslcbin)
+    stat = os.stat(path)
+    return path + ":" + str(stat.st_size) + ":" + str(stat.st_mtime_ns)
+
+
+# compile GLSL source to SPIR-V.
+# every call works in its own temp directory, so calls may run concurrently.
+# suffix tells glslc the shader stage (".comp", ".vert", ...)
+def compileGlsl(glslCode, suffix=".comp", targetEnv="vulkan1.1", glslcbin=None):
+    if glslcbin is None:
+        glslcbin = getGlslc()
+    with tempfile.TemporaryDirectory(prefix="vulkanese") as tmpdir:
+        glslFilename = os.path.join(tmpdir, "shader" + suffix)
+        spvFilename = os.path.join(tmpdir, "shader.spv")
+        with open(glslFilename, "w") as f:
+            f.write(glslCode)
+        result = subprocess.run(
+            [
+                glslcbin,
+                "--target-env=" + targetEnv,
+                glslFilename,
+                "-o",
+                spvFilename,
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        if result.returncode != 0:
+            raise Exception(
+                "glslc failed ("
+                + str(result.returncode)
+                + "):\n"
+                + result.stdout.decode(errors="replace")
+            )
+        with open(spvFilename, "rb") as f:
+            return f.read()
+
+
+# content-addressed SPIR-V store.
+# least recently used entries are evicted once the total exceeds maxBytes
+class SpirvCache:
+    def __init__(self, directory=None, maxBytes=256 * 1024 * 1024):
+        if directory is None:
+            directory = os.path.join(getCacheHome(), "spirv")
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        # glslCode, defines, suffix, targetEnv -> SPIR-V, for this process
+        self.memory = {}
+
+    def getKey(self, glslCode, defines, targetEnv, compilerVersion):
+        h = hashlib.sha256()
+        for part in [
+            glslCode,
+            "\n".join([str(k) + "=" + str(v) for k, v in sorted(defines.items())]),
+            targetEnv,
+            compilerVersion,
+        ]:
+            h.update(part.encode())
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def getFilename(self, key):
+        return os.path.join(self.directory, key + ".spv")
+
+    def get(self, key):
+        filename = self.getFilename(key)
+        try:
+            with open(filename, "rb") as f:
+                spirv = f.read()
+        except OSError:
+            return None
+        # mark it recently used
+        try:
+            os.utime(filename)
+        except OSError:
+            pass
+        return spirv
+
+    def put(self, key, spirv):
+        atomicWrite(self.getFilename(key), spirv)
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            entries = []
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if not entry.name.endswith(".spv"):
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries += [(stat.st_mtime, stat.st_size, entry.path)]
+
+            totalBytes = sum([e[1] for e in entries])
+            for mtime, size, path in sorted(entries):
+                if totalBytes <= self.maxBytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    # another process got there first
+                    pass
+                totalBytes -= size
+
+    # compile through the cache. a hit never runs the compiler
+    def compile(self, glslCode, defines={}, suffix=".comp", targetEnv="vulkan1.1"):
+        memoryKey = (glslCode, tuple(sorted(defines.items())), suffix, targetEnv)
+        spirv = self.memory.get(memoryKey)
+        if spirv is not None:
+            return spirv
+
+        glslcbin = getGlslc()
+        key = self.getKey(
+            glslCode, defines, targetEnv + suffix, getCompilerVersion(glslcbin)
+        )
+        spirv = self.get(key)
+        if spirv is None:
+            spirv = compileGlsl(glslCode, suffix, targetEnv, glslcbin)
+            self.put(key, spirv)
+        self.memory[memoryKey] = spirv
+        return spirv
+
+
+spirvCache = None
+
+
+def getSpirvCache():
+    global spirvCache
+    if spirvCache is None:
+        spirvCache = SpirvCache()
+    return spirvCache
+
+
+# VkPipelineCache, persisted per vendor, device and driver version.
+# The driver reuses the machine code in it instead of recompiling SPIR-V.
+# Saved data from another device or driver is discarded on load
+class PipelineCache:
+    def __init__(self, device, filename=None, load=True):
+        self.device = device
+        properties = vk.vkGetPhysicalDeviceProperties(device.physical_device)
+        self.vendorID = properties.vendorID
+        self.deviceID = properties.deviceID
+        self.driverVersion = properties.driverVersion
+        self.uuid = bytes(list(properties.pipelineCacheUUID))
+
+        if filename is None:
+            filename = os.path.join(
+                getCacheHome(),
+                "pipeline",
+                "%04x_%04x_%08x.bin"
+                % (self.vendorID, self.deviceID, self.driverVersion),
+            )
+        self.filename = filename
+
+        self.initialData = b""
+        if load and os.path.exists(filename):
+            with open(filename, "rb") as f:
+                data = f.read()
+            if self.isCompatible(data):
+                self.initialData = data
+            else:
+                device.instance.debug("discarding incompatible " + filename)
+
+        self.vkPipelineCacheCreateInfo = vk.VkPipelineCacheCreateInfo(
+            sType=vk.VK_STRUCTURE_TYPE_PIPELINE_CACHE_CREATE_INFO,
+            flags=0,
+            initialDataSize=len(self.initialData),
+            pInitialData=vk.ffi.from_buffer(self.initialData)
+            if self.initialData
+            else None,
+        )
+        self.vkPipelineCache = vk.vkCreatePipelineCache(
+            device=device.vkDevice,
+            pCreateInfo=self.vkPipelineCacheCreateInfo,
+            pAllocator=None,
+        )
+
+    # check the VkPipelineCacheHeaderVersionOne at the start of the data
+    def isCompatible(self, data):
+        if len(data) < 32:
+            return False
+        headerSize, headerVersion, vendorID, deviceID, uuid = struct.unpack_from(
+            "<IIII16s", data
+        )
+        return (
+            headerSize >= 32
+            and headerVersion == vk.VK_PIPELINE_CACHE_HEADER_VERSION_ONE
+            and vendorID == self.vendorID
+            and deviceID == self.deviceID
+            and uuid == self.uuid
+        )
+
+    def getData(self):
+        # the binding has no wrapper for this one
+        pDataSize = vk.ffi.new("size_t*")
+        while True:
+            result = vk.lib.vkGetPipelineCacheData(
+                self.device.vkDevice, self.vkPipelineCache, pDataSize, vk.ffi.NULL
+            )
+            if result != vk.VK_SUCCESS:
+                raise vk.exception_codes[result]
+            pData = vk.ffi.new("char[]", pDataSize[0])
+            result = vk.lib.vkGetPipelineCacheData(
+                self.device.vkDevice, self.vkPipelineCache, pDataSize, pData
+            )
+            # the cache grew between the two calls
+            if result == vk.VK_INCOMPLETE:
+                continue
+            if result != vk.VK_SUCCESS:
+                raise vk.exception_codes[result]
+            return vk.ffi.buffer(pData, pDataSize[0])[:]
+
+    def save(self):
+        data = self.getData()
+        if data and data != self.initialData:
+            try:
+                atomicWrite(self.filename, data)
+            except OSError as e:
+                self.device.instance.debug("couldn't save pipeline cache: " + str(e))
+
+    def release(self):
+        vk.vkDestroyPipelineCache(self.device.vkDevice, self.vkPipelineCache, None)
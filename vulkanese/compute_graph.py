@@ -0,0 +1,205 @@
+import os
+import sys
+import threading
+import vulkan as vk
+from . import synchronization
+from . import submission
+
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "sinode"))
+)
+import sinode.sinode as sinode
+
+
+# Records every dispatch of a set of compute shaders into one primary
+# command buffer, and submits it once.
+#
+# Dependencies are inferred from the buffers the shaders share.
+# In program order (the given order, after any explicit `depends`),
+# a later shader depends on an earlier one if
+#   it reads what the earlier one writes (read after write),
+#   it writes what the earlier one reads (write after read), or
+#   both write it (write after write).
+# Read/write sets come from Shader.getBufferAccess (the buffer qualifiers).
+# Shaders are then grouped into levels: a shader runs one level after
+# the last shader it depends on. Shaders in a level are independent,
+# and a single barrier separates consecutive levels.
+# Shaders must be finalized (they provide the pipelines).
+class ComputeGraph(sinode.Sinode):
+    def __init__(self, **kwargs):
+        sinode.Sinode.__init__(self, **kwargs)
+        self.proc_kwargs(shaders=[], inferDependencies=True)
+        self.shaders = self.getOrder(self.shaders)
+        self.getDependencies()
+        self.getLevels()
+        self.queueFamilyIndex = self.device.getSubmitQueue().queueFamilyIndex
+        self.commandPoolLock = self.device.commandPoolLocks[self.queueFamilyIndex]
+        # wait, re-record and submit as a unit (see ComputePipeline.run)
+        self.runLock = threading.Lock()
+        self.future = None
+        # timestamp queries in the recording, when the profiler is enabled
+        self.profiledQueries = []
+
+        self.beginInfo = vk.VkCommandBufferBeginInfo(
+            sType=vk.VK_STRUCTURE_TYPE_COMMAND_BUFFER_BEGIN_INFO, flags=0
+        )
+        with self.commandPoolLock:
+            self.vkCommandBuffer = vk.vkAllocateCommandBuffers(
+                device=self.device.vkDevice,
+                pAllocateInfo=vk.VkCommandBufferAllocateInfo(
+                    sType=vk.VK_STRUCTURE_TYPE_COMMAND_BUFFER_ALLOCATE_INFO,
+                    commandPool=self.device.vkComputeCommandPools[
+                        self.queueFamilyIndex
+                    ],
+                    level=vk.VK_COMMAND_BUFFER_LEVEL_PRIMARY,
+                    commandBufferCount=1,
+                ),
+            )[0]
+        self.submitInfo = vk.VkSubmitInfo(
+            sType=vk.VK_STRUCTURE_TYPE_SUBMIT_INFO,
+            commandBufferCount=1,
+            pCommandBuffers=[self.vkCommandBuffer],
+        )
+        self.record()
+
+    # dependencies first, otherwise in the given order
+    def getOrder(self, shaders):
+        ordered = []
+
+        def visit(shader, path):
+            if shader in ordered:
+                return
+            if shader in path:
+                raise Exception("Cycle in compute graph at " + shader.name)
+            for dependency in shader.depends:
+                if dependency in shaders:
+                    visit(dependency, path + [shader])
+            ordered.append(shader)
+
+        for shader in shaders:
+            visit(shader, [])
+        return ordered
+
+    # shader -> {earlier shader it depends on: [buffers causing the hazard]}
+    def getDependencies(self):
+        self.dependencies = {}
+        for i, later in enumerate(self.shaders):
+            self.dependencies[later] = {}
+            for earlier in self.shaders[:i]:
+                hazards = []
+                if self.inferDependencies:
+                    for buffer in later.buffers:
+                        if buffer not in earlier.buffers:
+                            continue
+                        earlierReads, earlierWrites = earlier.getBufferAccess(buffer)
+                        laterReads, laterWrites = later.getBufferAccess(buffer)
+                        if (
+                            (earlierWrites and laterReads)
+                            or (earlierReads and laterWrites)
+                            or (earlierWrites and laterWrites)
+                        ):
+                            hazards += [buffer]
+                # explicit edges are kept, even without a shared buffer
+                if hazards or earlier in later.depends:
+                    self.dependencies[later][earlier] = hazards
+
+    def getLevels(self):
+        level = {}
+        for shader in self.shaders:
+            level[shader] = 1 + max(
+                [level[d] for d in self.dependencies[shader]] + [-1]
+            )
+        self.levels = [[] for i in range(max(list(level.values()) + [-1]) + 1)]
+        for shader in self.shaders:
+            self.levels[level[shader]] += [shader]
+
+    # buffers with a hazard into any shader of this level
+    def getBarrierBuffers(self, level):
+        vkBuffers = []
+        for shader in level:
+            for hazards in self.dependencies[shader].values():
+                for buffer in hazards:
+                    if buffer.vkBuffer not in vkBuffers:
+                        vkBuffers += [buffer.vkBuffer]
+        return vkBuffers
+
+    def record(self):
+        with self.commandPoolLock:
+            self.recordCommands()
+
+    def recordCommands(self):
+        # push constants are baked into the recording
+        self.recordedPushConstants = {}
+        self.device.profiler.free([q for name, q in self.profiledQueries])
+        self.profiledQueries = []
+        self.profiledEnabled = self.device.profiler.enabled
+        vk.vkBeginCommandBuffer(self.vkCommandBuffer, self.beginInfo)
+        for i, level in enumerate(self.levels):
+            if i > 0:
+                vkBuffers = self.getBarrierBuffers(level)
+                if vkBuffers:
+                    synchronization.bufferBarrier(self.vkCommandBuffer, vkBuffers)
+                else:
+                    # explicit depends without a shared buffer: execution order only
+                    synchronization.executionBarrier(self.vkCommandBuffer)
+            for shader in level:
+                self.recordedPushConstants[shader] = shader.packPushConstants()
+                self.profiledQueries += shader.computePipeline.recordDispatch(
+                    self.vkCommandBuffer, self.recordedPushConstants[shader]
+                )
+        synchronization.hostBarrier(self.vkCommandBuffer)
+        vk.vkEndCommandBuffer(self.vkCommandBuffer)
+
+    # true if any shader's push constants changed since the last recording,
+    # or the profiler was enabled or disabled
+    def isStale(self):
+        if self.device.profiler.enabled != self.profiledEnabled:
+            return True
+        for shader in self.shaders:
+            if shader.packPushConstants() != self.recordedPushConstants[shader]:
+                return True
+        return False
+
+    def run(self, blocking=True):
+        with self.runLock:
+            self.wait()
+            self.device.profiler.collectDone()
+            if self.isStale():
+                self.record()
+
+            buffers = []
+            writtenBuffers = []
+            for shader in self.shaders:
+                for b in shader.buffers:
+                    if b not in buffers:
+                        buffers += [b]
+                    if shader.getBufferAccess(b)[1] and b not in writtenBuffers:
+                        writtenBuffers += [b]
+            future = submission.submitCompute(
+                self.device,
+                self.device.getSubmitQueue(self.queueFamilyIndex),
+                self.submitInfo,
+                self.vkCommandBuffer,
+                buffers,
+                writtenBuffers,
+            )
+            self.future = future
+            self.device.profiler.track(future, self.profiledQueries)
+        if blocking:
+            future.wait()
+        return future
+
+    def wait(self, timeout=None):
+        if self.future is None:
+            return True
+        return self.future.wait(timeout)
+
+    def release(self):
+        self.device.profiler.free([q for name, q in self.profiledQueries])
+        with self.commandPoolLock:
+            vk.vkFreeCommandBuffers(
+                self.device.vkDevice,
+                self.device.vkComputeCommandPools[self.queueFamilyIndex],
+                1,
+                [self.vkCommandBuffer],
+            )
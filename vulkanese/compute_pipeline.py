@@ -2,17 +2,23 @@ import ctypes
 import os
 import sys
 import time
+import threading
 import json
+import numpy as np
 import vulkan as vk
 import re
 from . import buffer
 from . import synchronization
+from . import submission
 
 sys.path.insert(
     0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "sinode"))
 )
 import sinode.sinode as sinode
 
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+import vulkanese as ve
+
 here = os.path.dirname(os.path.abspath(__file__))
 
 
@@ -20,6 +26,26 @@ def getVulkanesePath():
     return here
 
 
+# VK_PIPELINE_CREATE_DISPATCH_BASE_BIT (Vulkan 1.1), which the binding lacks
+PIPELINE_CREATE_DISPATCH_BASE_BIT = 0x00000010
+
+
+# split a workgroup count that exceeds the device's maxComputeWorkGroupCount
+# into [(base, count)] pieces, each within the limit
+def splitWorkgroupCount(workgroupCount, maxWorkgroupCount):
+    ranges = []
+    for count, maxCount in zip(workgroupCount, maxWorkgroupCount):
+        ranges += [
+            [(base, min(maxCount, count - base)) for base in range(0, count, maxCount)]
+        ]
+    pieces = []
+    for z in ranges[2]:
+        for y in ranges[1]:
+            for x in ranges[0]:
+                pieces += [((x[0], y[0], z[0]), (x[1], y[1], z[1]))]
+    return pieces
+
+
 # THIS CONTAINS EVERYTHING YOU NEED!
 # The Vulkanese Compute Pipeline includes the following componenets
 # command buffer
@@ -34,17 +60,41 @@ class ComputePipeline(sinode.Sinode):
             signalSemaphores=[],
             waitSemaphores=[],
             waitStages=[],
+            pipelineCache=None,
         )
+        if self.pipelineCache is None:
+            self.pipelineCache = self.device.pipelineCache
         self.descriptorPool = self.fromAbove("descriptorPool")
 
         # synchronization is owned by the pipeline (command buffer?)
 
-        # if this shader is not signalling other ones,
-        # it's either a dead-end or an output
-        if not len(self.signalSemaphores):
-            self.fence = self.device.getFence()
+        # independent pipelines are spread over the device's compute queues.
+        # the command buffer ties this one to a queue family, and each run goes
+        # to the least loaded queue of that family.
+        # ordering between pipelines needs semaphores (depends) or a ComputeGraph.
+        # a run that waits on a semaphore blocks until the run that signals
+        # it has been submitted, whichever queue that went to
+        self.queueFamilyIndex = self.device.getSubmitQueue().queueFamilyIndex
+        self.commandPoolLock = self.device.commandPoolLocks[self.queueFamilyIndex]
+        # one run at a time: the command buffer is waited on, re-recorded
+        # and submitted as a unit
+        self.runLock = threading.Lock()
+        self.future = None
+        # timestamp queries in the recording, when the profiler is enabled
+        self.profiledQueries = []
 
-        push_constant_ranges = vk.VkPushConstantRange(stageFlags=0, offset=0, size=0)
+        # per-dispatch parameters declared by the shader
+        self.pushConstantSize = self.computeShader.pushConstantSize
+        if self.pushConstantSize:
+            push_constant_ranges = [
+                vk.VkPushConstantRange(
+                    stageFlags=vk.VK_SHADER_STAGE_COMPUTE_BIT,
+                    offset=0,
+                    size=self.pushConstantSize,
+                )
+            ]
+        else:
+            push_constant_ranges = None
 
         # The pipeline layout allows the pipeline to access descriptor sets.
         # So we just specify the established descriptor set
@@ -53,8 +103,8 @@ class ComputePipeline(sinode.Sinode):
             flags=0,
             setLayoutCount=len(self.descriptorPool.descSets),
             pSetLayouts=[d.vkDescriptorSetLayout for d in self.descriptorPool.descSets],
-            pushConstantRangeCount=0,
-            pPushConstantRanges=[push_constant_ranges],
+            pushConstantRangeCount=1 if self.pushConstantSize else 0,
+            pPushConstantRanges=push_constant_ranges,
         )
 
         self.vkPipelineLayout = vk.vkCreatePipelineLayout(
@@ -63,8 +113,26 @@ class ComputePipeline(sinode.Sinode):
             pAllocator=None,
         )
 
+        # dispatches past maxComputeWorkGroupCount are split into several
+        # vkCmdDispatchBase calls. gl_WorkGroupID (and gl_GlobalInvocationID)
+        # include the base, so shaders see one big dispatch.
+        # gl_NumWorkGroups is per piece though
+        self.maxWorkgroupCount = self.device.limits["maxComputeWorkGroupCount"]
+        self.splitDispatch = any(
+            [c > m for c, m in zip(self.workgroupCount, self.maxWorkgroupCount)]
+        )
+        if self.splitDispatch and self.device.apiVersion < vk.VK_MAKE_VERSION(1, 1, 0):
+            raise Exception(
+                "workgroup count "
+                + str(self.workgroupCount)
+                + " exceeds "
+                + str(self.maxWorkgroupCount)
+                + ", and splitting it needs Vulkan 1.1"
+            )
+
         self.vkComputePipelineCreateInfo = vk.VkComputePipelineCreateInfo(
             sType=vk.VK_STRUCTURE_TYPE_COMPUTE_PIPELINE_CREATE_INFO,
+            flags=PIPELINE_CREATE_DISPATCH_BASE_BIT if self.splitDispatch else 0,
             stage=self.computeShader.vkPipelineShaderStageCreateInfo,
             layout=self.vkPipelineLayout,
         )
@@ -72,7 +140,7 @@ class ComputePipeline(sinode.Sinode):
         # Now, we finally create the compute pipeline.
         self.vkPipeline = vk.vkCreateComputePipelines(
             device=self.device.vkDevice,
-            pipelineCache=vk.VK_NULL_HANDLE,
+            pipelineCache=self.pipelineCache.vkPipelineCache,
             createInfoCount=1,
             pCreateInfos=[self.vkComputePipelineCreateInfo],
             pAllocator=None,
@@ -89,46 +157,19 @@ class ComputePipeline(sinode.Sinode):
         # wrap it all up into a command buffer
         self.vkCommandBufferAllocateInfo = vk.VkCommandBufferAllocateInfo(
             sType=vk.VK_STRUCTURE_TYPE_COMMAND_BUFFER_ALLOCATE_INFO,
-            commandPool=self.device.vkComputeCommandPool,
+            commandPool=self.device.vkComputeCommandPools[self.queueFamilyIndex],
             level=vk.VK_COMMAND_BUFFER_LEVEL_PRIMARY,
             commandBufferCount=1,
         )
 
-        self.vkCommandBuffer = vk.vkAllocateCommandBuffers(
-            device=self.device.vkDevice, pAllocateInfo=self.vkCommandBufferAllocateInfo
-        )[0]
-
-        vk.vkBeginCommandBuffer(self.vkCommandBuffer, self.beginInfo)
-
-        # We need to bind a pipeline, AND a descriptor set before we dispatch.
-        # The validation layer will NOT give warnings if you forget these, so be very careful not to forget them.
-        vk.vkCmdBindPipeline(
-            self.vkCommandBuffer, vk.VK_PIPELINE_BIND_POINT_COMPUTE, self.vkPipeline
-        )
+        with self.commandPoolLock:
+            self.vkCommandBuffer = vk.vkAllocateCommandBuffers(
+                device=self.device.vkDevice,
+                pAllocateInfo=self.vkCommandBufferAllocateInfo,
+            )[0]
 
         self.parent.parent.dump()
-        vk.vkCmdBindDescriptorSets(
-            commandBuffer=self.vkCommandBuffer,
-            pipelineBindPoint=vk.VK_PIPELINE_BIND_POINT_COMPUTE,
-            layout=self.vkPipelineLayout,
-            firstSet=0,
-            descriptorSetCount=len(self.descriptorPool.activevkDescriptorSets),
-            pDescriptorSets=self.descriptorPool.activevkDescriptorSets,
-            dynamicOffsetCount=0,
-            pDynamicOffsets=None,
-        )
-
-        # Calling vkCmdDispatch basically starts the compute pipeline, and executes the compute shader.
-        # The number of workgroups is specified in the arguments.
-        # If you are already familiar with compute shaders from OpenGL, this should be nothing new to you.
-        vk.vkCmdDispatch(
-            self.vkCommandBuffer,
-            self.workgroupCount[0],
-            self.workgroupCount[1],
-            self.workgroupCount[2],
-        )
-
-        vk.vkEndCommandBuffer(self.vkCommandBuffer)
+        self.record()
 
         if len(self.waitSemaphores):
             pWaitSemaphores = [s.vkSemaphore for s in self.waitSemaphores]
@@ -153,40 +194,196 @@ class ComputePipeline(sinode.Sinode):
             pWaitDstStageMask=self.waitStages,
         )
 
-    # this help if you run the main loop in C/C++
-    # just use the Vulkan addresses!
-    def getVulkanAddresses(self):
-        addrDict = {}
-        addrDict["FENCEADDR"] = hex(eval(str(self.fence).split(" ")[-1][:-1]))
-        addrDict["DEVADDR"] = str(self.device.vkDevice).split(" ")[-1][:-1]
-        addrDict["SUBMITINFOADDR"] = str(ffi.addressof(self.submitInfo)).split(" ")[-1][
-            :-1
-        ]
-        return addrDict
+    # record the bind + dispatch commands into any command buffer.
+    # pushConstants (packed by the shader) are baked into the recording,
+    # so the owner of the command buffer keeps them to detect staleness.
+    # returns the profiler's (name, query) timestamps around the dispatch, if any
+    def recordDispatch(self, vkCommandBuffer, pushConstants=b""):
+        profiler = self.device.profiler
+        query = profiler.allocate() if profiler.enabled else None
+        if query is not None:
+            profiler.writeTimestamp(vkCommandBuffer, query, "begin")
 
-    # the main loop
-    def run(self, blocking=True):
-        vkFence = None
-        if hasattr(self, "fence"):
-            vkFence = self.fence.vkFence
-
-        # We submit the command buffer on the queue, at the same time giving a fence.
-        vk.vkQueueSubmit(
-            queue=self.device.compute_queue,
-            submitCount=1,
-            pSubmits=self.submitInfo,
-            fence=vkFence,
+        # We need to bind a pipeline, AND a descriptor set before we dispatch.
+        # The validation layer will NOT give warnings if you forget these, so be very careful not to forget them.
+        vk.vkCmdBindPipeline(
+            vkCommandBuffer, vk.VK_PIPELINE_BIND_POINT_COMPUTE, self.vkPipeline
+        )
+
+        vk.vkCmdBindDescriptorSets(
+            commandBuffer=vkCommandBuffer,
+            pipelineBindPoint=vk.VK_PIPELINE_BIND_POINT_COMPUTE,
+            layout=self.vkPipelineLayout,
+            firstSet=0,
+            descriptorSetCount=len(self.descriptorPool.activevkDescriptorSets),
+            pDescriptorSets=self.descriptorPool.activevkDescriptorSets,
+            dynamicOffsetCount=0,
+            pDynamicOffsets=None,
         )
 
-        if hasattr(self, "fence"):
+        if self.pushConstantSize:
+            vk.vkCmdPushConstants(
+                vkCommandBuffer,
+                self.vkPipelineLayout,
+                vk.VK_SHADER_STAGE_COMPUTE_BIT,
+                0,
+                self.pushConstantSize,
+                vk.ffi.from_buffer(pushConstants),
+            )
+
+        # Calling vkCmdDispatch basically starts the compute pipeline, and executes the compute shader.
+        # The number of workgroups is specified in the arguments.
+        # If you are already familiar with compute shaders from OpenGL, this should be nothing new to you.
+        if self.splitDispatch:
+            for base, count in splitWorkgroupCount(
+                self.workgroupCount, self.maxWorkgroupCount
+            ):
+                vk.vkCmdDispatchBase(vkCommandBuffer, *base, *count)
+        else:
+            vk.vkCmdDispatch(
+                vkCommandBuffer,
+                self.workgroupCount[0],
+                self.workgroupCount[1],
+                self.workgroupCount[2],
+            )
+
+        if query is None:
+            return []
+        profiler.writeTimestamp(vkCommandBuffer, query, "end")
+        return [(self.computeShader.name, query)]
+
+    # (re)record this pipeline's own command buffer
+    def record(self):
+        self.device.profiler.free([q for name, q in self.profiledQueries])
+        self.profiledEnabled = self.device.profiler.enabled
+        self.recordedPushConstants = self.computeShader.packPushConstants()
+        with self.commandPoolLock:
+            vk.vkBeginCommandBuffer(self.vkCommandBuffer, self.beginInfo)
+            self.profiledQueries = self.recordDispatch(
+                self.vkCommandBuffer, self.recordedPushConstants
+            )
+            vk.vkEndCommandBuffer(self.vkCommandBuffer)
+
+    # the main loop
+    # with blocking=False, run returns as soon as the work is submitted.
+    # wait on the returned Future (or call wait()) before reading the results
+    def run(self, blocking=True, pushConstants=None):
+        with self.runLock:
+            # the command buffer can't be resubmitted while it is still executing
             self.wait()
+            profiler = self.device.profiler
+            profiler.collectDone()
+
+            # new push constant values need a new recording.
+            # beginning the command buffer again resets it.
+            # so does enabling or disabling the profiler
+            if pushConstants:
+                self.computeShader.setPushConstants(pushConstants)
+            if (
+                self.pushConstantSize
+                and self.computeShader.packPushConstants() != self.recordedPushConstants
+            ) or profiler.enabled != self.profiledEnabled:
+                self.record()
 
-    def wait(self):
-        self.fence.wait()
+            # We submit the command buffer on the queue.
+            # it may go to the driver batched with other threads' submissions
+            buffers = self.computeShader.buffers
+            future = submission.submitCompute(
+                self.device,
+                self.device.getSubmitQueue(self.queueFamilyIndex),
+                self.submitInfo,
+                self.vkCommandBuffer,
+                buffers,
+                [b for b in buffers if self.computeShader.getBufferAccess(b)[1]],
+                self.waitSemaphores,
+                self.signalSemaphores,
+            )
+            self.future = future
+            profiler.track(future, self.profiledQueries)
+        if blocking:
+            future.wait()
+        return future
+
+    # block until the last submission is complete, or for at most timeout seconds.
+    # returns whether it completed (True if nothing is pending)
+    def wait(self, timeout=None):
+        if self.future is None:
+            return True
+        return self.future.wait(timeout)
 
     def release(self):
 
+        self.device.profiler.free([q for name, q in self.profiledQueries])
         self.device.instance.debug("destroying pipeline")
         vk.vkDestroyPipeline(self.device.vkDevice, self.vkPipeline, None)
         self.device.instance.debug("destroying pipeline layout")
         vk.vkDestroyPipelineLayout(self.device.vkDevice, self.vkPipelineLayout, None)
+
+
+# the pieces stay within the limit, and cover every workgroup once
+def testSplitWorkgroupCount():
+    pieces = splitWorkgroupCount([10, 3, 1], [4, 2, 1])
+    passed = pieces == [
+        ((0, 0, 0), (4, 2, 1)),
+        ((4, 0, 0), (4, 2, 1)),
+        ((8, 0, 0), (2, 2, 1)),
+        ((0, 2, 0), (4, 1, 1)),
+        ((4, 2, 0), (4, 1, 1)),
+        ((8, 2, 0), (2, 1, 1)),
+    ]
+    covered = []
+    for base, count in pieces:
+        passed &= all([c <= m for c, m in zip(count, [4, 2, 1])])
+        for z in range(base[2], base[2] + count[2]):
+            for y in range(base[1], base[1] + count[1]):
+                for x in range(base[0], base[0] + count[0]):
+                    covered += [(x, y, z)]
+    passed &= sorted(covered) == [(x, y, 0) for x in range(10) for y in range(3)]
+    passed &= splitWorkgroupCount([3, 1, 1], [4, 2, 1]) == [((0, 0, 0), (3, 1, 1))]
+    print("splitWorkgroupCount: " + str(passed))
+    return passed
+
+
+SPLIT_TEMPLATE = """#version 450
+DEFINE_STRING
+BUFFERS_STRING
+layout (local_size_x = 1, local_size_y = 1, local_size_z = 1 ) in;
+void main() {
+    uint i = gl_GlobalInvocationID.x;
+    result[i] = float(i + 1);
+}
+"""
+
+
+# a dispatch past maxComputeWorkGroupCount[0], one element per workgroup,
+# with a partial last piece. every element must be written
+def test(device):
+    print("Testing Split Dispatch")
+    testSplitWorkgroupCount()
+    maxCount = device.limits["maxComputeWorkGroupCount"][0]
+    # where the limit is huge, the buffer would be too
+    if maxCount > 2**22 or device.apiVersion < vk.VK_MAKE_VERSION(1, 1, 0):
+        print("split dispatch: skipped")
+        return True
+    count = maxCount + maxCount // 3 + 5
+    result = device.getStorageBuffer(name="result", shape=[count])
+    result.set(np.zeros(count))
+    shader = ve.shader.Shader(
+        device=device,
+        name="split",
+        sourceCode=SPLIT_TEMPLATE,
+        constantsDict={},
+        stage=vk.VK_SHADER_STAGE_COMPUTE_BIT,
+        buffers=[result],
+        workgroupCount=[count, 1, 1],
+    )
+    shader.finalize()
+    passed = shader.computePipeline.splitDispatch
+    shader.run(blocking=True)
+    passed &= np.array_equal(result.get(), np.arange(1, count + 1))
+    print("split dispatch: " + str(passed))
+    ve.autotune.releaseKernel(shader)
+    result.release()
+    while result in device.buffers:
+        device.buffers.remove(result)
+    return passed
@@ -56,10 +56,10 @@ class DescriptorPool(sinode.Sinode):
                 return descSet
         raise Exception("Buffer not found in this DescPool")
 
-    def getComputeDeclaration(self):
+    def getComputeDeclaration(self, runtimeSized=False):
         outstr = ""
         for descSet in self.descSets:
-            outstr += descSet.getComputeDeclaration()
+            outstr += descSet.getComputeDeclaration(runtimeSized)
 
         return outstr
 
@@ -66,7 +66,9 @@ class DescriptorSet(sinode.Sinode):
         # if "descriptorSet" not in kwargs.keys():
         #    self.descriptorSet = self.fromAbove("descriptorPool").descSetGlobal
 
-    def getComputeDeclaration(self):
+    # with runtimeSized, storage buffers are declared without a length,
+    # so the generated code doesn't change with the buffer size
+    def getComputeDeclaration(self, runtimeSized=False):
         BUFFERS_STRING = ""
         # novel INPUT buffers belong to THIS Stage (others are linked)
 
@@ -80,7 +82,8 @@ class DescriptorSet(sinode.Sinode):
             if self.fromAbove("stage") != vk.VK_SHADER_STAGE_COMPUTE_BIT:
                 BUFFERS_STRING += b.getDeclaration(descSet=self.descriptorSet)
             else:
-                if buffer.usage == vk.VK_BUFFER_USAGE_UNIFORM_BUFFER_BIT:
+                length = str(int(buffer.sizeBytes / buffer.itemSizeBytes))
+                if buffer.usage & vk.VK_BUFFER_USAGE_UNIFORM_BUFFER_BIT:
                     b = "uniform "
                     std = "std140"
                 else:
@@ -89,6 +92,8 @@ class DescriptorSet(sinode.Sinode):
                         std = "std430"
                     else:
                         std = "std140"
+                    if runtimeSized:
+                        length = ""
 
                 BUFFERS_STRING += (
                     f"layout({std}, set = {self.binding}, binding = {self.getBindingNumber(buffer)} ) "
@@ -99,7 +104,7 @@ class DescriptorSet(sinode.Sinode):
                     + " "
                     + buffer.name
                     + "["
-                    + str(int(buffer.sizeBytes / buffer.itemSizeBytes))
+                    + length
                     + "];\n};\n"
                 )
 
@@ -3,6 +3,8 @@ import sys
 import os
 import time
 import json
+import threading
+import concurrent.futures
 import vulkan as vk
 import vulkanese as ve
 
@@ -33,6 +35,47 @@ def ctypes2dict(props, depth=0):
         die
 
 
+# allocation policies for buffers, by intended access pattern.
+# each maps to (required, preferred, avoided) memory property flags
+MEMORY_INTENTS = {
+    # written by the CPU, read by the GPU.
+    # write-combined device-local memory (ReBAR/UMA) is ideal
+    "upload": (
+        vk.VK_MEMORY_PROPERTY_HOST_VISIBLE_BIT,
+        vk.VK_MEMORY_PROPERTY_DEVICE_LOCAL_BIT
+        | vk.VK_MEMORY_PROPERTY_HOST_COHERENT_BIT,
+        vk.VK_MEMORY_PROPERTY_HOST_CACHED_BIT,
+    ),
+    # written by the GPU, read by the CPU.
+    # uncached memory is very slow to read, so prefer cached
+    "readback": (
+        vk.VK_MEMORY_PROPERTY_HOST_VISIBLE_BIT,
+        vk.VK_MEMORY_PROPERTY_HOST_CACHED_BIT
+        | vk.VK_MEMORY_PROPERTY_HOST_COHERENT_BIT,
+        0,
+    ),
+    # only touched by the GPU. set/get go through staging buffers
+    "device": (
+        vk.VK_MEMORY_PROPERTY_DEVICE_LOCAL_BIT,
+        0,
+        vk.VK_MEMORY_PROPERTY_HOST_VISIBLE_BIT,
+    ),
+}
+
+
+# names of the VkSubgroupFeatureFlagBits
+SUBGROUP_OPERATIONS = {
+    "basic": vk.VK_SUBGROUP_FEATURE_BASIC_BIT,
+    "vote": vk.VK_SUBGROUP_FEATURE_VOTE_BIT,
+    "arithmetic": vk.VK_SUBGROUP_FEATURE_ARITHMETIC_BIT,
+    "ballot": vk.VK_SUBGROUP_FEATURE_BALLOT_BIT,
+    "shuffle": vk.VK_SUBGROUP_FEATURE_SHUFFLE_BIT,
+    "shuffleRelative": vk.VK_SUBGROUP_FEATURE_SHUFFLE_RELATIVE_BIT,
+    "clustered": vk.VK_SUBGROUP_FEATURE_CLUSTERED_BIT,
+    "quad": vk.VK_SUBGROUP_FEATURE_QUAD_BIT,
+}
+
+
 class Device(sinode.Sinode):
     def __init__(self, **kwargs):
         sinode.Sinode.__init__(self, **kwargs)
@@ -42,7 +85,12 @@ class Device(sinode.Sinode):
             shaders=[],
             fences=[],
             semaphores=[],
+            # how pipelines are spread over the compute queues:
+            # "roundRobin", or "load" (the queue with the least work pending)
+            queueSchedule="roundRobin",
         )
+        self.fenceWaiter = None
+        self.fenceWaiterLock = threading.Lock()
 
         self.instance.debug("initializing device " + str(self.deviceIndex))
         self.physical_device = vk.vkEnumeratePhysicalDevices(self.instance.vkInstance)[
@@ -124,25 +172,56 @@ class Device(sinode.Sinode):
         extensions = [e.extensionName for e in extensions]
         # self.instance.debug("available device extensions: %s\n" % extensions)
 
+        # subgroup size, and the stages and operations that support subgroups
+        self.subgroupProperties = self.getSubgroupProperties(extensions)
+        self.apiVersion = self.subgroupProperties["apiVersion"]
+        self.subgroupSize = self.subgroupProperties["subgroupSize"]
+        self.subgroupStages = self.subgroupProperties["supportedStages"]
+        self.subgroupOperations = self.subgroupProperties["supportedOperations"]
+        self.subgroupSizeControl = self.subgroupProperties["subgroupSizeControl"]
+
         # only use the extensions necessary
+        sizeControlExtension = vk.VK_EXT_SUBGROUP_SIZE_CONTROL_EXTENSION_NAME
+        requiresExtension = self.apiVersion < vk.VK_MAKE_VERSION(1, 3, 0)
         extensions = [vk.VK_KHR_SWAPCHAIN_EXTENSION_NAME]
+        if self.subgroupSizeControl and requiresExtension:
+            extensions += [sizeControlExtension]
+
+        # every queue of the compute families, one of each other family
+        self.computeQueueFamilyIndices = self.getComputeQueueFamilyIndices()
+        queueCounts = {}
+        for i in [self.queue_family_graphic_index, self.queue_family_present_index]:
+            if i >= 0:
+                queueCounts[i] = 1
+        for i in self.computeQueueFamilyIndices:
+            queueCounts[i] = self.queueFamilies[i].queueCount
+        self.transferQueueFamilyIndex = self.getTransferQueueFamilyIndex()
+        if self.transferQueueFamilyIndex is not None:
+            queueCounts[self.transferQueueFamilyIndex] = 1
+
+        # buffers are shared by every family that may use them
+        self.sharedQueueFamilyIndices = sorted(queueCounts.keys())
 
         queues_create = [
             vk.VkDeviceQueueCreateInfo(
                 sType=vk.VK_STRUCTURE_TYPE_DEVICE_QUEUE_CREATE_INFO,
                 queueFamilyIndex=i,
-                queueCount=1,
-                pQueuePriorities=[1],
+                queueCount=count,
+                pQueuePriorities=[1.0] * count,
                 flags=0,
             )
-            for i in {self.queue_family_graphic_index, self.queue_family_present_index}
+            for i, count in queueCounts.items()
         ]
         # self.instance.debug(self.pFeatures.pNext)
         # die
+        # lets shaders pin their subgroup size
+        deviceCreateNext = None
+        if self.subgroupSizeControl:
+            deviceCreateNext = self.subgroupSizeControlFeatures
         self.device_create = vk.VkDeviceCreateInfo(
             sType=vk.VK_STRUCTURE_TYPE_DEVICE_CREATE_INFO,
             # pNext=self.pFeatures2,
-            pNext=None,
+            pNext=deviceCreateNext,
             pQueueCreateInfos=queues_create,
             queueCreateInfoCount=len(queues_create),
             pEnabledFeatures=self.pFeatures,  # NEED TO PUT PFEATURES2 or something
@@ -169,11 +248,6 @@ class Device(sinode.Sinode):
             queueFamilyIndex=self.queue_family_present_index,
             queueIndex=0,
         )
-        self.compute_queue = vk.vkGetDeviceQueue(
-            device=self.vkDevice,
-            queueFamilyIndex=self.getComputeQueueFamilyIndex(),
-            queueIndex=0,
-        )
 
         # Create command pool
         self.vkGraphicsCommandPoolCreateInfo = vk.VkCommandPoolCreateInfo(
@@ -186,46 +260,126 @@ class Device(sinode.Sinode):
             self.vkDevice, self.vkGraphicsCommandPoolCreateInfo, None
         )
 
-        # Create command pool
-        self.vkComputeCommandPoolCreateInfo = vk.VkCommandPoolCreateInfo(
-            sType=vk.VK_STRUCTURE_TYPE_COMMAND_POOL_CREATE_INFO,
-            queueFamilyIndex=self.getComputeQueueFamilyIndex(),
-            flags=0,
-        )
+        # Create command pools, one per compute family
+        # compute command buffers are re-recorded when their push constants change
+        # every compute queue gets a SubmitQueue, so run() can be called from any thread
+        self.vkComputeCommandPools = {}
+        # a command pool is externally synchronized: held while allocating,
+        # recording or freeing any of its command buffers
+        self.commandPoolLocks = {}
+        self.submitQueues = []
+        for familyIndex in self.computeQueueFamilyIndices:
+            self.commandPoolLocks[familyIndex] = threading.Lock()
+            self.vkComputeCommandPools[familyIndex] = vk.vkCreateCommandPool(
+                device=self.vkDevice,
+                pCreateInfo=vk.VkCommandPoolCreateInfo(
+                    sType=vk.VK_STRUCTURE_TYPE_COMMAND_POOL_CREATE_INFO,
+                    queueFamilyIndex=familyIndex,
+                    flags=vk.VK_COMMAND_POOL_CREATE_RESET_COMMAND_BUFFER_BIT,
+                ),
+                pAllocator=None,
+            )
+            for queueIndex in range(queueCounts[familyIndex]):
+                self.submitQueues += [
+                    ve.submission.SubmitQueue(
+                        device=self,
+                        queue=vk.vkGetDeviceQueue(
+                            device=self.vkDevice,
+                            queueFamilyIndex=familyIndex,
+                            queueIndex=queueIndex,
+                        ),
+                        queueFamilyIndex=familyIndex,
+                    )
+                ]
+        self.submitQueueLock = threading.Lock()
+        self.nextSubmitQueue = 0
+
+        # the first queue of the first compute family
+        self.submitQueue = self.submitQueues[0]
+        self.compute_queue = self.submitQueue.queue
+        self.vkComputeCommandPool = self.vkComputeCommandPools[
+            self.getComputeQueueFamilyIndex()
+        ]
 
-        self.vkComputeCommandPool = vk.vkCreateCommandPool(
-            device=self.vkDevice,
-            pCreateInfo=self.vkComputeCommandPoolCreateInfo,
-            pAllocator=None,
+        # buffers are sub-allocated from large per-memory-type blocks
+        self.memoryPool = ve.memory.MemoryPool(device=self)
+
+        # driver-compiled pipelines, kept on disk between runs
+        self.pipelineCache = ve.cache.PipelineCache(device=self)
+
+        # copies to and from device-only buffers
+        self.transfer = ve.transfer.TransferContext(
+            device=self,
+            queue=self.compute_queue,
+            queueFamilyIndex=self.getComputeQueueFamilyIndex(),
+            submitQueue=self.submitQueue,
         )
 
-        # poor man's subgroup size query
-        print(self.name.lower())
-        if "nvidia" in self.name.lower():
-            self.subgroupSize = 32
-        elif "amd" in self.name.lower():
-            self.subgroupSize = 64
-        elif "intel" in self.name.lower():
-            self.subgroupSize = 128
+        # asynchronous copies (Buffer.uploadAsync, downloadAsync) go through
+        # the transfer-only queue if there is one, overlapping compute.
+        # otherwise through the first compute queue
+        if self.transferQueueFamilyIndex is None:
+            self.transferSubmitQueue = None
+            self.asyncTransfer = ve.transfer.TransferContext(
+                device=self,
+                queue=self.compute_queue,
+                queueFamilyIndex=self.getComputeQueueFamilyIndex(),
+                submitQueue=self.submitQueue,
+            )
         else:
-            print("    SUBGROUP SIZE UNKNOWN. DEFAULTING TO 32")
-            self.subgroupSize = 32
+            self.transferSubmitQueue = ve.submission.SubmitQueue(
+                device=self,
+                queue=vk.vkGetDeviceQueue(
+                    device=self.vkDevice,
+                    queueFamilyIndex=self.transferQueueFamilyIndex,
+                    queueIndex=0,
+                ),
+                queueFamilyIndex=self.transferQueueFamilyIndex,
+            )
+            self.asyncTransfer = ve.transfer.TransferContext(
+                device=self,
+                queue=self.transferSubmitQueue.queue,
+                queueFamilyIndex=self.transferQueueFamilyIndex,
+                submitQueue=self.transferSubmitQueue,
+            )
+
+        # GPU timestamps around every dispatch, off until enabled
+        self.profiler = ve.profiler.Profiler(device=self)
 
         # self.descriptorPool = ve.descriptor.DescriptorPool(self)
 
     # find memory type with desired properties.
-    def findMemoryType(self, memoryTypeBits, properties):
+    # among the types that have all the required properties,
+    # pick the one with the most preferred and fewest avoided properties
+    def findMemoryType(self, memoryTypeBits, properties, preferred=0, avoided=0):
 
         # How does this search work?
         # See the documentation of VkPhysicalDeviceMemoryProperties for a detailed description.
+        bestIndex = -1
+        bestScore = None
         for i, mt in enumerate(self.memoryProperties["memoryTypes"]):
             if (
                 memoryTypeBits & (1 << i)
                 and (mt["propertyFlags"] & properties) == properties
             ):
-                return i
-
-        return -1
+                score = bin(mt["propertyFlags"] & preferred).count("1") - bin(
+                    mt["propertyFlags"] & avoided
+                ).count("1")
+                if bestScore is None or score > bestScore:
+                    bestIndex = i
+                    bestScore = score
+
+        return bestIndex
+
+    def getMemoryIntent(self, intent):
+        if intent not in MEMORY_INTENTS.keys():
+            raise Exception(
+                "Unknown memory intent "
+                + str(intent)
+                + ". Choose from "
+                + str(list(MEMORY_INTENTS.keys()))
+            )
+        return MEMORY_INTENTS[intent]
 
     def debug(self, *args):
         self.instance.debug(args)
@@ -255,7 +409,7 @@ class Device(sinode.Sinode):
         types = []
         # (this is so dumb)
         # get all keys that start with VK_MEMORY_PROPERTY_
-        for k, v in globals().items():
+        for k, v in vars(vk).items():
             if (
                 k.startswith("VK_MEMORY_PROPERTY_")
                 and v is not None
@@ -265,7 +419,7 @@ class Device(sinode.Sinode):
                     if mt["propertyFlags"] & v:
                         mt["propertyFlagsString"] += [k]
 
-        for k, v in globals().items():
+        for k, v in vars(vk).items():
             if (
                 k.startswith("VK_MEMORY_HEAP_")
                 and v is not None
@@ -287,6 +441,139 @@ class Device(sinode.Sinode):
         else:
             return value
 
+    # VkPhysicalDeviceSubgroupProperties, and the range of sizes a shader
+    # can require, where VK_EXT_subgroup_size_control (core in 1.3) is available
+    def getSubgroupProperties(self, extensions):
+        apiVersion = vk.vkGetPhysicalDeviceProperties(self.physical_device).apiVersion
+        sizeControl = apiVersion >= vk.VK_MAKE_VERSION(1, 3, 0) or (
+            vk.VK_EXT_SUBGROUP_SIZE_CONTROL_EXTENSION_NAME in extensions
+        )
+        subgroupDict = {
+            "apiVersion": apiVersion,
+            "subgroupSize": 0,
+            "supportedStages": 0,
+            "supportedOperations": [],
+            "quadOperationsInAllStages": False,
+            "subgroupSizeControl": False,
+            "minSubgroupSize": 0,
+            "maxSubgroupSize": 0,
+            "requiredSubgroupSizeStages": 0,
+        }
+
+        try:
+            subgroupProperties = vk.VkPhysicalDeviceSubgroupProperties()
+            pNext = subgroupProperties
+            if sizeControl:
+                sizeControlProperties = (
+                    vk.VkPhysicalDeviceSubgroupSizeControlProperties(
+                        pNext=subgroupProperties
+                    )
+                )
+                pNext = sizeControlProperties
+            properties2 = vk.VkPhysicalDeviceProperties2(pNext=pNext)
+            vk.vkGetPhysicalDeviceProperties2(
+                self.physical_device, vk.ffi.addressof(properties2)
+            )
+        except Exception as e:
+            self.instance.debug("vkGetPhysicalDeviceProperties2 failed: " + str(e))
+            subgroupProperties = None
+
+        if subgroupProperties is None or not subgroupProperties.subgroupSize:
+            # poor man's subgroup size query
+            if "nvidia" in self.name.lower():
+                subgroupDict["subgroupSize"] = 32
+            elif "amd" in self.name.lower():
+                subgroupDict["subgroupSize"] = 64
+            elif "intel" in self.name.lower():
+                # anywhere from 8 to 32
+                subgroupDict["subgroupSize"] = 32
+            else:
+                print("    SUBGROUP SIZE UNKNOWN. DEFAULTING TO 32")
+                subgroupDict["subgroupSize"] = 32
+            return subgroupDict
+
+        subgroupDict["subgroupSize"] = subgroupProperties.subgroupSize
+        subgroupDict["supportedStages"] = subgroupProperties.supportedStages
+        subgroupDict["quadOperationsInAllStages"] = bool(
+            subgroupProperties.quadOperationsInAllStages
+        )
+        for name, bit in SUBGROUP_OPERATIONS.items():
+            if subgroupProperties.supportedOperations & bit:
+                subgroupDict["supportedOperations"] += [name]
+
+        # a size can only be required if the feature is there too
+        if sizeControl:
+            self.subgroupSizeControlFeatures = (
+                vk.VkPhysicalDeviceSubgroupSizeControlFeatures()
+            )
+            features2 = vk.VkPhysicalDeviceFeatures2(
+                pNext=self.subgroupSizeControlFeatures
+            )
+            vk.vkGetPhysicalDeviceFeatures2(
+                self.physical_device, vk.ffi.addressof(features2)
+            )
+            if self.subgroupSizeControlFeatures.subgroupSizeControl:
+                subgroupDict["subgroupSizeControl"] = True
+                subgroupDict["minSubgroupSize"] = sizeControlProperties.minSubgroupSize
+                subgroupDict["maxSubgroupSize"] = sizeControlProperties.maxSubgroupSize
+                subgroupDict["requiredSubgroupSizeStages"] = (
+                    sizeControlProperties.requiredSubgroupSizeStages
+                )
+
+        self.instance.debug("subgroup properties " + str(subgroupDict))
+        return subgroupDict
+
+    # whether a shader of this stage can be pinned to this subgroup size
+    def canRequireSubgroupSize(self, stage, subgroupSize):
+        return (
+            self.subgroupSizeControl
+            and bool(self.subgroupProperties["requiredSubgroupSizeStages"] & stage)
+            and self.subgroupProperties["minSubgroupSize"]
+            <= subgroupSize
+            <= self.subgroupProperties["maxSubgroupSize"]
+        )
+
+    # the first family that supports compute,
+    # then any compute-only (async compute) families
+    def getComputeQueueFamilyIndices(self):
+        indices = [self.getComputeQueueFamilyIndex()]
+        for i, props in enumerate(self.queueFamilies):
+            if (
+                i not in indices
+                and props.queueCount > 0
+                and props.queueFlags & vk.VK_QUEUE_COMPUTE_BIT
+                and not props.queueFlags & vk.VK_QUEUE_GRAPHICS_BIT
+            ):
+                indices += [i]
+        return indices
+
+    # a family with transfer but neither graphics nor compute (a DMA engine), or None
+    def getTransferQueueFamilyIndex(self):
+        for i, props in enumerate(self.queueFamilies):
+            if (
+                props.queueCount > 0
+                and props.queueFlags & vk.VK_QUEUE_TRANSFER_BIT
+                and not props.queueFlags
+                & (vk.VK_QUEUE_GRAPHICS_BIT | vk.VK_QUEUE_COMPUTE_BIT)
+            ):
+                return i
+        return None
+
+    # with no family, pick a compute queue by queueSchedule.
+    # within a family, pick the least loaded queue
+    def getSubmitQueue(self, queueFamilyIndex=None):
+        if queueFamilyIndex is not None:
+            candidates = [
+                q for q in self.submitQueues if q.queueFamilyIndex == queueFamilyIndex
+            ]
+            return min(candidates, key=lambda q: q.getLoad())
+        if self.queueSchedule == "load":
+            return min(self.submitQueues, key=lambda q: q.getLoad())
+        with self.submitQueueLock:
+            i = self.nextSubmitQueue % len(self.submitQueues)
+            self.nextSubmitQueue += 1
+        return self.submitQueues[i]
+
     # Returns the index of a queue family that supports compute operations.
     def getComputeQueueFamilyIndex(self):
         # Retrieve all queue families.
@@ -333,7 +620,8 @@ class Device(sinode.Sinode):
             if fieldType.type.kind == "primitive":
                 fieldValue = eval("pProperties.limits." + fieldName)
             else:
-                lfieldValue = str(eval("pProperties.limits." + fieldName))
+                # arrays, such as maxComputeWorkGroupCount
+                fieldValue = list(eval("pProperties.limits." + fieldName))
 
             limitsDict[fieldName] = fieldValue
 
@@ -353,11 +641,45 @@ class Device(sinode.Sinode):
         self.shaders += [newShader]
         return newShader
 
+    # compile many shaders at once.
+    # glslc runs as a separate process per shader, so worker threads
+    # are enough to keep every core busy. templates are filled in on the
+    # calling thread; cache hits never reach the compiler
+    def compileShaders(self, shaders, maxWorkers=None):
+        shaders = [s for s in shaders if s.vkShaderModule is None]
+        if maxWorkers is None:
+            maxWorkers = os.cpu_count() or 1
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers) as pool:
+            futures = []
+            # shaders that only differ in specialization constants
+            # produce the same code. compile it once
+            jobs = {}
+            for shader in shaders:
+                if shader.sourceFilename.endswith(".spv"):
+                    futures += [pool.submit(shader.getSpirv)]
+                    continue
+                glslCode = shader.preprocess()
+                key = (glslCode, shader.getStageSuffix())
+                if key not in jobs:
+                    jobs[key] = pool.submit(shader.compilePreprocessed, glslCode)
+                futures += [jobs[key]]
+            # shader modules are created in order, on this thread
+            for shader, future in zip(shaders, futures):
+                shader.createShaderModule(future.result())
+
     def getFence(self):
         newFence = ve.synchronization.Fence(device=self)
         self.fences += [newFence]
         return newFence
 
+    # started on first use, by awaiting a synchronization.Future
+    def getFenceWaiter(self):
+        with self.fenceWaiterLock:
+            if self.fenceWaiter is None:
+                self.fenceWaiter = ve.synchronization.FenceWaiter(self)
+        return self.fenceWaiter
+
     def getSemaphore(self):
         newSemaphore = ve.synchronization.Semaphore(device=self)
         self.semaphores += [newSemaphore]
@@ -373,22 +695,46 @@ class Device(sinode.Sinode):
         self.buffers += [newBuffer]
         return newBuffer
 
+    def getMemoryStats(self):
+        return self.memoryPool.getStats()
+
     def release(self):
 
+        self.instance.debug("finishing submissions")
+        for submitQueue in self.submitQueues:
+            submitQueue.release()
+        if self.transferSubmitQueue is not None:
+            self.transferSubmitQueue.release()
+
         self.instance.debug("destroying children")
 
         for buffer in self.buffers:
             buffer.release()
+        if self.fenceWaiter is not None:
+            self.fenceWaiter.release()
         for fence in self.fences:
             fence.release()
         for semaphore in self.semaphores:
             semaphore.release()
         for shader in self.shaders:
             shader.release()
+        self.profiler.release()
+
+        self.instance.debug("saving pipeline cache")
+        self.pipelineCache.save()
+        self.pipelineCache.release()
+
+        self.instance.debug("destroying transfer context")
+        self.transfer.release()
+        self.asyncTransfer.release()
+
+        self.instance.debug("destroying memory pool")
+        self.memoryPool.release()
 
         self.instance.debug("destroying command pool")
         vk.vkDestroyCommandPool(self.vkDevice, self.vkGraphicsCommandPool, None)
-        vk.vkDestroyCommandPool(self.vkDevice, self.vkComputeCommandPool, None)
+        for vkCommandPool in self.vkComputeCommandPools.values():
+            vk.vkDestroyCommandPool(self.vkDevice, vkCommandPool, None)
 
         self.instance.debug("destroying device")
         vk.vkDestroyDevice(self.vkDevice, None)
@@ -10,6 +10,7 @@ sys.path.insert(
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
 import vulkanese as ve
 import numpy as np
+import vulkan as vk
 import sinode.sinode as sinode
 
 """the compute graph representing
@@ -31,26 +32,94 @@ class SimpleGraph(sinode.Sinode):
         # shaders create their own output buffers
         # (typically called "result")
         self.addShader0 = ve.math.arith.add(
-            name="add0", x=self.v, y=self.w, device=self.device
+            name="add0", x=self.v, y=self.w, device=self.device, deferCompile=True
         )
         self.addShader1 = ve.math.arith.add(
-            name="add1", x=self.x, y=self.y, device=self.device
+            name="add1", x=self.x, y=self.y, device=self.device, deferCompile=True
         )
         self.multiplyShader = ve.math.arith.multiply(
             name="multiply",
             x=self.addShader0.gpuBuffers.result,
             y=self.addShader1.gpuBuffers.result,
             device=self.device,
-            depends=[self.addShader0, self.addShader1],
+            deferCompile=True,
         )
         self.result = self.multiplyShader.gpuBuffers.result
         self.shaders = [self.addShader0, self.addShader1, self.multiplyShader]
+        # compile all three in parallel
+        self.device.compileShaders(self.shaders)
         for shader in self.shaders:
             shader.finalize()
 
+        # all three dispatches go out in a single submission
+        self.graph = ve.compute_graph.ComputeGraph(
+            device=self.device, shaders=self.shaders
+        )
+
     def run(self):
-        for shader in self.shaders:
-            shader.run()
+        self.graph.run()
+
+
+# an elementwise statement over 128-element buffers, such as "y[i] = x[i] + 1.0"
+# access is buffer -> qualifier, as this shader uses it (see Shader.bufferAccess)
+STATEMENT_TEMPLATE = """#version 450
+DEFINE_STRING
+BUFFERS_STRING
+layout (local_size_x = 128, local_size_y = 1, local_size_z = 1 ) in;
+void main() {
+    uint i = gl_GlobalInvocationID.x;
+    STATEMENT;
+}
+"""
+
+
+def statement(device, name, statement, access):
+    return ve.shader.Shader(
+        device=device,
+        name=name,
+        sourceCode=STATEMENT_TEMPLATE.replace("STATEMENT", statement),
+        constantsDict={},
+        stage=vk.VK_SHADER_STAGE_COMPUTE_BIT,
+        buffers=list(access.keys()),
+        bufferAccess=access,
+        deferCompile=True,
+    )
+
+
+# three shaders whose order only the inferred hazards enforce:
+#   s0 reads x, writes y
+#   s1 writes x, which s0 reads (write after read)
+#   s2 reads x (read after write), and updates y (write after write)
+def testHazards(device):
+    x = device.getStorageBuffer(name="x", shape=[128])
+    y = device.getStorageBuffer(name="y", shape=[128])
+    z = device.getStorageBuffer(name="z", shape=[128])
+    s0 = statement(device, "s0", "y[i] = x[i] + 1.0", {x: "readonly", y: "writeonly"})
+    s1 = statement(device, "s1", "x[i] = 2.0 * z[i]", {z: "readonly", x: "writeonly"})
+    s2 = statement(device, "s2", "y[i] = y[i] + x[i]", {x: "readonly", y: ""})
+    shaders = [s0, s1, s2]
+    device.compileShaders(shaders)
+    for shader in shaders:
+        shader.finalize()
+    graph = ve.compute_graph.ComputeGraph(device=device, shaders=shaders)
+
+    # one shader per level, so a barrier between each
+    passed = graph.levels == [[s0], [s1], [s2]]
+
+    x0 = np.arange(128)
+    z0 = np.arange(128) * 10
+    x.set(x0)
+    y.set(np.zeros(128))
+    z.set(z0)
+    graph.run()
+    passed &= np.allclose(x.get(), 2 * z0)
+    passed &= np.allclose(y.get(), (x0 + 1) + 2 * z0)
+    print("hazards (WAR, WAW): " + str(passed))
+
+    graph.release()
+    for shader in shaders:
+        ve.autotune.releaseKernel(shader)
+    return passed
 
 
 def test(device):
@@ -63,7 +132,22 @@ def test(device):
     simpleGraph.y.set(np.arange(128))
     simpleGraph.run()
 
-    print(simpleGraph.result.get())
+    expectation = (np.arange(128) * 2) ** 2
+    print("simple graph: " + str(np.allclose(simpleGraph.result.get(), expectation)))
+
+    # the same graph, fused into a single kernel
+    fused = ve.math.expr(
+        "(v+w)*(x+y)",
+        device=device,
+        v=simpleGraph.v,
+        w=simpleGraph.w,
+        x=simpleGraph.x,
+        y=simpleGraph.y,
+    )
+    fused.run()
+    print("fused: " + str(np.allclose(fused.result.get(), simpleGraph.result.get())))
+
+    testHazards(device)
 
 
 if __name__ == "__main__":
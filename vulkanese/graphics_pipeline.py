@@ -304,7 +304,11 @@ class GraphicsPipeline(sinode.Sinode):
         )
 
         pipelines = vk.vkCreateGraphicsPipelines(
-            self.device.vkDevice, None, 1, [self.vkGraphicsPipelineCreateInfo], None
+            self.device.vkDevice,
+            self.device.pipelineCache.vkPipelineCache,
+            1,
+            [self.vkGraphicsPipelineCreateInfo],
+            None,
         )
         self.children += [pipelines]
         self.vkPipeline = pipelines[0]
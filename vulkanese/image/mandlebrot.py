@@ -51,6 +51,12 @@ class VideoSynth(ve.shader.Shader):
                 math.ceil(float(self.HEIGHT) / 32),
                 1,
             ],
+            # view parameters, set on every run
+            pushConstants=dict(
+                originX="double",
+                originY="double",
+                mandleStride="double",
+            ),
         )
 
         self.imageData = ve.buffer.StorageBuffer(
@@ -63,16 +69,7 @@ class VideoSynth(ve.shader.Shader):
             stageFlags=vk.VK_SHADER_STAGE_COMPUTE_BIT,
         )
 
-        self.paramsBuffer = ve.buffer.StorageBuffer(
-            device=self.device,
-            name="paramsBuffer",
-            qualifier="readonly",
-            memtype="double",
-            shape=[16],
-            stageFlags=vk.VK_SHADER_STAGE_COMPUTE_BIT,
-        )
-
-        self.buffers=[self.imageData, self.paramsBuffer]
+        self.buffers=[self.imageData]
 
         ve.shader.Shader.__init__(self, device=self.device)
         self.finalize()
@@ -88,8 +85,14 @@ class VideoSynth(ve.shader.Shader):
         return pa
 
     def run(self):
-        self.paramsBuffer.set(np.array([self.originX, self.originY, self.mandleStride, 0] + [0]*12))
-        ve.shader.Shader.run(self)
+        ve.shader.Shader.run(
+            self,
+            pushConstants=dict(
+                originX=self.originX,
+                originY=self.originY,
+                mandleStride=self.mandleStride,
+            ),
+        )
         return self.getImage()
 
     def runDemo(self):
@@ -171,6 +174,7 @@ class Mandlebrot(VideoSynth):
         self,
         WIDTH:3200,  # Size of rendered mandelbrot set.
         HEIGHT=2400,  # Size of renderered mandelbrot set.
+        WORKGROUP_SIZE=None,  # None takes the tuned value (see tune)
         **kwargs
     ):
         self.WIDTH = int(WIDTH)
@@ -179,6 +183,14 @@ class Mandlebrot(VideoSynth):
         self.proc_kwargs(**kwargs)
 
         here = os.path.dirname(os.path.abspath(__file__))
+        # tuned per device (see tune)
+        workgroupSize = WORKGROUP_SIZE
+        if workgroupSize is None:
+            workgroupSize = ve.autotune.lookup(
+                self.device,
+                getSignature(self.WIDTH, self.HEIGHT),
+                {"WORKGROUP_SIZE": 32},
+            )["WORKGROUP_SIZE"]
         self.setDefaults(
             memProperties=0
             | vk.VK_MEMORY_PROPERTY_DEVICE_LOCAL_BIT
@@ -192,11 +204,11 @@ class Mandlebrot(VideoSynth):
             constantsDict=dict(
                 HEIGHT=self.HEIGHT,
                 WIDTH=self.WIDTH,
-                WORKGROUP_SIZE=32,  # Workgroup size in compute shader.
+                WORKGROUP_SIZE=workgroupSize,  # Workgroup size in compute shader.
             ),
             workgroupCount=[
-                math.ceil(float(WIDTH) / 32),
-                math.ceil(float(HEIGHT) / 32),
+                math.ceil(float(WIDTH) / workgroupSize),
+                math.ceil(float(HEIGHT) / workgroupSize),
                 1,
             ],
         )
@@ -238,10 +250,40 @@ class Mandlebrot(VideoSynth):
         self.dumpPos()
 
     def run(self):
-        self.paramsBuffer.set(np.array([self.originX, self.originY, self.mandleStride, 0] + [0]*12))
-        ve.shader.Shader.run(self)
+        ve.shader.Shader.run(
+            self,
+            pushConstants=dict(
+                originX=self.originX,
+                originY=self.originY,
+                mandleStride=self.mandleStride,
+            ),
+        )
         return self.getImage()
 
+def getSignature(WIDTH, HEIGHT):
+    return "Mandlebrot %dx%d" % (WIDTH, HEIGHT)
+
+
+# pick the fastest square workgroup for images of this size on this device.
+# Mandlebrots constructed afterwards use it
+def tune(device, WIDTH, HEIGHT, force=False, verbose=False):
+    maxInvocations = device.limits["maxComputeWorkGroupInvocations"]
+    return ve.autotune.tune(
+        device,
+        getSignature(WIDTH, HEIGHT),
+        [{"WORKGROUP_SIZE": s} for s in [4, 8, 16, 32] if s * s <= maxInvocations],
+        lambda params: Mandlebrot(
+            device=device,
+            parent=device,
+            WIDTH=WIDTH,
+            HEIGHT=HEIGHT,
+            WORKGROUP_SIZE=params["WORKGROUP_SIZE"],
+        ),
+        run=lambda kernel: kernel.run(),
+        force=force,
+        verbose=verbose,
+    )
+
 def runDemo():
     # device selection and instantiation
     instance_inst = ve.instance.Instance(verbose=True)
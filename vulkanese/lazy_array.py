@@ -0,0 +1,440 @@
+import os
+import sys
+import numbers
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+import vulkanese as ve
+
+# A GPU array that evaluates lazily.
+# Arithmetic on an Array (operators, or NumPy ufuncs through __array_ufunc__)
+# only records an expression tree. Nothing runs until the value is needed:
+# get(), np.asarray(), or evaluate() for several arrays at once.
+# Each pending array then compiles to one fused kernel (see math/fusion.py),
+# and all of them go out as one ComputeGraph submission.
+# The kernels are released once it completes; only the results are kept,
+# until release().
+# Reductions fuse their operand, and run on the reduction engine
+# (see math/reduce.py), over everything or along an axis.
+#   a = ve.array(x, device=device)
+#   b = np.sin(a) * 2 + a
+#   b.sum().get()
+
+# ufunc -> fused expression function (see FUNCTIONS1 and FUNCTIONS2 in arith)
+UFUNCS = {
+    np.add: "+",
+    np.subtract: "-",
+    np.multiply: "*",
+    np.true_divide: "/",
+    np.negative: "neg",
+    np.positive: "pos",
+    np.power: "pow",
+    np.remainder: "mod",
+    np.sin: "sin",
+    np.cos: "cos",
+    np.tan: "tan",
+    np.exp: "exp",
+    np.sqrt: "sqrt",
+    np.arcsin: "asin",
+    np.arccos: "acos",
+    np.arctan: "atan",
+    np.log: "log",
+    np.absolute: "abs",
+    np.arctan2: "atan",
+    np.minimum: "min",
+    np.maximum: "max",
+}
+
+# ufunc.reduce -> fused reduction
+REDUCE_UFUNCS = {
+    np.add: "sum",
+    np.multiply: "prod",
+    np.maximum: "max",
+    np.minimum: "min",
+}
+
+# reduction -> op of the reduction engine
+REDUCTIONS = ve.math.fusion.REDUCTIONS
+
+
+class Array:
+    def __init__(
+        self, device, buffer=None, op=None, args=[], shape=None, axis=None, owned=False
+    ):
+        self.device = device
+        # evaluated arrays hold a buffer (or, for full reductions
+        # and indices, a value)
+        self.buffer = buffer
+        self.value = None
+        # whether release() frees the buffer. not for wrapped StorageBuffers
+        self.owned = owned
+        self.op = op
+        self.args = args
+        # of reductions. None reduces everything
+        self.axis = axis
+        # while being evaluated
+        self.kernel = None
+        self.reduction = None
+        if buffer is not None:
+            shape = buffer.shape
+        self.shape = tuple(shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float32)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        if self.isEvaluated():
+            return "Array(" + repr(self.get()) + ")"
+        return "Array(pending " + str(self.op) + ", shape=" + str(self.shape) + ")"
+
+    def isEvaluated(self):
+        return self.buffer is not None or self.value is not None
+
+    def isReduction(self):
+        return self.op in REDUCTIONS
+
+    # record op on the arguments, broadcasting as NumPy does.
+    # the fused kernels repeat shorter inputs by flat index, which covers
+    # inputs that only lack leading dimensions. others, like (32, 1)
+    # against (32,), are broadcast by NumPy and uploaded
+    def apply(self, op, args):
+        shapes = [a.shape for a in args if isinstance(a, Array)]
+        try:
+            shape = tuple(np.broadcast_shapes(*shapes))
+        except ValueError:
+            raise Exception("can't broadcast " + " and ".join(map(str, shapes)))
+        broadcastArgs = []
+        for a in args:
+            if isinstance(a, Array) and not isRepeatable(a.shape, shape):
+                a = array(np.broadcast_to(a.get(), shape), device=self.device)
+            broadcastArgs += [a]
+        return Array(device=self.device, op=op, args=broadcastArgs, shape=shape)
+
+    # np.sum(a) etc. end up here too, with axis and out
+    def reduce(self, op, axis=None, out=None, **kwargs):
+        # the engine reduces everything, or a single axis
+        if (
+            out is not None
+            or kwargs
+            or not (axis is None or isinstance(axis, numbers.Integral))
+        ):
+            return getattr(np, op)(self.get(), axis=axis, out=out, **kwargs)
+        shape = ()
+        if axis is not None:
+            if not -self.ndim <= axis < self.ndim:
+                raise Exception(
+                    "axis " + str(axis) + " out of range for " + str(self.shape)
+                )
+            axis = axis % self.ndim
+            shape = self.shape[:axis] + self.shape[axis + 1 :]
+        return Array(device=self.device, op=op, args=[self], shape=shape, axis=axis)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        if not kwargs:
+            if method == "__call__" and ufunc in UFUNCS:
+                args = []
+                for a in inputs:
+                    if isinstance(a, (Array, numbers.Number)):
+                        args += [a]
+                    else:
+                        args += [array(a, device=self.device)]
+                return self.apply(UFUNCS[ufunc], args)
+            if method == "reduce" and ufunc in REDUCE_UFUNCS and len(inputs) == 1:
+                return inputs[0].reduce(REDUCE_UFUNCS[ufunc])
+
+        # anything else runs in NumPy, on the evaluated inputs
+        inputs = [a.get() if isinstance(a, Array) else a for a in inputs]
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    def __array__(self, dtype=None, copy=None):
+        result = np.asarray(self.get())
+        if dtype is not None:
+            result = result.astype(dtype)
+        return result
+
+    def __add__(self, other):
+        return np.add(self, other)
+
+    def __radd__(self, other):
+        return np.add(other, self)
+
+    def __sub__(self, other):
+        return np.subtract(self, other)
+
+    def __rsub__(self, other):
+        return np.subtract(other, self)
+
+    def __mul__(self, other):
+        return np.multiply(self, other)
+
+    def __rmul__(self, other):
+        return np.multiply(other, self)
+
+    def __truediv__(self, other):
+        return np.true_divide(self, other)
+
+    def __rtruediv__(self, other):
+        return np.true_divide(other, self)
+
+    def __pow__(self, other):
+        return np.power(self, other)
+
+    def __rpow__(self, other):
+        return np.power(other, self)
+
+    def __mod__(self, other):
+        return np.remainder(self, other)
+
+    def __neg__(self):
+        return np.negative(self)
+
+    def __pos__(self):
+        return np.positive(self)
+
+    def __abs__(self):
+        return np.absolute(self)
+
+    def sum(self, axis=None, **kwargs):
+        return self.reduce("sum", axis, **kwargs)
+
+    def prod(self, axis=None, **kwargs):
+        return self.reduce("prod", axis, **kwargs)
+
+    def max(self, axis=None, **kwargs):
+        return self.reduce("max", axis, **kwargs)
+
+    def min(self, axis=None, **kwargs):
+        return self.reduce("min", axis, **kwargs)
+
+    def mean(self, axis=None, **kwargs):
+        return self.reduce("mean", axis, **kwargs)
+
+    def argmax(self, axis=None, **kwargs):
+        return self.reduce("argmax", axis, **kwargs)
+
+    def argmin(self, axis=None, **kwargs):
+        return self.reduce("argmin", axis, **kwargs)
+
+    # the fused expression for this array, over named inputs.
+    # evaluated arrays are leaves
+    def getExpression(self, inputs, names):
+        # a reduction can't fuse into its consumer. it gets its own passes,
+        # and a full reduction's value comes in as a scalar
+        if self.isReduction():
+            evaluate(self)
+        if self.value is not None and not np.ndim(self.value):
+            name = "c" + str(len(inputs))
+            inputs[name] = float(self.value)
+            return name
+        if self.value is not None and self.buffer is None:
+            # indices along an axis. uploaded once, get() still returns them
+            self.buffer = array(self.value, device=self.device).buffer
+            self.owned = True
+
+        if self.isEvaluated():
+            if id(self) not in names:
+                names[id(self)] = "a" + str(len(names))
+                inputs[names[id(self)]] = self.buffer
+            return names[id(self)]
+
+        args = []
+        for a in self.args:
+            if isinstance(a, Array):
+                args += [a.getExpression(inputs, names)]
+            else:
+                # scalars become push constants, so the kernel is reused
+                name = "c" + str(len(inputs))
+                inputs[name] = float(a)
+                args += [name]
+
+        if self.op in ["+", "-", "*", "/"]:
+            return "(" + args[0] + self.op + args[1] + ")"
+        elif self.op == "neg":
+            return "(-" + args[0] + ")"
+        elif self.op == "pos":
+            return args[0]
+        return self.op + "(" + ", ".join(args) + ")"
+
+    def getFusedKernel(self):
+        inputs = {}
+        return ve.math.fusion.Expression(
+            device=self.device,
+            expression=self.getExpression(inputs, {}),
+            inputs=inputs,
+            deferCompile=True,
+        )
+
+    # the shaders that evaluate this array: its fused kernel or,
+    # for reductions, the operand's fused kernel and the Reduction passes
+    def getKernels(self):
+        if not self.isReduction():
+            self.kernel = self.getFusedKernel()
+            return [self.kernel]
+
+        operand = self.args[0]
+        kernels = []
+        if operand.buffer is not None:
+            x = operand.buffer
+        else:
+            self.kernel = operand.getFusedKernel()
+            kernels += [self.kernel]
+            x = self.kernel.result
+        self.reduction = ve.math.reduce.Reduction(
+            device=self.device,
+            x=x,
+            shape=operand.shape,
+            op=REDUCTIONS[self.op],
+            axis=self.axis,
+            deferCompile=True,
+        )
+        return kernels + self.reduction.shaders
+
+    def get(self):
+        evaluate(self)
+        if self.value is not None:
+            return self.value
+        return self.buffer.get().reshape(self.shape)
+
+    # free the GPU memory of the result. the array can't be used afterwards
+    def release(self):
+        if self.owned and self.buffer is not None:
+            releaseBuffer(self.buffer)
+        self.buffer = None
+        self.value = None
+        self.args = []
+
+
+# whether an input of shape, repeated by flat index, broadcasts to outShape
+def isRepeatable(shape, outShape):
+    if int(np.prod(shape)) == 1:
+        return True
+    shape = list(shape)
+    while shape and shape[0] == 1:
+        shape = shape[1:]
+    return tuple(shape) == tuple(outShape[len(outShape) - len(shape) :])
+
+
+def releaseBuffer(buffer):
+    buffer.release()
+    while buffer in buffer.device.buffers:
+        buffer.device.buffers.remove(buffer)
+
+
+# evaluate pending arrays together:
+# one fused kernel each (and the passes of reductions),
+# compiled in parallel, in a single submission
+def evaluate(*arrays):
+    pending = []
+    for a in arrays:
+        if not a.isEvaluated() and a not in pending:
+            pending += [a]
+    if not pending:
+        return
+
+    device = pending[0].device
+    kernels = []
+    for a in pending:
+        kernels += a.getKernels()
+    device.compileShaders(kernels)
+    for kernel in kernels:
+        kernel.finalize()
+    graph = ve.compute_graph.ComputeGraph(device=device, shaders=kernels)
+    graph.run()
+
+    # buffers of the reductions: results, and intermediates.
+    # fused kernels release their own, unless an array takes the result
+    buffers = []
+    for a in pending:
+        if a.reduction is not None:
+            buffers += a.reduction.ownBuffers
+
+    for a in pending:
+        if not a.isReduction():
+            a.buffer = a.kernel.result
+            a.kernel.ownBuffers.remove(a.buffer)
+            a.owned = True
+        elif a.axis is None or a.reduction.resultIndex is not None:
+            a.value = a.reduction.get()
+        else:
+            a.buffer = a.reduction.result
+            a.owned = True
+        # the tree, and the kernels, are no longer needed
+        a.args = []
+        a.kernel = None
+        a.reduction = None
+
+    graph.release()
+    for kernel in kernels:
+        ve.autotune.releaseKernel(kernel)
+    for buffer in buffers:
+        if not any([buffer is a.buffer for a in pending]):
+            releaseBuffer(buffer)
+
+
+# a GPU copy of data, or an Array over an existing StorageBuffer
+def array(data, device):
+    if isinstance(data, Array):
+        return data
+    if isinstance(data, ve.buffer.StorageBuffer):
+        return Array(device=device, buffer=data)
+    data = np.asarray(data)
+    buffer = device.getStorageBuffer(
+        name="array", memtype="float", qualifier="readonly", shape=np.shape(data)
+    )
+    buffer.set(data)
+    return Array(device=device, buffer=buffer, owned=True)
+
+
+def test(device):
+    print("Testing Lazy Array")
+    x = np.random.random((2**10))
+    y = np.random.random((2**10))
+    a = array(x, device=device)
+    b = array(y, device=device)
+    c = np.sin(a) * 2 + b / (a + 1)
+    d = np.maximum(c, b) - 0.5
+    evaluate(c, d)
+    expectation = np.sin(x) * 2 + y / (x + 1)
+    print("elementwise: " + str(np.allclose(np.asarray(c), expectation, rtol=1e-4)))
+    print(
+        "chained: "
+        + str(np.allclose(d.get(), np.maximum(expectation, y) - 0.5, rtol=1e-4))
+    )
+    print("sum: " + str(np.allclose(np.sum(a * b).get(), np.sum(x * y), rtol=1e-4)))
+    print("mean: " + str(np.allclose(c.mean().get(), np.mean(expectation), rtol=1e-4)))
+    print("argmax: " + str(np.argmax(c).get() == np.argmax(expectation)))
+    # (32, 1) * (32,) is (32, 32), as in NumPy
+    column = array(x[:32].reshape((32, 1)), device=device)
+    row = array(y[:32], device=device)
+    print(
+        "broadcast: "
+        + str(
+            np.allclose(
+                (column * row).get(), x[:32].reshape((32, 1)) * y[:32], rtol=1e-4
+            )
+        )
+    )
+    m = np.random.random((32, 2**5))
+    e = array(m, device=device)
+    print(
+        "axis: "
+        + str(
+            np.allclose(
+                (np.exp(e).max(axis=1) - e.sum(axis=0)).get(),
+                np.exp(m).max(axis=1) - m.sum(axis=0),
+                rtol=1e-4,
+            )
+        )
+    )
@@ -1,3 +1,5 @@
 from . import arith, reduce
+from . import fusion
+from .fusion import expr
 from . import signals
 from . import machine_learning
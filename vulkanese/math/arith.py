@@ -16,6 +16,24 @@ sys.path.insert(
 import sinode.sinode as sinode
 
 
+# opcodes of the shared ARITH kernel (see shaders/arith.template.comp).
+# anything else falls back to a #define, and its own compile
+OPERATIONS = {"+": 0, "-": 1, "*": 2, "/": 3}
+FUNCTIONS1 = {
+    "sin": 4,
+    "cos": 5,
+    "tan": 6,
+    "exp": 7,
+    "sqrt": 8,
+    "asin": 9,
+    "acos": 10,
+    "atan": 11,
+    "log": 12,
+    "abs": 13,
+}
+FUNCTIONS2 = {"pow": 20, "mod": 21, "atan": 22, "min": 23, "max": 24}
+
+
 class ARITH(ve.shader.Shader):
     def __init__(self, **kwargs):
         sinode.Sinode.__init__(self, parent=kwargs["device"], **kwargs)
@@ -25,6 +43,12 @@ class ARITH(ve.shader.Shader):
                 "buffers": [],
                 "buffType": "float",
                 "shader_basename": "shaders/arith",
+                "deferCompile": False,
+                # workgroup size. None takes the tuned value (see tune)
+                "LG_WG_SIZE": None,
+                # loop over the array in at most maxComputeWorkGroupCount
+                # workgroups, instead of one thread per element
+                "gridStride": False,
                 "memProperties": (
                     vk.VK_MEMORY_PROPERTY_DEVICE_LOCAL_BIT
                     | vk.VK_MEMORY_PROPERTY_HOST_VISIBLE_BIT
@@ -37,15 +61,37 @@ class ARITH(ve.shader.Shader):
         constantsDict["PROCTYPE"] = self.buffType
 
         if hasattr(self, "operation"):
-            constantsDict["operation"] = self.operation
+            opcode = OPERATIONS.get(self.operation)
+            define = "operation", self.operation
         elif hasattr(self, "FUNCTION1"):
-            constantsDict["FUNCTION1"] = self.FUNCTION1
+            opcode = FUNCTIONS1.get(self.FUNCTION1)
+            define = "FUNCTION1", self.FUNCTION1
         elif hasattr(self, "FUNCTION2"):
-            constantsDict["FUNCTION2"] = self.FUNCTION2
+            opcode = FUNCTIONS2.get(self.FUNCTION2)
+            define = "FUNCTION2", self.FUNCTION2
         else:
             die
-        constantsDict["YLEN"] = np.prod(np.shape(self.y))
-        constantsDict["LG_WG_SIZE"] = 7  # corresponding to 128 threads, a good number
+
+        length = int(np.prod(np.shape(self.x)))
+        specializationConstants = {}
+        if opcode is None:
+            constantsDict[define[0]] = define[1]
+            constantsDict["YLEN"] = np.prod(np.shape(self.y))
+            constantsDict["XLEN"] = length
+            constantsDict["GRID_STRIDE"] = int(self.gridStride)
+        else:
+            specializationConstants["OPCODE"] = opcode
+            specializationConstants["YLEN"] = np.prod(np.shape(self.y))
+            specializationConstants["XLEN"] = length
+            specializationConstants["GRID_STRIDE"] = int(self.gridStride)
+        if self.LG_WG_SIZE is None:
+            self.LG_WG_SIZE = ve.autotune.lookup(
+                self.device,
+                getSignature(self.buffType, np.prod(np.shape(self.x))),
+                # corresponding to 128 threads, a good number
+                {"LG_WG_SIZE": 7},
+            )["LG_WG_SIZE"]
+        constantsDict["LG_WG_SIZE"] = self.LG_WG_SIZE
         constantsDict["THREADS_PER_WORKGROUP"] = 1 << constantsDict["LG_WG_SIZE"]
 
         # device selection and instantiation
@@ -88,6 +134,17 @@ class ARITH(ve.shader.Shader):
             ),
         ]
 
+        # a thread per vec4, and one per element of the tail (length % 4).
+        # any length works, the shader bounds-checks
+        threadCount = int(length / 4) + length % 4
+        workgroupCount = int(
+            np.ceil(threadCount / constantsDict["THREADS_PER_WORKGROUP"])
+        )
+        if self.gridStride:
+            workgroupCount = min(
+                workgroupCount, self.device.limits["maxComputeWorkGroupCount"][0]
+            )
+
         # Compute Stage: the only stage
         ve.shader.Shader.__init__(
             self,
@@ -95,16 +152,20 @@ class ARITH(ve.shader.Shader):
                 arith_home, self.shader_basename + ".template.comp"
             ),  # can be GLSL or SPIRV
             constantsDict=self.constantsDict,
+            specializationConstants=specializationConstants,
+            # as declared in the template, whatever the buffers' own qualifiers
+            bufferAccess={
+                self.buffers[0]: "readonly",
+                self.buffers[1]: "readonly",
+                self.buffers[2]: "writeonly",
+            },
             device=self.device,
             name=self.shader_basename,
             stage=vk.VK_SHADER_STAGE_COMPUTE_BIT,
             buffers=self.buffers,
             DEBUG=self.DEBUG,
-            workgroupCount=[
-                int(np.prod(self.x.shape) / (constantsDict["THREADS_PER_WORKGROUP"])),
-                1,
-                1,
-            ],
+            deferCompile=self.deferCompile,
+            workgroupCount=[workgroupCount, 1, 1],
         )
 
     def baseline(self, X, Y):
@@ -137,28 +198,114 @@ class ARITH(ve.shader.Shader):
         return self.passed
 
 
+# one tuning for every operation, per type and size class
+def getSignature(buffType, length):
+    return "ARITH " + buffType + " " + ve.autotune.getSizeClass(length)
+
+
+# pick the fastest workgroup size for arrays of this length on this device.
+# ARITH kernels constructed afterwards use it
+def tune(device, length=2 ** 20, buffType="float", force=False, verbose=False):
+    x = np.random.random((length))
+    y = np.random.random((length))
+    buffersBefore = list(device.buffers)
+    buffers = []
+    for name, data in [("x", x), ("y", y)]:
+        buffers += [
+            device.getStorageBuffer(
+                name=name, memtype=buffType, qualifier="readonly", shape=[length]
+            )
+        ]
+        buffers[-1].set(data)
+
+    def make(params):
+        kernel = ARITH(
+            device=device,
+            x=buffers[0],
+            y=buffers[1],
+            operation="*",
+            buffType=buffType,
+            LG_WG_SIZE=params["LG_WG_SIZE"],
+        )
+        kernel.finalize()
+        return kernel
+
+    try:
+        return ve.autotune.tune(
+            device,
+            getSignature(buffType, length),
+            ve.autotune.getWorkgroupCandidates(device, maxThreads=length),
+            make,
+            force=force,
+            verbose=verbose,
+        )
+    finally:
+        # the inputs
+        ve.autotune.releaseBuffersSince(device, buffersBefore)
+
+
 def test(device):
     print("Testing Arithmatic")
-    signalLen = 2 ** 10
+    # not a multiple of the workgroup size, or of 4, to exercise the tail
+    signalLen = 2 ** 10 + 3
     x = np.random.random((signalLen))
     y = np.random.random((signalLen))
+    # compile all the kernels together, in parallel
     toTest = [
-        ARITH(device=device, x=x, y=y, operation="+", npEquivalent=np.add),
-        ARITH(device=device, x=x, y=y, operation="-", npEquivalent=np.subtract),
-        ARITH(device=device, x=x, y=y, operation="*", npEquivalent=np.multiply),
-        ARITH(device=device, x=x, y=y, operation="/", npEquivalent=np.divide),
-        ARITH(device=device, x=x, y=y, FUNCTION1="sin"),
-        ARITH(device=device, x=x, y=y, FUNCTION1="cos"),
-        ARITH(device=device, x=x, y=y, FUNCTION1="tan"),
-        ARITH(device=device, x=x, y=y, FUNCTION1="exp"),
+        ARITH(
+            device=device,
+            x=x,
+            y=y,
+            operation="+",
+            npEquivalent=np.add,
+            deferCompile=True,
+        ),
+        ARITH(
+            device=device,
+            x=x,
+            y=y,
+            operation="-",
+            npEquivalent=np.subtract,
+            deferCompile=True,
+        ),
+        ARITH(
+            device=device,
+            x=x,
+            y=y,
+            operation="*",
+            npEquivalent=np.multiply,
+            deferCompile=True,
+        ),
+        ARITH(
+            device=device,
+            x=x,
+            y=y,
+            operation="/",
+            npEquivalent=np.divide,
+            deferCompile=True,
+        ),
+        ARITH(
+            device=device,
+            x=x,
+            y=y,
+            operation="+",
+            npEquivalent=np.add,
+            gridStride=True,
+            deferCompile=True,
+        ),
+        ARITH(device=device, x=x, y=y, FUNCTION1="sin", deferCompile=True),
+        ARITH(device=device, x=x, y=y, FUNCTION1="cos", deferCompile=True),
+        ARITH(device=device, x=x, y=y, FUNCTION1="tan", deferCompile=True),
+        ARITH(device=device, x=x, y=y, FUNCTION1="exp", deferCompile=True),
         # ARITH(device = device, x=x, y=y, FUNCTION1="asin"),
         # ARITH(device = device, x=x, y=y, FUNCTION1="acos"),
         # ARITH(device = device, x=x, y=y, FUNCTION1="atan"),
-        ARITH(device=device, x=x, y=y, FUNCTION1="sqrt"),
+        ARITH(device=device, x=x, y=y, FUNCTION1="sqrt", deferCompile=True),
         # ARITH(device = device, x=x, y=y, FUNCTION2="pow" ),
         # ARITH(device = device, x=x, y=y, FUNCTION2="mod" ),
         # ARITH(device = device, x=x, y=y, FUNCTION2="atan"),
     ]
+    device.compileShaders(toTest)
     # print(json.dumps(device.asDict(), indent=2))
 
     for s in toTest:
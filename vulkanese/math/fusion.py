@@ -0,0 +1,411 @@
+import ast
+import os
+import sys
+import numbers
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+import vulkanese as ve
+import vulkan as vk
+
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "sinode"))
+)
+import sinode.sinode as sinode
+
+from .arith import FUNCTIONS1, FUNCTIONS2
+
+# Elementwise expression fusion.
+# An expression like "(v+w)*(x+y)" becomes one generated compute shader,
+# so intermediate results stay in registers instead of round-tripping
+# through buffers, and the whole tree costs one dispatch.
+# Inputs are renamed by position (in0, in1, ... and s0, s1, ... for scalars),
+# so the generated code depends only on the shape of the expression.
+# Lengths are specialization constants and scalars are push constants:
+# changing either reuses the same SPIR-V.
+
+OPERATORS = {ast.Add: "+", ast.Sub: "-", ast.Mult: "*", ast.Div: "/"}
+# python operators that are functions in GLSL
+OPERATOR_FUNCTIONS = {ast.Pow: "pow", ast.Mod: "mod"}
+UNARY_OPERATORS = {ast.USub: "-", ast.UAdd: "+"}
+
+# reductions of an expression run on the reduction engine (see reduce.py),
+# over the fused kernel's result.
+# name -> op of the engine
+REDUCTIONS = {
+    "sum": "SUM",
+    "prod": "PROD",
+    "max": "VMAX",
+    "min": "VMIN",
+    "mean": "MEAN",
+    "argmax": "ARGMAX",
+    "argmin": "ARGMIN",
+}
+
+# signature -> generated template
+kernelSources = {}
+
+
+class Expression(ve.shader.Shader):
+    def __init__(self, **kwargs):
+        sinode.Sinode.__init__(self, parent=kwargs["device"], **kwargs)
+        self.proc_kwargs(
+            **{
+                "DEBUG": False,
+                "expression": "",
+                # name -> numpy array, StorageBuffer or scalar
+                "inputs": {},
+                "buffType": "float",
+                "deferCompile": False,
+                "memProperties": (
+                    vk.VK_MEMORY_PROPERTY_DEVICE_LOCAL_BIT
+                    | vk.VK_MEMORY_PROPERTY_HOST_VISIBLE_BIT
+                    | vk.VK_MEMORY_PROPERTY_HOST_COHERENT_BIT
+                ),
+            }
+        )
+
+        constantsDict = {}
+        constantsDict["LG_WG_SIZE"] = 7  # corresponding to 128 threads, a good number
+        constantsDict["THREADS_PER_WORKGROUP"] = 1 << constantsDict["LG_WG_SIZE"]
+        self.constantsDict = constantsDict
+        self.instance = self.device.instance
+
+        self.tree = ast.parse(self.expression, mode="eval")
+
+        # every buffer the expression uses, once, in order of first use
+        self.buffers = []
+        # the buffers this kernel made (uploaded inputs, and the result),
+        # released with it
+        self.ownBuffers = []
+        self.lengths = []
+        self.bufferNames = {}
+        self.scalarNames = {}
+        self.scalarValues = {}
+        for node in ast.walk(self.tree):
+            if not isinstance(node, ast.Name) or node.id in self.getFunctionNames():
+                continue
+            if node.id not in self.inputs:
+                raise Exception(
+                    "expression " + self.expression + " has no input " + node.id
+                )
+            value = self.inputs[node.id]
+            if isinstance(value, numbers.Number):
+                if node.id not in self.scalarNames:
+                    self.scalarNames[node.id] = "s" + str(len(self.scalarNames))
+                    self.scalarValues[self.scalarNames[node.id]] = value
+                continue
+            if node.id in self.bufferNames:
+                continue
+            if not isinstance(value, ve.buffer.StorageBuffer):
+                data = np.asarray(value)
+                value = self.device.getStorageBuffer(
+                    name=node.id,
+                    memtype=self.buffType,
+                    qualifier="readonly",
+                    shape=np.shape(data),
+                    memProperties=self.memProperties,
+                )
+                value.set(data)
+                self.ownBuffers += [value]
+            if value not in self.buffers:
+                self.buffers += [value]
+                self.lengths += [value.itemCount]
+            self.bufferNames[node.id] = "in" + str(self.buffers.index(value))
+
+        if not self.buffers:
+            raise Exception("expression " + self.expression + " has no buffer inputs")
+
+        # shorter inputs repeat, as y does in ARITH
+        self.itemCount = max(self.lengths)
+        for buffer, length in zip(self.buffers, self.lengths):
+            if self.itemCount % length:
+                raise Exception(
+                    "can't broadcast "
+                    + buffer.name
+                    + " ("
+                    + str(length)
+                    + ") to "
+                    + str(self.itemCount)
+                )
+        shape = [b.shape for b in self.buffers if b.itemCount == self.itemCount][0]
+        threadsPerWorkgroup = constantsDict["THREADS_PER_WORKGROUP"]
+        workgroupCount = int(
+            (self.itemCount + threadsPerWorkgroup - 1) / threadsPerWorkgroup
+        )
+
+        self.result = self.device.getStorageBuffer(
+            name="result",
+            memtype=self.buffType,
+            qualifier="writeonly",
+            shape=shape,
+            memProperties=self.memProperties,
+        )
+        self.buffers += [self.result]
+        self.ownBuffers += [self.result]
+
+        specializationConstants = {"N": self.itemCount}
+        for i, length in enumerate(self.lengths):
+            specializationConstants["LEN" + str(i)] = length
+
+        self.pushConstants = {name: "float" for name in self.scalarValues.keys()}
+        self.signature = self.getSignature()
+        if self.signature not in kernelSources:
+            kernelSources[self.signature] = self.getSource()
+
+        ve.shader.Shader.__init__(
+            self,
+            sourceCode=kernelSources[self.signature],
+            constantsDict=self.constantsDict,
+            specializationConstants=specializationConstants,
+            pushConstants=self.pushConstants,
+            bufferAccess={b: "readonly" for b in self.buffers[:-1]},
+            device=self.device,
+            name="expression",
+            stage=vk.VK_SHADER_STAGE_COMPUTE_BIT,
+            buffers=self.buffers,
+            DEBUG=self.DEBUG,
+            deferCompile=self.deferCompile,
+            workgroupCount=[workgroupCount, 1, 1],
+        )
+        self.setPushConstants(self.scalarValues)
+
+    def getFunctionNames(self):
+        return set(FUNCTIONS1.keys()) | set(FUNCTIONS2.keys())
+
+    # the GLSL for one node of the expression tree
+    def toGlsl(self, node):
+        if isinstance(node, ast.Expression):
+            return self.toGlsl(node.body)
+        elif isinstance(node, ast.BinOp) and type(node.op) in OPERATORS:
+            return (
+                "("
+                + self.toGlsl(node.left)
+                + OPERATORS[type(node.op)]
+                + self.toGlsl(node.right)
+                + ")"
+            )
+        elif isinstance(node, ast.BinOp) and type(node.op) in OPERATOR_FUNCTIONS:
+            return (
+                OPERATOR_FUNCTIONS[type(node.op)]
+                + "("
+                + self.toGlsl(node.left)
+                + ", "
+                + self.toGlsl(node.right)
+                + ")"
+            )
+        elif isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPERATORS:
+            return (
+                "(" + UNARY_OPERATORS[type(node.op)] + self.toGlsl(node.operand) + ")"
+            )
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+            name = node.func.id
+            if (
+                not (
+                    (len(node.args) == 1 and name in FUNCTIONS1)
+                    or (len(node.args) == 2 and name in FUNCTIONS2)
+                )
+                or node.keywords
+            ):
+                raise Exception(
+                    "unsupported call " + name + " in expression " + self.expression
+                )
+            return name + "(" + ", ".join([self.toGlsl(a) for a in node.args]) + ")"
+        elif isinstance(node, ast.Name):
+            if node.id in self.scalarNames:
+                return self.scalarNames[node.id]
+            inName = self.bufferNames[node.id]
+            i = int(inName[2:])
+            if self.lengths[i] == self.itemCount:
+                return inName + "[i]"
+            return inName + "[i % LEN" + str(i) + "]"
+        elif isinstance(node, ast.Constant) and isinstance(node.value, numbers.Number):
+            return repr(float(node.value))
+        else:
+            raise Exception(
+                "unsupported "
+                + type(node).__name__
+                + " in expression "
+                + self.expression
+            )
+
+    # everything the generated code depends on
+    def getSignature(self):
+        return (
+            self.toGlsl(self.tree),
+            len(self.lengths),
+            len(self.pushConstants),
+            self.buffType,
+        )
+
+    def getSource(self):
+        glslCode = "#version 450\n#extension GL_ARB_separate_shader_objects : enable\n"
+        glslCode += "DEFINE_STRING\n"
+        for i in range(len(self.lengths)):
+            glslCode += (
+                "layout(std430, set = 0, binding = "
+                + str(i)
+                + ") buffer in"
+                + str(i)
+                + "_buf\n{\n   readonly "
+                + self.buffType
+                + " in"
+                + str(i)
+                + "[];\n};\n"
+            )
+        glslCode += (
+            "layout(std430, set = 0, binding = "
+            + str(len(self.lengths))
+            + ") buffer result_buf\n{\n   writeonly "
+            + self.buffType
+            + " result[];\n};\n"
+        )
+        glslCode += self.getPushConstantDeclaration()
+        glslCode += "layout (local_size_x = THREADS_PER_WORKGROUP, local_size_y = 1, local_size_z = 1 ) in;\n"
+        value = self.buffType + "(" + self.toGlsl(self.tree) + ")"
+        glslCode += "void main() {\n"
+        glslCode += "    uint i = gl_GlobalInvocationID.x;\n"
+        glslCode += "    if (i >= N) return;\n"
+        glslCode += "    result[i] = " + value + ";\n"
+        glslCode += "}\n"
+        return glslCode
+
+    def get(self):
+        return self.result.get()
+
+    # update scalar inputs, by their name in the expression
+    def set(self, **values):
+        self.setPushConstants({self.scalarNames[k]: v for k, v in values.items()})
+
+    def release(self):
+        ve.shader.Shader.release(self)
+        for buffer in self.ownBuffers:
+            buffer.release()
+            while buffer in self.device.buffers:
+                self.device.buffers.remove(buffer)
+        self.ownBuffers = []
+
+
+# an Expression, reduced by the engine in the same submission
+class ReducedExpression(sinode.Sinode):
+    def __init__(self, **kwargs):
+        sinode.Sinode.__init__(self, parent=kwargs["device"], **kwargs)
+        self.proc_kwargs(
+            **{
+                "expression": "",
+                "inputs": {},
+                # a key of REDUCTIONS
+                "reduction": "sum",
+                # None reduces everything to a scalar
+                "axis": None,
+                "deferCompile": False,
+            }
+        )
+        if self.reduction not in REDUCTIONS:
+            raise Exception("unknown reduction " + str(self.reduction))
+        self.kernel = Expression(
+            device=self.device,
+            expression=self.expression,
+            inputs=self.inputs,
+            deferCompile=True,
+        )
+        self.reducer = ve.math.reduce.Reduction(
+            device=self.device,
+            x=self.kernel.result,
+            op=REDUCTIONS[self.reduction],
+            axis=self.axis,
+            deferCompile=True,
+        )
+        self.shaders = [self.kernel] + self.reducer.shaders
+        self.graph = None
+        if not self.deferCompile:
+            self.device.compileShaders(self.shaders)
+            self.finalize()
+
+    def finalize(self):
+        for shader in self.shaders:
+            shader.finalize()
+        self.graph = ve.compute_graph.ComputeGraph(
+            device=self.device, shaders=self.shaders
+        )
+
+    # returns a synchronization.Future for the submission
+    def run(self, blocking=True):
+        return self.graph.run(blocking=blocking)
+
+    def wait(self, timeout=None):
+        return self.graph.wait(timeout)
+
+    # the reduced value, or array along axis
+    def get(self):
+        return self.reducer.get()
+
+    # update scalar inputs, by their name in the expression
+    def set(self, **values):
+        self.kernel.set(**values)
+
+    def release(self):
+        if self.graph is not None:
+            self.graph.release()
+        self.reducer.release()
+        ve.autotune.releaseKernel(self.kernel)
+
+
+# fuse an elementwise expression into a single kernel
+#   e = ve.math.expr("(v+w)*(x+y)", device=device, v=v, w=w, x=x, y=y)
+#   e.run()
+#   e.result.get()
+# reduction="sum" etc. reduces it on the engine instead (see reduce.py),
+# and e.get() returns the value
+def expr(expression, device, deferCompile=False, reduction="", **inputs):
+    if reduction:
+        return ReducedExpression(
+            device=device,
+            expression=expression,
+            inputs=inputs,
+            reduction=reduction,
+            deferCompile=deferCompile,
+        )
+    kernel = Expression(
+        device=device,
+        expression=expression,
+        inputs=inputs,
+        deferCompile=deferCompile,
+    )
+    if not deferCompile:
+        kernel.finalize()
+    return kernel
+
+
+def test(device):
+    print("Testing Expression Fusion")
+    signalLen = 2**10
+    v = np.random.random((signalLen))
+    w = np.random.random((signalLen))
+    x = np.random.random((signalLen))
+    y = np.random.random((signalLen))
+    for expression, expectation in [
+        ("(v+w)*(x+y)", (v + w) * (x + y)),
+        ("sin(v)*a + pow(w, 2)", np.sin(v) * 0.5 + w**2),
+        ("max(x, y) - min(x, y) / -a", np.maximum(x, y) + np.minimum(x, y) / 0.5),
+    ]:
+        kernel = expr(expression, device=device, v=v, w=w, x=x, y=y, a=0.5)
+        kernel.run(blocking=True)
+        passed = np.allclose(kernel.result.get(), expectation, rtol=1e-4)
+        print(expression + ": " + str(passed))
+        ve.autotune.releaseKernel(kernel)
+
+    for reduction in REDUCTIONS.keys():
+        kernel = expr("v*w", device=device, reduction=reduction, v=v, w=w)
+        kernel.run(blocking=True)
+        expectation = getattr(np, reduction)((v * w).astype(np.float32))
+        passed = np.allclose(kernel.get(), expectation, rtol=1e-4)
+        print(reduction + "(v*w): " + str(passed))
+        kernel.release()
+
+
+if __name__ == "__main__":
+    instance = ve.instance.Instance(verbose=False)
+    device = instance.getDevice(0)
+    test(device=device)
+    instance.release()
@@ -1,163 +1,498 @@
 import os
 import sys
 import time
-from scipy.signal import get_window
+import numpy as np
 
-sum_home = os.path.dirname(os.path.abspath(__file__))
-# if vulkanese isn't installed, check for a development version parallel to Loiacono repo ;)
-import pkg_resources
+reduce_home = os.path.dirname(os.path.abspath(__file__))
 
-here = os.path.dirname(os.path.abspath(__file__))
-sys.path.insert(0, os.path.abspath(os.path.join(here, "..", "..")))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 import vulkanese as ve
 import vulkan as vk
 
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "sinode"))
+)
+import sinode.sinode as sinode
 
-# Create a compute shader
-class Sum(ve.shader.Shader):
-    def __init__(
-        self,
-        device,
-        inBuffer,
-        N,
-        waitSemaphores=[],
-        constantsDict={},
-        DEBUG=False,
-        buffType="float",
-        interleave=0,
-        memProperties=0
-        | vk.VK_MEMORY_PROPERTY_DEVICE_LOCAL_BIT
-        | vk.VK_MEMORY_PROPERTY_HOST_VISIBLE_BIT,
-    ):
-
-        # the constants will be placed into the shader.comp file,
-        # and also available in Python
-        constantsDict["INPUT_LENGTH"] = N * (device.subgroupSize ** 2)
-        constantsDict["PROCTYPE"] = buffType
-        constantsDict["TOTAL_THREAD_COUNT"] = N * N
-        constantsDict["LG_WG_SIZE"] = 7
-        constantsDict["THREADS_PER_WORKGROUP"] = 1 << constantsDict["LG_WG_SIZE"]
-        constantsDict["N"] = N
-        constantsDict["INTERLEAVE"] = interleave
+# Reductions of a buffer to a scalar, or of one axis of an N-D buffer.
+# The buffer is viewed as [outside, length, inside], length being the axis.
+# Contiguous rows (inside == 1) take at most two passes
+# (see shaders/reduce.template.comp):
+#   1. up to THREADS_PER_WORKGROUP * 4 workgroups per row each fold a strided
+#      slice of it, through subgroup operations and shared memory,
+#      into one partial per workgroup
+#   2. a single workgroup per row folds the partials
+# Rows short enough for one workgroup finish in pass 1.
+# An inner axis (inside > 1), or short rows, are one pass,
+# with a thread per output.
+# Both passes go out as one ComputeGraph submission.
+#   r = ve.math.reduce.Reduction(device=device, x=x, op="MEAN", axis=1)
+#   r.run()
+#   r.get()
 
+# opcodes of shaders/reduce.template.comp
+OPERATIONS = {
+    "SUM": 0,
+    "PROD": 1,
+    "VMAX": 2,
+    "VMIN": 3,
+    "MEAN": 4,
+    "ARGMAX": 5,
+    "ARGMIN": 6,
+}
+# reductions that return the index of the value
+ARG_OPERATIONS = ["ARGMAX", "ARGMIN"]
+
+NP_EQUIVALENTS = {
+    "SUM": np.sum,
+    "PROD": np.prod,
+    "VMAX": np.max,
+    "VMIN": np.min,
+    "MEAN": np.mean,
+    "ARGMAX": np.argmax,
+    "ARGMIN": np.argmin,
+}
+
+# pass 1 work per thread before a row is split across workgroups
+MIN_ITEMS_PER_THREAD = 8
+# pass 2 work per thread, at most
+MAX_PARTIALS_PER_THREAD = 4
+
+
+# [outside, length, inside] of a reduction of shape along axis
+def getExtents(shape, axis):
+    if axis is None:
+        return 1, int(np.prod(shape)), 1
+    return (
+        int(np.prod(shape[:axis])),
+        int(shape[axis]),
+        int(np.prod(shape[axis + 1 :])),
+    )
+
+
+# workgroups sharing each row in pass 1. 1 means a single pass
+def getGroupCount(length, inside, threads):
+    if inside != 1 or length < threads:
+        return 1
+    groups = int(np.ceil(length / (threads * MIN_ITEMS_PER_THREAD)))
+    return max(1, min(groups, threads * MAX_PARTIALS_PER_THREAD))
+
+
+# one pass of a Reduction
+class ReducePass(ve.shader.Shader):
+    def __init__(self, **kwargs):
+        sinode.Sinode.__init__(self, parent=kwargs["device"], **kwargs)
+        self.proc_kwargs(
+            **{
+                "DEBUG": False,
+                "op": "SUM",
+                "buffType": "float",
+                "LG_WG_SIZE": 7,
+                "deferCompile": False,
+                # [outside, length, inside] of the input
+                "extents": [1, 1, 1],
+                # workgroups per row
+                "groups": 1,
+                # the last pass scales MEAN by scale
+                "final": True,
+                "scale": 1.0,
+                # indices of the input values along the axis,
+                # when the input is a previous pass's partials
+                "inIndex": None,
+                "outIndex": None,
+            }
+        )
+        outside, length, inside = self.extents
+        arg = self.op in ARG_OPERATIONS
+
+        constantsDict = {}
+        constantsDict["PROCTYPE"] = self.buffType
+        constantsDict["LG_WG_SIZE"] = self.LG_WG_SIZE
+        constantsDict["THREADS_PER_WORKGROUP"] = 1 << self.LG_WG_SIZE
+        constantsDict["ARG"] = int(arg)
+        constantsDict["INDEXED_INPUT"] = int(self.inIndex is not None)
+        constantsDict["SUBGROUPS"] = int(
+            "arithmetic" in self.device.subgroupOperations
+            and bool(self.device.subgroupStages & vk.VK_SHADER_STAGE_COMPUTE_BIT)
+        )
         self.constantsDict = constantsDict
+        self.instance = self.device.instance
 
-        # make the constants available locally
-        for k, v in self.constantsDict.items():
-            if type(v) != str:
-                exec("self." + k + " = " + str(v))
-            else:
-                exec("self." + k + ' = "' + v + '"')
-
-        # device selection and instantiation
-        self.instance = device.instance
-        self.device = device
-        inBuffer.qualifier = "readonly"
-        inBuffer.name = "inBuf"
-        # declare buffers. they will be in GPU memory, but visible from the host (!)
-        buffers = [
-            # x is the input signal
-            inBuffer,
-            # The following 4 are reduction buffers
-            # Intermediate buffers for computing the sum
-            ve.buffer.StorageBuffer(
-                device=self.device,
-                name="Lr0",
-                memtype=buffType,
-                dimensionVals=[N, self.device.subgroupSize],
-            ),
-            # L is the final output
-            ve.buffer.StorageBuffer(
-                device=self.device,
-                name="sumOut",
-                memtype=buffType,
-                qualifier="writeonly",
-                dimensionVals=[N],
-                memProperties=memProperties,
-            ),
-            # DebugBuffer(
-            #    device=self.device,
-            #    name="allShaders",
-            #    memtype=buffType,
-            #    dimensionVals=[constantsDict["TOTAL_THREAD_COUNT"]],
-            # ),
-        ]
+        specializationConstants = {
+            "OPCODE": OPERATIONS[self.op],
+            "OUTSIDE": outside,
+            "LENGTH": length,
+            "INSIDE": inside,
+            "GROUPS": self.groups,
+            "FINAL": int(self.final),
+            "SCALE": float(self.scale),
+        }
+
+        # in the order of the template's bindings
+        bufferAccess = {self.inBuffer: "readonly", self.outBuffer: "writeonly"}
+        buffers = [self.inBuffer, self.outBuffer]
+        if arg:
+            buffers += [self.outIndex]
+            bufferAccess[self.outIndex] = "writeonly"
+            if self.inIndex is not None:
+                buffers += [self.inIndex]
+                bufferAccess[self.inIndex] = "readonly"
+
+        # workgroups fold rows together, unless the rows are short,
+        # or strided (inside > 1). then a thread folds each
+        threads = constantsDict["THREADS_PER_WORKGROUP"]
+        cooperative = inside == 1 and length >= threads
+        specializationConstants["COOPERATIVE"] = int(cooperative)
+        if cooperative:
+            workgroupCount = outside * self.groups
+        else:
+            workgroupCount = int(np.ceil(outside * inside / threads))
 
-        # Create a compute shader
-        # Compute Stage: the only stage
         ve.shader.Shader.__init__(
             self,
-            sourceFilename=os.path.join(
-                sum_home, "shaders/sum.c"
-            ),  # can be GLSL or SPIRV
+            sourceFilename=os.path.join(reduce_home, "shaders/reduce.template.comp"),
             constantsDict=self.constantsDict,
-            stage=vk.VK_SHADER_STAGE_COMPUTE_BIT,
+            specializationConstants=specializationConstants,
+            bufferAccess=bufferAccess,
             device=self.device,
-            name="sum",
+            name="reduce " + self.op,
+            stage=vk.VK_SHADER_STAGE_COMPUTE_BIT,
             buffers=buffers,
-            DEBUG=DEBUG,
-            workgroupCount=[
-                int(self.INPUT_LENGTH / (constantsDict["THREADS_PER_WORKGROUP"])),
-                1,
-                1,
-            ],
-            waitSemaphores=waitSemaphores,
-            compressBuffers=True,  # flat float arrays, instead of skipping every 4
+            DEBUG=self.DEBUG,
+            deferCompile=self.deferCompile,
+            workgroupCount=[workgroupCount, 1, 1],
         )
 
-    def debugRun(self):
-        vstart = time.time()
-        self.run()
-        vlen = time.time() - vstart
-        self.absresult = self.gpuBuffers.L
-        print("vlen " + str(vlen))
-        # return self.sumOut.getAsNumpyArray()
 
-    def feed(self, newData):
-        self.gpuBuffers.x.setByIndexStart(self.offset, newData)
-        self.offset = (self.offset + len(newData)) % self.signalLength
-        self.gpuBuffers.offset.setByIndex(index=0, data=[self.offset])
-        self.run()
-        self.absresult = self.gpuBuffers.L.getAsNumpyArray()
-        return self.absresult
+class Reduction(sinode.Sinode):
+    def __init__(self, **kwargs):
+        sinode.Sinode.__init__(self, parent=kwargs["device"], **kwargs)
+        self.proc_kwargs(
+            **{
+                "DEBUG": False,
+                # numpy array, or StorageBuffer
+                "x": None,
+                # of x, when it differs from the buffer's own shape
+                "shape": None,
+                # a key of OPERATIONS
+                "op": "SUM",
+                # None reduces everything to a scalar
+                "axis": None,
+                "buffType": "float",
+                # workgroup size. None takes the tuned value (see tune)
+                "LG_WG_SIZE": None,
+                # leave compilation to finalize(), or to Device.compileShaders
+                "deferCompile": False,
+                "memProperties": (
+                    vk.VK_MEMORY_PROPERTY_DEVICE_LOCAL_BIT
+                    | vk.VK_MEMORY_PROPERTY_HOST_VISIBLE_BIT
+                    | vk.VK_MEMORY_PROPERTY_HOST_COHERENT_BIT
+                ),
+            }
+        )
+        if self.op not in OPERATIONS:
+            raise Exception(
+                "unknown reduction "
+                + str(self.op)
+                + ". Choose from "
+                + str(list(OPERATIONS.keys()))
+            )
 
+        if isinstance(self.x, ve.buffer.StorageBuffer):
+            self.inBuffer = self.x
+            if self.shape is None:
+                self.shape = self.x.shape
+        else:
+            data = np.asarray(self.x)
+            if self.shape is None:
+                self.shape = np.shape(data)
+            self.inBuffer = self.device.getStorageBuffer(
+                name="x",
+                memtype=self.buffType,
+                qualifier="readonly",
+                shape=np.shape(data),
+                memProperties=self.memProperties,
+            )
+            self.inBuffer.set(data)
+        self.shape = tuple(self.shape)
 
-if __name__ == "__main__":
+        if self.axis is not None:
+            if not -len(self.shape) <= self.axis < len(self.shape):
+                raise Exception(
+                    "axis " + str(self.axis) + " out of range for " + str(self.shape)
+                )
+            self.axis = self.axis % len(self.shape)
+            self.outShape = self.shape[: self.axis] + self.shape[self.axis + 1 :]
+        else:
+            self.outShape = ()
+        outside, length, inside = getExtents(self.shape, self.axis)
+        if length == 0:
+            raise Exception("zero-size reduction over " + str(self.shape))
+        outputCount = outside * inside
+
+        if self.LG_WG_SIZE is None:
+            self.LG_WG_SIZE = ve.autotune.lookup(
+                self.device,
+                getSignature(self.buffType, length),
+                {"LG_WG_SIZE": 7},
+            )["LG_WG_SIZE"]
+        threads = 1 << self.LG_WG_SIZE
+        groups = getGroupCount(length, inside, threads)
+        arg = self.op in ARG_OPERATIONS
+
+        self.result = self.device.getStorageBuffer(
+            name="result",
+            memtype=self.buffType,
+            qualifier="writeonly",
+            shape=[outputCount],
+            memProperties=self.memProperties,
+        )
+        self.resultIndex = None
+        if arg:
+            self.resultIndex = self.device.getStorageBuffer(
+                name="resultIndex",
+                memtype="uint",
+                qualifier="writeonly",
+                shape=[outputCount],
+                memProperties=self.memProperties,
+            )
+        self.ownBuffers = [b for b in [self.result, self.resultIndex] if b is not None]
+        if self.inBuffer is not self.x:
+            self.ownBuffers += [self.inBuffer]
+
+        passKwargs = {
+            "device": self.device,
+            "op": self.op,
+            "buffType": self.buffType,
+            "LG_WG_SIZE": self.LG_WG_SIZE,
+            "DEBUG": self.DEBUG,
+            "deferCompile": True,
+            "scale": 1.0 / length,
+        }
+        if groups == 1:
+            self.passes = [
+                ReducePass(
+                    inBuffer=self.inBuffer,
+                    outBuffer=self.result,
+                    outIndex=self.resultIndex,
+                    extents=[outside, length, inside],
+                    **passKwargs,
+                )
+            ]
+        else:
+            # a partial per workgroup, and its index along the axis
+            partial = self.device.getStorageBuffer(
+                name="partial",
+                memtype=self.buffType,
+                shape=[outside * groups],
+                intent="device",
+            )
+            partialIndex = None
+            if arg:
+                partialIndex = self.device.getStorageBuffer(
+                    name="partialIndex",
+                    memtype="uint",
+                    shape=[outside * groups],
+                    intent="device",
+                )
+            self.ownBuffers += [b for b in [partial, partialIndex] if b is not None]
+            self.passes = [
+                ReducePass(
+                    inBuffer=self.inBuffer,
+                    outBuffer=partial,
+                    outIndex=partialIndex,
+                    extents=[outside, length, 1],
+                    groups=groups,
+                    final=False,
+                    **passKwargs,
+                ),
+                # the final single-workgroup pass, per row
+                ReducePass(
+                    inBuffer=partial,
+                    outBuffer=self.result,
+                    inIndex=partialIndex,
+                    outIndex=self.resultIndex,
+                    extents=[outside, groups, 1],
+                    **passKwargs,
+                ),
+            ]
+        self.graph = None
+
+        if not self.deferCompile:
+            self.device.compileShaders(self.passes)
+            self.finalize()
+
+    # the shaders, for a ComputeGraph of their own (see finalize),
+    # or of a bigger one that also produces x
+    @property
+    def shaders(self):
+        return self.passes
+
+    def finalize(self):
+        for p in self.passes:
+            p.finalize()
+        self.graph = ve.compute_graph.ComputeGraph(
+            device=self.device, shaders=self.passes
+        )
 
-    # generate a sine wave at A440, SR=48000
-    sr = 48000
-    A4 = 440
-    z = np.sin(np.arange(2 ** 15) * 2 * np.pi * A4 / sr)
-    z += np.sin(2 * np.arange(2 ** 15) * 2 * np.pi * A4 / sr)
-    z += np.sin(3 * np.arange(2 ** 15) * 2 * np.pi * A4 / sr)
-    z += np.sin(4 * np.arange(2 ** 15) * 2 * np.pi * A4 / sr)
-
-    multiple = 40
-    normalizedStep = 5.0 / sr
-    # create a linear distribution of desired frequencies
-    fprime = np.arange(100 / sr, 3000 / sr, normalizedStep)
-
-    # generate a Loiacono based on this SR
-    # (this one runs in CPU. reference only)
-    linst = Loiacono(fprime=fprime, multiple=multiple, dtftlen=2 ** 15)
-    linst.debugRun(z)
-
-    # begin GPU test
-    instance = Instance(verbose=False)
+    # returns a synchronization.Future for the submission
+    def run(self, blocking=True):
+        return self.graph.run(blocking=blocking)
+
+    def wait(self, timeout=None):
+        return self.graph.wait(timeout)
+
+    # the reduced value, or array of outShape. indices for ARGMAX and ARGMIN.
+    # a copy: Buffer.get may return a view of the buffer's mapped memory,
+    # which goes back to the pool when the reduction is released
+    def get(self):
+        if self.resultIndex is not None:
+            result = self.resultIndex.get().astype(np.int64)
+        else:
+            result = self.result.get()
+        if self.outShape == ():
+            return result[0]
+        return np.array(result.reshape(self.outShape))
+
+    def release(self):
+        if self.graph is not None:
+            self.graph.release()
+        for p in self.passes:
+            ve.autotune.releaseKernel(p)
+        for b in self.ownBuffers:
+            b.release()
+
+
+# sums each of the N rows of inBuffer into sumOut
+class Sum(Reduction):
+    def __init__(self, device, inBuffer, N, **kwargs):
+        kwargs["op"] = "SUM"
+        Reduction.__init__(
+            self,
+            device=device,
+            x=inBuffer,
+            shape=[N, int(inBuffer.itemCount / N)],
+            axis=1,
+            **kwargs,
+        )
+        self.sumOut = self.result
+
+
+# reduce x (numpy array or StorageBuffer) and return the value
+def reduce(x, device, op="SUM", axis=None, **kwargs):
+    reduction = Reduction(device=device, x=x, op=op, axis=axis, **kwargs)
+    reduction.run(blocking=True)
+    result = reduction.get()
+    reduction.release()
+    return result
+
+
+# one tuning for every reduction, per type and size class of the reduced axis
+def getSignature(buffType, length):
+    return "Reduce " + buffType + " " + ve.autotune.getSizeClass(length)
+
+
+# pick the fastest workgroup size for reductions of this length on this device.
+# Reductions constructed afterwards use it
+def tune(device, length=2**20, buffType="float", force=False, verbose=False):
+    buffersBefore = list(device.buffers)
+    x = device.getStorageBuffer(
+        name="x", memtype=buffType, qualifier="readonly", shape=[length]
+    )
+    x.set(np.random.random((length)))
+
+    def make(params):
+        return Reduction(device=device, x=x, op="SUM", LG_WG_SIZE=params["LG_WG_SIZE"])
+
+    try:
+        return ve.autotune.tune(
+            device,
+            getSignature(buffType, length),
+            ve.autotune.getWorkgroupCandidates(device),
+            make,
+            force=force,
+            verbose=verbose,
+        )
+    finally:
+        # the input
+        ve.autotune.releaseBuffersSince(device, buffersBefore)
+
+
+def test(device):
+    print("Testing Reduction")
+    # not a multiple of anything, to exercise the bounds
+    x = np.random.random((2**16 + 3)) + 0.5
+    m = np.random.random((37, 1025, 5))
+    cases = [(op, x, None) for op in OPERATIONS.keys()]
+    cases += [
+        (op, m, axis) for op in ["SUM", "VMAX", "MEAN", "ARGMIN"] for axis in [0, 1, 2]
+    ]
+    for op, data, axis in cases:
+        if op == "PROD":
+            # keep the product finite
+            data = 1 + (data - 1) / len(data)
+        reduction = Reduction(device=device, x=data, op=op, axis=axis)
+        reduction.run(blocking=True)
+        result = reduction.get()
+        expectation = NP_EQUIVALENTS[op](data.astype(np.float32), axis=axis)
+        if op in ARG_OPERATIONS:
+            passed = np.array_equal(result, expectation)
+        else:
+            passed = np.allclose(result, expectation, rtol=1e-4)
+        print(
+            op
+            + " of "
+            + str(np.shape(data))
+            + " along "
+            + str(axis)
+            + ": "
+            + str(passed)
+        )
+        reduction.release()
+
+
+# time a full reduction on the GPU against numpy, over several lengths.
+# GPU times are from run() to completion on the host, so they include
+# submission; enable device.profiler for the passes alone
+def benchmark(device, lengths=[2**16, 2**20, 2**24], op="SUM", runs=20):
+    print("Benchmarking Reduction " + op + " against numpy")
+    print(
+        "%12s %12s %12s %10s %8s" % ("length", "gpu ms", "numpy ms", "speedup", "match")
+    )
+    results = []
+    for length in lengths:
+        x = np.random.random((length)).astype(np.float32)
+        reduction = Reduction(device=device, x=x, op=op)
+        reduction.run(blocking=True)
+
+        gpuTimes = []
+        for i in range(runs):
+            start = time.perf_counter()
+            reduction.run(blocking=True)
+            gpuTimes += [time.perf_counter() - start]
+        cpuTimes = []
+        for i in range(runs):
+            start = time.perf_counter()
+            expectation = NP_EQUIVALENTS[op](x)
+            cpuTimes += [time.perf_counter() - start]
+
+        gpuTime = float(np.median(gpuTimes))
+        cpuTime = float(np.median(cpuTimes))
+        match = bool(np.allclose(reduction.get(), expectation, rtol=1e-3))
+        print(
+            "%12d %12.3f %12.3f %10.2f %8s"
+            % (length, gpuTime * 1000, cpuTime * 1000, cpuTime / gpuTime, match)
+        )
+        results += [
+            {"length": length, "gpu": gpuTime, "numpy": cpuTime, "match": match}
+        ]
+        reduction.release()
+    return results
+
+
+if __name__ == "__main__":
+    instance = ve.instance.Instance(verbose=False)
     device = instance.getDevice(0)
-    linst_gpu = Sum(device=device, fprime=fprime, multiple=linst.multiple)
-    linst_gpu.gpuBuffers.x.set(z)
-    for i in range(10):
-        linst_gpu.debugRun()
-    # linst_gpu.dumpMemory()
-    readstart = time.time()
-    linst_gpu.absresult = linst_gpu.gpuBuffers.L.getAsNumpyArray()
-    print("Readtime " + str(time.time() - readstart))
-
-    fig, ((ax1, ax2)) = plt.subplots(1, 2)
-    ax1.plot(linst.fprime * sr, linst_gpu.absresult)
-    ax1.set_title("GPU Result")
-    ax2.plot(linst.fprime * sr, linst.absresult)
-    ax2.set_title("CPU Result")
-
-    plt.show()
+    test(device=device)
+    benchmark(device=device)
+    instance.release()
@@ -30,9 +30,14 @@ class Loiacono_GPU(ve.shader.Shader):
         sinode.Sinode.__init__(self, **kwargs)
         self.proc_kwargs(
             signalLength=2 ** 15,
+            # extra ring capacity, in samples, for audio appended
+            # while a dispatch is still reading the previous window
+            ringSlack=4096,
             constantsDict={},
             DEBUG=False,
             buffType="float",
+            # workgroup size. None takes the tuned value (see tune)
+            LG_WG_SIZE=None,
             memProperties=0
             | vk.VK_MEMORY_PROPERTY_DEVICE_LOCAL_BIT
             | vk.VK_MEMORY_PROPERTY_HOST_VISIBLE_BIT,
@@ -43,12 +48,25 @@ class Loiacono_GPU(ve.shader.Shader):
         constantsDict = {}
         constantsDict["multiple"] = self.multiple
         constantsDict["SIGNAL_LENGTH"] = self.signalLength
+        constantsDict["RING_LENGTH"] = self.signalLength + self.ringSlack
         constantsDict["PROCTYPE"] = self.buffType
         constantsDict["TOTAL_THREAD_COUNT"] = self.signalLength * len(self.fprime)
-        constantsDict["LG_WG_SIZE"] = 7
+        if self.LG_WG_SIZE is None:
+            self.LG_WG_SIZE = ve.autotune.lookup(
+                self.device,
+                getSignature(self.buffType, self.signalLength * len(self.fprime)),
+                {"LG_WG_SIZE": 7},
+            )["LG_WG_SIZE"]
+        constantsDict["LG_WG_SIZE"] = self.LG_WG_SIZE
         constantsDict["THREADS_PER_WORKGROUP"] = 1 << constantsDict["LG_WG_SIZE"]
         constantsDict["windowed"] = 0
 
+        # sizes are specialization constants rather than #defines,
+        # so every signal length and multiple shares one compiled shader
+        self.specializationConstants = {}
+        for k in ["multiple", "SIGNAL_LENGTH", "RING_LENGTH", "TOTAL_THREAD_COUNT"]:
+            self.specializationConstants[k] = constantsDict.pop(k)
+
         # device selection and instantiation
         self.instance = self.device.instance
         self.constantsDict = constantsDict
@@ -60,13 +78,13 @@ class Loiacono_GPU(ve.shader.Shader):
 
         # declare buffers. they will be in GPU memory, but visible from the host (!)
         buffers = [
-            # x is the input signal
-            ve.buffer.StorageBuffer(
+            # x is the input signal, streamed into a ring
+            ve.buffer.RingBuffer(
                 device=self.device,
                 name="x",
                 memtype=self.buffType,
                 qualifier="readonly",
-                shape=[2 ** 15],  # always 32**3
+                shape=[self.specializationConstants["RING_LENGTH"]],
                 memProperties=self.memProperties,
             ),
             # The following 4 are reduction buffers
@@ -118,14 +136,6 @@ class Loiacono_GPU(ve.shader.Shader):
                 dimIndexNames=["F"],
                 memProperties=self.memProperties,
             ),
-            ve.buffer.StorageBuffer(
-                device=self.device,
-                name="offset",
-                memtype="uint",
-                qualifier="readonly",
-                shape=[16],
-                memProperties=self.memProperties,
-            ),
             # StorageBuffer(
             #    device=self.device,
             #    name="allShaders",
@@ -153,9 +163,15 @@ class Loiacono_GPU(ve.shader.Shader):
         ve.shader.Shader.__init__(
             self,
             sourceFilename=os.path.join(
-                loiacono_home, "shaders/loiacono.comp.template"
+                loiacono_home, "shaders/loiacono.template.comp"
             ),
             constantsDict=self.constantsDict,
+            specializationConstants=self.specializationConstants,
+            runtimeSizedBuffers=True,
+            # the reduction buffers are sized for this subgroup size
+            requiredSubgroupSize=self.device.subgroupSize,
+            # the ring's write head, published once per dispatch
+            pushConstants={"offset": "uint"},
             device=self.device,
             name="loiacono",
             stage=vk.VK_SHADER_STAGE_COMPUTE_BIT,
@@ -174,7 +190,6 @@ class Loiacono_GPU(ve.shader.Shader):
         )
 
         self.gpuBuffers.f.set(self.fprime)
-        self.gpuBuffers.offset.zeroInitialize()
         self.offset = 0
         if constantsDict["windowed"]:
             self.gpuBuffers.window.set(get_window("hamming", 1024))
@@ -182,25 +197,64 @@ class Loiacono_GPU(ve.shader.Shader):
         self.finalize()
 
     def debugRun(self, z):
-        linst_gpu.gpuBuffers.x.set(z)
+        self.gpuBuffers.x.set(z)
         vstart = time.time()
-        self.run()
+        self.dispatch()
         vlen = time.time() - vstart
         self.spectrum = self.gpuBuffers.L
         print("vlen " + str(vlen))
         # return self.sumOut.get()
 
+    # append audio to the ring without dispatching.
+    # may be called from a producer thread while a dispatch is in flight,
+    # as long as no more than ringSlack samples arrive per dispatch
+    def append(self, newData):
+        self.offset = self.gpuBuffers.x.write(newData)
+
+    # compute the spectrum of the newest signalLength samples
+    def dispatch(self, blocking=True):
+        head = self.gpuBuffers.x.publish()
+        return self.run(blocking, pushConstants={"offset": head})
+
     def feed(self, newData, blocking=True):
-        self.gpuBuffers.x.setByIndexStart(self.offset, newData)
-        self.offset = (self.offset + len(newData)) % self.signalLength
-        self.gpuBuffers.offset.setByIndex(index=0, data=[self.offset])
-        self.run(blocking)
+        self.append(newData)
+        return self.dispatch(blocking)
 
     def getSpectrum(self):
+        self.wait()
         self.spectrum = self.gpuBuffers.L.get()
         return self.spectrum
 
 
+
+# one thread per sample and frequency
+def getSignature(buffType, threadCount):
+    return "Loiacono " + buffType + " " + ve.autotune.getSizeClass(threadCount)
+
+
+# pick the fastest workgroup size for this many samples and frequencies.
+# Loiacono_GPU instances constructed afterwards use it
+def tune(device, fprime, multiple, signalLength=2 ** 15, force=False, verbose=False):
+    # the reduction is over subgroups, so workgroups hold whole ones
+    lgMin = max(5, int(np.log2(device.subgroupSize)))
+    return ve.autotune.tune(
+        device,
+        getSignature("float", signalLength * len(fprime)),
+        ve.autotune.getWorkgroupCandidates(device, lgMin=lgMin),
+        lambda params: Loiacono_GPU(
+            device=device,
+            parent=device,
+            fprime=fprime,
+            multiple=multiple,
+            signalLength=signalLength,
+            LG_WG_SIZE=params["LG_WG_SIZE"],
+        ),
+        run=lambda kernel: kernel.dispatch(),
+        force=force,
+        verbose=verbose,
+    )
+
+
 if __name__ == "__main__":
     # generate a sine wave at A440, SR=48000
     sr = 48000
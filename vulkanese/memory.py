@@ -0,0 +1,301 @@
+import threading
+import vulkan as vk
+
+# Device-wide sub-allocator.
+# Instead of one vkAllocateMemory per Buffer, we allocate large blocks
+# per memory type and hand out power-of-two ranges from them (buddy allocation).
+# Freed ranges merge with their buddy and go back to the block.
+# Requests larger than half a block get a dedicated allocation of their own.
+
+
+def nextPow2(n):
+    return 1 << max(0, int(n - 1).bit_length())
+
+
+class Allocation:
+    def __init__(self, block, offset, size, allocatedSize, order):
+        self.block = block
+        self.offset = offset
+        self.size = size
+        self.allocatedSize = allocatedSize
+        self.order = order
+        self.vkDeviceMemory = block.vkDeviceMemory
+        self.freed = False
+
+    # a cffi buffer over this allocation's bytes only
+    # (same semantics as the buffer vkMapMemory returns)
+    def getMap(self, size=None):
+        if self.block.pmap is None:
+            return None
+        if size is None:
+            size = self.size
+        return vk.ffi.buffer(self.block.address + self.offset, size)
+
+    # (offset, size) of a VkMappedMemoryRange covering bytes [startByte, endByte)
+    # of this allocation, widened to nonCoherentAtomSize
+    def getMappedRange(self, startByte, endByte):
+        atomSize = self.block.pool.atomSize
+        start = self.offset + startByte - (self.offset + startByte) % atomSize
+        end = self.offset + endByte
+        end += -end % atomSize
+        if end >= self.block.size:
+            return start, vk.VK_WHOLE_SIZE
+        return start, end - start
+
+    def free(self):
+        if not self.freed:
+            self.block.pool.free(self)
+            self.freed = True
+
+
+class MemoryBlock:
+    def __init__(self, pool, memoryTypeIndex, size, dedicated=False):
+        self.pool = pool
+        self.device = pool.device
+        self.memoryTypeIndex = memoryTypeIndex
+        self.size = size
+        self.dedicated = dedicated
+        self.liveBytes = 0
+        self.allocatedBytes = 0
+        self.allocations = {}
+
+        self.allocateInfo = vk.VkMemoryAllocateInfo(
+            sType=vk.VK_STRUCTURE_TYPE_MEMORY_ALLOCATE_INFO,
+            allocationSize=size,
+            memoryTypeIndex=memoryTypeIndex,
+        )
+        self.vkDeviceMemory = vk.vkAllocateMemory(
+            self.device.vkDevice, self.allocateInfo, None
+        )
+
+        # host visible blocks stay mapped for their whole lifetime.
+        # every allocation gets a window into this one mapping
+        propertyFlags = self.device.memoryProperties["memoryTypes"][memoryTypeIndex][
+            "propertyFlags"
+        ]
+        self.hostVisible = bool(propertyFlags & vk.VK_MEMORY_PROPERTY_HOST_VISIBLE_BIT)
+        if self.hostVisible:
+            self.pmap = vk.vkMapMemory(
+                device=self.device.vkDevice,
+                memory=self.vkDeviceMemory,
+                offset=0,
+                size=size,
+                flags=0,
+            )
+            self.address = vk.ffi.from_buffer(self.pmap)
+        else:
+            self.pmap = None
+            self.address = None
+
+        # buddy bookkeeping. order 0 is the smallest allocation
+        if not dedicated:
+            self.minSize = pool.minAllocationSize
+            self.maxOrder = (size // self.minSize).bit_length() - 1
+            self.freeLists = [set() for i in range(self.maxOrder + 1)]
+            self.freeLists[self.maxOrder].add(0)
+
+    def getOrder(self, size):
+        order = 0
+        while (self.minSize << order) < size:
+            order += 1
+        return order
+
+    def allocate(self, size, alignment):
+        if self.dedicated:
+            if self.allocations:
+                return None
+            allocation = Allocation(self, 0, size, self.size, -1)
+        else:
+            # buddy ranges are naturally aligned to their own size
+            order = self.getOrder(max(size, alignment))
+            if order > self.maxOrder:
+                return None
+
+            # find the smallest free range that fits
+            found = None
+            for o in range(order, self.maxOrder + 1):
+                if self.freeLists[o]:
+                    found = o
+                    break
+            if found is None:
+                return None
+
+            offset = min(self.freeLists[found])
+            self.freeLists[found].remove(offset)
+
+            # split it down, returning the upper halves to the free lists
+            while found > order:
+                found -= 1
+                self.freeLists[found].add(offset + (self.minSize << found))
+
+            allocation = Allocation(self, offset, size, self.minSize << order, order)
+
+        self.allocations[allocation.offset] = allocation
+        self.liveBytes += allocation.size
+        self.allocatedBytes += allocation.allocatedSize
+        return allocation
+
+    def free(self, allocation):
+        del self.allocations[allocation.offset]
+        self.liveBytes -= allocation.size
+        self.allocatedBytes -= allocation.allocatedSize
+        if self.dedicated:
+            return
+
+        # merge with the buddy for as long as it is free
+        offset = allocation.offset
+        order = allocation.order
+        while order < self.maxOrder:
+            buddy = offset ^ (self.minSize << order)
+            if buddy not in self.freeLists[order]:
+                break
+            self.freeLists[order].remove(buddy)
+            offset = min(offset, buddy)
+            order += 1
+        self.freeLists[order].add(offset)
+
+    def isEmpty(self):
+        return not self.allocations
+
+    def getFreeBytes(self):
+        if self.dedicated:
+            return 0
+        return self.size - self.allocatedBytes
+
+    def getLargestFree(self):
+        if self.dedicated:
+            return 0
+        for o in range(self.maxOrder, -1, -1):
+            if self.freeLists[o]:
+                return self.minSize << o
+        return 0
+
+    def release(self):
+        if self.pmap is not None:
+            vk.vkUnmapMemory(self.device.vkDevice, self.vkDeviceMemory)
+            self.pmap = None
+        vk.vkFreeMemory(self.device.vkDevice, self.vkDeviceMemory, None)
+
+
+class MemoryPool:
+    def __init__(self, device, blockSize=64 * 1024 * 1024, minAllocationSize=256):
+        self.device = device
+        self.lock = threading.Lock()
+
+        # flush ranges must be multiples of nonCoherentAtomSize,
+        # so the smallest buddy range must be as well
+        self.atomSize = max(1, int(self.device.limits.get("nonCoherentAtomSize", 1)))
+        self.minAllocationSize = nextPow2(max(minAllocationSize, self.atomSize))
+        self.blockSize = nextPow2(blockSize)
+
+        # memoryTypeIndex -> [MemoryBlock]
+        self.blocks = {}
+
+    # dont reserve more than a quarter of a heap in one block
+    def getBlockSize(self, memoryTypeIndex):
+        memoryType = self.device.memoryProperties["memoryTypes"][memoryTypeIndex]
+        heapSize = self.device.memoryProperties["memoryHeaps"][
+            memoryType["heapIndex"]
+        ]["size"]
+        blockSize = self.blockSize
+        while blockSize > self.minAllocationSize and blockSize > heapSize // 4:
+            blockSize //= 2
+        return blockSize
+
+    def allocate(self, memoryRequirements, memoryTypeIndex):
+        size = int(memoryRequirements.size)
+        alignment = int(memoryRequirements.alignment)
+        with self.lock:
+            blocks = self.blocks.setdefault(memoryTypeIndex, [])
+            blockSize = self.getBlockSize(memoryTypeIndex)
+
+            # big buffers get their own memory object
+            if size > blockSize // 2:
+                block = MemoryBlock(self, memoryTypeIndex, size, dedicated=True)
+                blocks.append(block)
+                return block.allocate(size, alignment)
+
+            for block in blocks:
+                if block.dedicated:
+                    continue
+                allocation = block.allocate(size, alignment)
+                if allocation is not None:
+                    return allocation
+
+            self.device.instance.debug(
+                "allocating new memory block of "
+                + str(blockSize)
+                + " bytes for memory type "
+                + str(memoryTypeIndex)
+            )
+            block = MemoryBlock(self, memoryTypeIndex, blockSize)
+            blocks.append(block)
+            return block.allocate(size, alignment)
+
+    def free(self, allocation):
+        with self.lock:
+            block = allocation.block
+            block.free(allocation)
+            # dedicated blocks are never reused
+            if block.dedicated:
+                self.blocks[block.memoryTypeIndex].remove(block)
+                block.release()
+
+    # free and release every block that holds no live allocations
+    def trim(self):
+        with self.lock:
+            for memoryTypeIndex, blocks in self.blocks.items():
+                for block in [b for b in blocks if b.isEmpty()]:
+                    blocks.remove(block)
+                    block.release()
+
+    def getStats(self):
+        with self.lock:
+            stats = {"memoryTypes": {}}
+            for memoryTypeIndex, blocks in self.blocks.items():
+                typeStats = {
+                    "blockCount": len(blocks),
+                    "dedicatedCount": len([b for b in blocks if b.dedicated]),
+                    "reservedBytes": sum([b.size for b in blocks]),
+                    "allocatedBytes": sum([b.allocatedBytes for b in blocks]),
+                    "liveBytes": sum([b.liveBytes for b in blocks]),
+                    "liveAllocations": sum([len(b.allocations) for b in blocks]),
+                    "freeBytes": sum([b.getFreeBytes() for b in blocks]),
+                    "largestFreeBytes": max([b.getLargestFree() for b in blocks] + [0]),
+                }
+                stats["memoryTypes"][memoryTypeIndex] = typeStats
+
+            for k in [
+                "blockCount",
+                "dedicatedCount",
+                "reservedBytes",
+                "allocatedBytes",
+                "liveBytes",
+                "liveAllocations",
+                "freeBytes",
+            ]:
+                stats[k] = sum([t[k] for t in stats["memoryTypes"].values()])
+            stats["largestFreeBytes"] = max(
+                [t["largestFreeBytes"] for t in stats["memoryTypes"].values()] + [0]
+            )
+
+            # internal: bytes lost to power-of-two rounding
+            # external: free bytes that can't be handed out as one range
+            for s in [stats] + list(stats["memoryTypes"].values()):
+                if s["allocatedBytes"]:
+                    s["internalFragmentation"] = 1 - s["liveBytes"] / s["allocatedBytes"]
+                else:
+                    s["internalFragmentation"] = 0.0
+                if s["freeBytes"]:
+                    s["externalFragmentation"] = 1 - s["largestFreeBytes"] / s["freeBytes"]
+                else:
+                    s["externalFragmentation"] = 0.0
+
+            return stats
+
+    def release(self):
+        with self.lock:
+            for blocks in self.blocks.values():
+                for block in blocks:
+                    block.release()
+            self.blocks = {}
@@ -0,0 +1,184 @@
+import threading
+import numpy as np
+import vulkan as vk
+
+# GPU-side timing of every dispatch.
+# When enabled, each recorded dispatch is bracketed by two vkCmdWriteTimestamp
+# into a query pool slot pair of its own. Command buffers are re-recorded
+# on their next run, to add (or drop) the timestamps.
+# The pair is read back when the submission completes, converted to
+# nanoseconds with the device's timestampPeriod, and kept per shader.
+#   device.profiler.enable()
+#   ...
+#   device.profiler.report()
+
+
+class Profiler:
+    def __init__(self, device, maxDispatches=2048, maxSamples=100000):
+        self.device = device
+        self.maxDispatches = maxDispatches
+        self.maxSamples = maxSamples
+        self.enabled = False
+        self.vkQueryPool = None
+        self.lock = threading.Lock()
+        self.freeSlots = []
+        # (Future, [(shader name, query)]) submitted, not yet read back
+        self.pending = []
+        # shader name -> [duration in ns]
+        self.samples = {}
+        # called with (shader name, start ns, end ns) of each dispatch,
+        # on the device's timestamp clock (see trace.py)
+        self.listeners = []
+
+        # nanoseconds per timestamp tick
+        self.timestampPeriod = float(self.device.limits.get("timestampPeriod", 1))
+        # only the low timestampValidBits of a timestamp are meaningful
+        self.validBits = min(
+            [
+                self.device.queueFamilies[i].timestampValidBits
+                for i in self.device.computeQueueFamilyIndices
+            ]
+        )
+
+    def enable(self):
+        if self.enabled:
+            return
+        if not self.validBits:
+            raise Exception("device " + self.device.name + " has no compute timestamps")
+        if self.vkQueryPool is None:
+            self.vkQueryPool = vk.vkCreateQueryPool(
+                self.device.vkDevice,
+                vk.VkQueryPoolCreateInfo(
+                    sType=vk.VK_STRUCTURE_TYPE_QUERY_POOL_CREATE_INFO,
+                    queryType=vk.VK_QUERY_TYPE_TIMESTAMP,
+                    queryCount=2 * self.maxDispatches,
+                ),
+                None,
+            )
+            self.freeSlots = list(range(self.maxDispatches - 1, -1, -1))
+        self.enabled = True
+
+    # recordings that have timestamps keep them until they are re-recorded
+    def disable(self):
+        self.enabled = False
+
+    def clear(self):
+        with self.lock:
+            self.samples = {}
+
+    # first query of a free slot pair, or None when they are all in use
+    def allocate(self):
+        with self.lock:
+            if not self.freeSlots:
+                return None
+            return 2 * self.freeSlots.pop()
+
+    def free(self, queries):
+        with self.lock:
+            self.freeSlots += [int(q / 2) for q in queries]
+
+    # bracket a dispatch: call with "begin" before it, "end" after
+    def writeTimestamp(self, vkCommandBuffer, query, point):
+        if point == "begin":
+            vk.vkCmdResetQueryPool(vkCommandBuffer, self.vkQueryPool, query, 2)
+            vk.vkCmdWriteTimestamp(
+                vkCommandBuffer,
+                vk.VK_PIPELINE_STAGE_TOP_OF_PIPE_BIT,
+                self.vkQueryPool,
+                query,
+            )
+        else:
+            vk.vkCmdWriteTimestamp(
+                vkCommandBuffer,
+                vk.VK_PIPELINE_STAGE_BOTTOM_OF_PIPE_BIT,
+                self.vkQueryPool,
+                query + 1,
+            )
+
+    # read back the queries of a submission once it completes
+    def track(self, future, queries):
+        if not queries:
+            return
+        with self.lock:
+            self.pending += [(future, queries)]
+        future.addCallback(self.collectDone)
+
+    # read back every completed submission.
+    # call before resubmitting a command buffer, which overwrites its queries
+    def collectDone(self):
+        with self.lock:
+            done = [p for p in self.pending if p[0].done()]
+            for p in done:
+                self.pending.remove(p)
+        for future, queries in done:
+            self.collect(queries)
+
+    # read back (name, query) pairs of a completed submission
+    def collect(self, queries):
+        data = vk.ffi.new("uint64_t[2]")
+        mask = (1 << self.validBits) - 1 if self.validBits < 64 else ~0
+        durations = []
+        for name, query in queries:
+            vk.vkGetQueryPoolResults(
+                self.device.vkDevice,
+                self.vkQueryPool,
+                query,
+                2,
+                vk.ffi.sizeof(data),
+                data,
+                8,
+                vk.VK_QUERY_RESULT_64_BIT | vk.VK_QUERY_RESULT_WAIT_BIT,
+            )
+            start = (data[0] & mask) * self.timestampPeriod
+            ticks = ((data[1] & mask) - (data[0] & mask)) & mask
+            durations += [(name, start, ticks * self.timestampPeriod)]
+        for listener in list(self.listeners):
+            for name, start, duration in durations:
+                listener(name, start, start + duration)
+        with self.lock:
+            for name, start, duration in durations:
+                samples = self.samples.setdefault(name, [])
+                samples += [duration]
+                if len(samples) > self.maxSamples:
+                    del samples[: len(samples) - self.maxSamples]
+
+    # per shader: count, and min, p50, p99 and mean in microseconds.
+    # printed as a table, slowest first, and returned as a dict
+    def report(self, verbose=True):
+        self.collectDone()
+        with self.lock:
+            samples = {k: np.array(v) / 1000.0 for k, v in self.samples.items()}
+        stats = {}
+        for name, s in samples.items():
+            stats[name] = {
+                "count": len(s),
+                "min": float(np.min(s)),
+                "p50": float(np.percentile(s, 50)),
+                "p99": float(np.percentile(s, 99)),
+                "mean": float(np.mean(s)),
+                "total": float(np.sum(s)),
+            }
+
+        if verbose:
+            print(
+                "%-40s %8s %10s %10s %10s %10s"
+                % ("shader", "count", "min us", "p50 us", "p99 us", "total ms")
+            )
+            for name, st in sorted(stats.items(), key=lambda i: -i[1]["total"]):
+                print(
+                    "%-40s %8d %10.1f %10.1f %10.1f %10.2f"
+                    % (
+                        name[-40:],
+                        st["count"],
+                        st["min"],
+                        st["p50"],
+                        st["p99"],
+                        st["total"] / 1000.0,
+                    )
+                )
+        return stats
+
+    def release(self):
+        if self.vkQueryPool is not None:
+            vk.vkDestroyQueryPool(self.device.vkDevice, self.vkQueryPool, None)
+            self.vkQueryPool = None
@@ -7,6 +7,8 @@ sys.path.insert(
 )
 import sinode.sinode as sinode
 import re
+import struct
+import numbers
 import vulkan as vk
 from . import buffer
 from . import compute_pipeline
@@ -19,6 +21,36 @@ from pathlib import Path
 here = os.path.dirname(os.path.abspath(__file__))
 
 
+# GLSL type, placeholder and packed 4-byte value of a specialization constant
+def getSpecializationValue(value):
+    if isinstance(value, bool):
+        return "bool", "true", struct.pack("<I", int(value))
+    elif isinstance(value, numbers.Integral):
+        if value < 0:
+            return "int", "1", struct.pack("<i", int(value))
+        return "uint", "1u", struct.pack("<I", int(value))
+    else:
+        return "float", "1.0", struct.pack("<f", float(value))
+
+
+# std430 layout of push constant members: struct format, size, alignment
+PUSH_CONSTANT_TYPES = {
+    "float": ("f", 4, 4),
+    "int": ("i", 4, 4),
+    "uint": ("I", 4, 4),
+    "bool": ("I", 4, 4),
+    "double": ("d", 8, 8),
+    "vec2": ("2f", 8, 8),
+    "vec3": ("3f", 12, 16),
+    "vec4": ("4f", 16, 16),
+    "ivec2": ("2i", 8, 8),
+    "ivec4": ("4i", 16, 16),
+    "uvec2": ("2I", 8, 8),
+    "uvec4": ("4I", 16, 16),
+    "dvec2": ("2d", 16, 16),
+}
+
+
 class Empty:
     def __init__(self):
         pass
@@ -35,6 +67,8 @@ class Shader(sinode.Sinode):
         self.proc_kwargs(
             **{
                 "sourceFilename": "",
+                # template text, for generated shaders that have no file
+                "sourceCode": "",
                 "stage": vk.VK_SHADER_STAGE_VERTEX_BIT,
                 "DEBUG": False,
                 "workgroupCount": [1, 1, 1],
@@ -43,6 +77,22 @@ class Shader(sinode.Sinode):
                 "depends": [],
                 "waitStages": None,
                 "signalSemaphores": [],  # these only used for compute shaders
+                # leave compilation to finalize(), or to Device.compileShaders
+                "deferCompile": False,
+                # name -> value. declared as specialization constants,
+                # so changing a value doesn't change the SPIR-V
+                "specializationConstants": {},
+                # declare storage buffers as x[] instead of x[length]
+                "runtimeSizedBuffers": False,
+                # buffer -> qualifier, for buffers this shader accesses differently
+                # than their own qualifier says. used by ComputeGraph
+                "bufferAccess": {},
+                # name -> GLSL type. declared in a push constant block
+                # and set per dispatch with run(pushConstants={name: value})
+                "pushConstants": {},
+                # pin the subgroup size, where the device supports it
+                # (VK_EXT_subgroup_size_control). 0 leaves it to the driver
+                "requiredSubgroupSize": 0,
             }
         )
 
@@ -55,6 +105,8 @@ class Shader(sinode.Sinode):
             device=self.device, parent=self
         )
 
+        self.getPushConstantLayout()
+
         self.gpuBuffers = Empty()
         self.basename = self.sourceFilename.replace(".template", "")
 
@@ -73,16 +125,107 @@ class Shader(sinode.Sinode):
         # Desc Pools belong to the shader
         self.descriptorPool.finalize()
 
-        outfilename = self.basename + ".spv"
-        # if its spv (compiled), just run it
-        if self.sourceFilename.endswith(".spv"):
+        self.vkShaderModule = None
+        if not self.deferCompile:
+            self.createShaderModule(self.getSpirv())
+
+    # (reads, writes) of this shader on one of its buffers
+    def getBufferAccess(self, buffer):
+        qualifier = self.bufferAccess.get(buffer, buffer.qualifier)
+        return "writeonly" not in qualifier, "readonly" not in qualifier
+
+    # member offsets follow std430, which push constant blocks use
+    def getPushConstantLayout(self):
+        self.pushConstantOffsets = {}
+        self.pushConstantValues = {}
+        offset = 0
+        for name, glslType in self.pushConstants.items():
+            fmt, size, alignment = PUSH_CONSTANT_TYPES[glslType]
+            offset += -offset % alignment
+            self.pushConstantOffsets[name] = offset
+            self.pushConstantValues[name] = None
+            offset += size
+        self.pushConstantSize = offset + (-offset % 4)
+
+    def getPushConstantDeclaration(self):
+        if not self.pushConstants:
+            return ""
+        declaration = "layout(push_constant) uniform PushConstants\n{\n"
+        for name, glslType in self.pushConstants.items():
+            declaration += "   " + glslType + " " + name + ";\n"
+        return declaration + "};\n"
+
+    def setPushConstants(self, values):
+        for name, value in values.items():
+            if name not in self.pushConstants:
+                raise Exception("Shader " + self.name + " has no push constant " + name)
+            self.pushConstantValues[name] = value
+
+    # the push constant block, as bytes. unset members are zero
+    def packPushConstants(self):
+        data = bytearray(self.pushConstantSize)
+        for name, glslType in self.pushConstants.items():
+            value = self.pushConstantValues[name]
+            if value is None:
+                continue
+            fmt = PUSH_CONSTANT_TYPES[glslType][0]
+            offset = self.pushConstantOffsets[name]
+            # vectors take a sequence
+            if fmt[0].isdigit():
+                struct.pack_into("<" + fmt, data, offset, *value)
+            else:
+                struct.pack_into("<" + fmt, data, offset, value)
+        return bytes(data)
+
+    # specialization constants are declared with a placeholder value.
+    # the real values are supplied when the pipeline is created
+    def getSpecializationDeclaration(self):
+        declaration = ""
+        for i, (name, value) in enumerate(self.specializationConstants.items()):
+            glslType, default, data = getSpecializationValue(value)
+            declaration += (
+                "layout(constant_id = "
+                + str(i)
+                + ") const "
+                + glslType
+                + " "
+                + name
+                + " = "
+                + default
+                + ";\n"
+            )
+        return declaration
+
+    def getSpecializationInfo(self):
+        if not self.specializationConstants:
+            return None
+        mapEntries = []
+        self.specializationData = b""
+        for i, value in enumerate(self.specializationConstants.values()):
+            glslType, default, data = getSpecializationValue(value)
+            mapEntries += [
+                vk.VkSpecializationMapEntry(
+                    constantID=i, offset=len(self.specializationData), size=len(data)
+                )
+            ]
+            self.specializationData += data
+        return vk.VkSpecializationInfo(
+            mapEntryCount=len(mapEntries),
+            pMapEntries=mapEntries,
+            dataSize=len(self.specializationData),
+            pData=vk.ffi.from_buffer(self.specializationData),
+        )
+
+    # if its spv (compiled), just read it.
+    # if its not an spv, compile it
+    def getSpirv(self):
+        if self.sourceCode:
+            return self.compile()
+        elif self.sourceFilename.endswith(".spv"):
             with open(self.sourceFilename, "rb") as f:
-                spirv = f.read()
-        # if its not an spv, compile it
+                return f.read()
         elif ".template" in self.sourceFilename:
-            spirv = self.compile()
-            with open(outfilename, "wb+") as f:
-                f.write(spirv)
+            return self.compile()
         else:
             raise Exception(
                 "source template filename "
@@ -90,6 +233,7 @@ class Shader(sinode.Sinode):
                 + " must end with .template"
             )
 
+    def createShaderModule(self, spirv):
         # Create Stage
         self.vkShaderModuleCreateInfo = vk.VkShaderModuleCreateInfo(
             sType=vk.VK_STRUCTURE_TYPE_SHADER_MODULE_CREATE_INFO,
@@ -103,17 +247,37 @@ class Shader(sinode.Sinode):
         )
 
         # Create Shader stage
+        self.vkSpecializationInfo = self.getSpecializationInfo()
+        self.vkRequiredSubgroupSizeCreateInfo = None
+        if self.requiredSubgroupSize:
+            if self.device.canRequireSubgroupSize(
+                self.stage, self.requiredSubgroupSize
+            ):
+                self.vkRequiredSubgroupSizeCreateInfo = (
+                    vk.VkPipelineShaderStageRequiredSubgroupSizeCreateInfo(
+                        requiredSubgroupSize=self.requiredSubgroupSize
+                    )
+                )
+            else:
+                self.debug(
+                    "can't require subgroup size " + str(self.requiredSubgroupSize)
+                )
         self.vkPipelineShaderStageCreateInfo = vk.VkPipelineShaderStageCreateInfo(
             sType=vk.VK_STRUCTURE_TYPE_PIPELINE_SHADER_STAGE_CREATE_INFO,
+            pNext=self.vkRequiredSubgroupSizeCreateInfo,
             stage=self.stage,
             module=self.vkShaderModule,
             flags=0,
-            pSpecializationInfo=None,
+            pSpecializationInfo=self.vkSpecializationInfo,
             pName="main",
         )
         self.debug("creating Stage " + str(self.stage))
 
     def finalize(self):
+        # deferred shaders that weren't batch compiled
+        if self.vkShaderModule is None:
+            self.createShaderModule(self.getSpirv())
+
         # if this is a compute shader, it corresponds with a single pipeline. we create that here
         if self.stage == vk.VK_SHADER_STAGE_COMPUTE_BIT:
             # generate a compute cmd buffer
@@ -138,54 +302,77 @@ class Shader(sinode.Sinode):
         if hasattr(self, "computePipeline"):
             self.debug("destroying Pipeline")
             self.computePipeline.release()
-        self.debug("destroying shader")
-        vk.vkDestroyShaderModule(self.device.vkDevice, self.vkShaderModule, None)
-
-    def compile(self):
-
-        with open(self.sourceFilename, "r") as f:
-            glslCode = f.read()
+        if self.vkShaderModule is not None:
+            self.debug("destroying shader")
+            vk.vkDestroyShaderModule(self.device.vkDevice, self.vkShaderModule, None)
+
+    # GLSL file extension glslc uses to infer the stage
+    def getStageSuffix(self):
+        suffix = os.path.splitext(self.basename)[1]
+        if suffix in [".comp", ".vert", ".frag", ".geom", ".tesc", ".tese"]:
+            return suffix
+        return {
+            vk.VK_SHADER_STAGE_COMPUTE_BIT: ".comp",
+            vk.VK_SHADER_STAGE_VERTEX_BIT: ".vert",
+            vk.VK_SHADER_STAGE_FRAGMENT_BIT: ".frag",
+            vk.VK_SHADER_STAGE_GEOMETRY_BIT: ".geom",
+        }.get(self.stage, ".comp")
+
+    def preprocess(self):
+
+        if self.sourceCode:
+            glslCode = self.sourceCode
+        else:
+            with open(self.sourceFilename, "r") as f:
+                glslCode = f.read()
 
         # PREPROCESS THE SHADER CODE
         # RELATIVE TO DEFINED BUFFERS
 
         # put structs and buffers into the code
-        glslCode = glslCode.replace("BUFFERS_STRING", self.descriptorPool.getComputeDeclaration())
+        glslCode = glslCode.replace(
+            "BUFFERS_STRING",
+            self.descriptorPool.getComputeDeclaration(self.runtimeSizedBuffers)
+            + self.getPushConstantDeclaration(),
+        )
 
         # add definitions from constants dict
         DEFINE_STRING = ""
         for k, v in self.constantsDict.items():
             DEFINE_STRING += "#define " + k + " " + str(v) + "\n"
+        DEFINE_STRING += self.getSpecializationDeclaration()
         glslCode = glslCode.replace("DEFINE_STRING", DEFINE_STRING)
+        return glslCode
 
-        # COMPILE GLSL TO SPIR-V
+    # GLSL -> SPIR-V, through the on-disk cache (see cache.py)
+    def compile(self):
+        glslCode = self.preprocess()
         self.debug("compiling Stage")
-        glslFilename = self.basename
-
-        with open(glslFilename, "w+") as f:
-            f.write(glslCode)
-
-        # delete the old one
-        # POS always outputs to "a.spv"
-        compiledFilename = "a.spv"
-        if os.path.exists(compiledFilename):
-            os.remove(compiledFilename)
-        self.debug("running " + glslFilename)
-        # os.system("glslc --scalar-block-layout " + glslFilename)
-        glslcbin = os.path.join(here, "glslc")
-        os.system(glslcbin + " --target-env=vulkan1.1 " + glslFilename)
-        with open(compiledFilename, "rb") as f:
-            spirv = f.read()
+        return self.compilePreprocessed(glslCode)
+
+    # the part of compile() that is safe to run on a worker thread
+    def compilePreprocessed(self, glslCode):
+        spirv = ve.cache.getSpirvCache().compile(
+            glslCode,
+            defines=self.constantsDict,
+            suffix=self.getStageSuffix(),
+            targetEnv="vulkan1.1",
+        )
 
+        # keep the generated code next to the template, for inspection
+        if self.DEBUG and self.basename:
+            ve.cache.atomicWrite(self.basename, glslCode.encode())
+            ve.cache.atomicWrite(self.basename + ".spv", spirv)
 
         return spirv
 
-    def run(self, blocking=True):
+    # returns a synchronization.Future for the submission
+    def run(self, blocking=True, pushConstants=None):
         self.dump()
-        self.computePipeline.run(blocking=blocking)
+        return self.computePipeline.run(blocking=blocking, pushConstants=pushConstants)
 
-    def wait(self):
-        self.computePipeline.wait()
+    def wait(self, timeout=None):
+        return self.computePipeline.wait(timeout)
 
     def getVertexBuffers(self):
         allVertexBuffers = []
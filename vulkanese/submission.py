@@ -0,0 +1,320 @@
+import asyncio
+import threading
+import vulkan as vk
+
+from . import synchronization
+
+# Thread-safe submission to one VkQueue.
+# Vulkan requires vkQueueSubmit calls on a queue to be externally synchronized,
+# so every submission to the queue goes through its SubmitQueue.
+#
+# submit() only queues the VkSubmitInfo and returns a Submission.
+# A single thread takes everything pending, and hands it to the driver
+# as one vkQueueSubmit with many VkSubmitInfos, and one fence for the batch.
+# A second thread waits on the fences of batches in flight, and
+# completes each request's Submission once its batch is done,
+# so waiting never delays the next submission.
+# So requests from many Python threads cost one driver call per batch.
+#
+# submitDirect() submits immediately, under the same lock,
+# for callers that manage their own fence.
+#
+# Binary semaphores must not be waited on before the submission that
+# signals them reaches the driver. Semaphores link work on different
+# queues, and different submit threads, so waiters block in
+# waitForSignals() until the signalling vkQueueSubmit has returned.
+
+
+# a VkSubmitInfo for command buffers that wait on, and signal, Semaphores
+def getSubmitInfo(
+    vkCommandBuffers,
+    waitSemaphores=[],
+    signalSemaphores=[],
+    waitStage=vk.VK_PIPELINE_STAGE_COMPUTE_SHADER_BIT,
+):
+    return vk.VkSubmitInfo(
+        sType=vk.VK_STRUCTURE_TYPE_SUBMIT_INFO,
+        commandBufferCount=len(vkCommandBuffers),
+        pCommandBuffers=vkCommandBuffers,
+        waitSemaphoreCount=len(waitSemaphores),
+        pWaitSemaphores=[s.vkSemaphore for s in waitSemaphores]
+        if waitSemaphores
+        else None,
+        pWaitDstStageMask=[waitStage] * len(waitSemaphores) if waitSemaphores else None,
+        signalSemaphoreCount=len(signalSemaphores),
+        pSignalSemaphores=[s.vkSemaphore for s in signalSemaphores]
+        if signalSemaphores
+        else None,
+    )
+
+
+# block until the submissions that signal semaphores are in the driver
+def waitForSignals(semaphores):
+    for semaphore in semaphores:
+        if semaphore.signalSubmission is not None:
+            semaphore.signalSubmission.waitSubmitted()
+
+
+# Submit compute work that uses buffers. Async uploads into them still
+# in flight are waited on, on the GPU, and the written buffers remember
+# the Submission for async downloads. submitInfo is used as is when
+# no uploads are pending, otherwise a new one is made that also waits on them
+def submitCompute(
+    device,
+    submitQueue,
+    submitInfo,
+    vkCommandBuffer,
+    buffers,
+    writtenBuffers,
+    waitSemaphores=[],
+    signalSemaphores=[],
+):
+    uploadSemaphores, uploadFutures = device.asyncTransfer.consume(buffers)
+    # uploads some other submission waits for
+    for future in uploadFutures:
+        future.wait()
+    if uploadSemaphores:
+        submitInfo = getSubmitInfo(
+            [vkCommandBuffer], waitSemaphores + uploadSemaphores, signalSemaphores
+        )
+
+    waitForSignals(waitSemaphores)
+    computeSubmission = submitQueue.submit(submitInfo, signalSemaphores)
+    if uploadSemaphores:
+        computeSubmission.addCallback(
+            lambda: device.asyncTransfer.recycleSemaphores(uploadSemaphores)
+        )
+    for b in writtenBuffers:
+        b.lastWrite = computeSubmission
+    return computeSubmission
+
+
+# completed by the SubmitQueue's fence thread.
+# same interface as synchronization.Future: done(), wait(timeout), result(), await
+class Submission(synchronization.Future):
+    def __init__(self, submitInfo):
+        synchronization.Future.__init__(self, None)
+        self.submitInfo = submitInfo
+        self.event = threading.Event()
+        # set once vkQueueSubmit has returned (or failed)
+        self.submitted = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+        self.error = None
+        # what result() returns, such as downloaded data
+        self.value = None
+
+    def done(self):
+        return self.event.is_set()
+
+    def wait(self, timeout=None):
+        finished = self.event.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return finished
+
+    def waitSubmitted(self):
+        self.submitted.wait()
+
+    def result(self, timeout=None):
+        if not self.wait(timeout):
+            raise TimeoutError("submission not complete after " + str(timeout) + " s")
+        return self.value
+
+    # callback runs on the fence thread, or right away if already done
+    def addCallback(self, callback):
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks += [callback]
+                return
+        callback()
+
+    def setDone(self, error=None, value=None):
+        with self.lock:
+            self.error = error
+            self.value = value
+            self.finished = True
+            self.event.set()
+            callbacks = self.callbacks
+            self.callbacks = []
+        for callback in callbacks:
+            callback()
+
+    def __await__(self):
+        if not self.done():
+            loop = asyncio.get_running_loop()
+            asyncFuture = loop.create_future()
+
+            def resolve():
+                if not asyncFuture.done():
+                    asyncFuture.set_result(None)
+
+            self.addCallback(lambda: loop.call_soon_threadsafe(resolve))
+            yield from asyncFuture.__await__()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class SubmitQueue:
+    # pollInterval is how long the fence thread blocks on the fences
+    # in flight before it picks up newer batches
+    def __init__(
+        self, device, queue, queueFamilyIndex=0, maxBatch=64, pollInterval=0.001
+    ):
+        self.device = device
+        self.queue = queue
+        self.queueFamilyIndex = queueFamilyIndex
+        self.maxBatch = maxBatch
+        self.pollInterval = pollInterval
+
+        # held around every vkQueueSubmit on this queue
+        self.lock = threading.Lock()
+
+        # guards pending, inFlight and freeFences, and wakes the threads
+        self.condition = threading.Condition()
+        self.pending = []
+        # (Fence, [Submission])
+        self.inFlight = []
+        self.freeFences = []
+        self.stopped = False
+        # set by the submit thread once everything pending is submitted
+        self.submitterDone = False
+
+        # statistics
+        self.submitCount = 0
+        self.batchCount = 0
+
+        self.thread = threading.Thread(
+            target=self.loop, name="vulkanese submit queue", daemon=True
+        )
+        self.fenceThread = threading.Thread(
+            target=self.fenceLoop, name="vulkanese fence waiter", daemon=True
+        )
+        self.thread.start()
+        self.fenceThread.start()
+
+    # queue a submission. the VkSubmitInfo (and everything it points to)
+    # must stay alive, and unchanged, until the Submission is done.
+    # signalSemaphores are those the VkSubmitInfo signals
+    def submit(self, submitInfo, signalSemaphores=[]):
+        submission = Submission(submitInfo)
+        with self.condition:
+            if self.stopped:
+                raise Exception("SubmitQueue has been released")
+            for semaphore in signalSemaphores:
+                semaphore.signalSubmission = submission
+            self.pending += [submission]
+            self.condition.notify_all()
+        return submission
+
+    def submitDirect(self, submitInfos, fence=None):
+        if not isinstance(submitInfos, list):
+            submitInfos = [submitInfos]
+        with self.lock:
+            vk.vkQueueSubmit(
+                queue=self.queue,
+                submitCount=len(submitInfos),
+                pSubmits=submitInfos,
+                fence=None if fence is None else fence.vkFence,
+            )
+
+    def getFence(self):
+        with self.condition:
+            if self.freeFences:
+                return self.freeFences.pop()
+        return synchronization.Fence(device=self.device)
+
+    # the submit thread
+    def loop(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopped:
+                    self.condition.wait()
+                if self.stopped and not self.pending:
+                    self.submitterDone = True
+                    self.condition.notify_all()
+                    return
+                batch = self.pending[: self.maxBatch]
+                del self.pending[: len(batch)]
+            self.submitBatch(batch)
+
+    # the fence thread
+    def fenceLoop(self):
+        while True:
+            with self.condition:
+                while not self.inFlight and not self.submitterDone:
+                    self.condition.wait()
+                if self.submitterDone and not self.inFlight:
+                    return
+            self.poll()
+
+    def submitBatch(self, batch):
+        fence = self.getFence()
+        try:
+            self.submitDirect([s.submitInfo for s in batch], fence)
+        except Exception as e:
+            with self.condition:
+                self.freeFences += [fence]
+            for submission in batch:
+                submission.submitted.set()
+                submission.setDone(e)
+            return
+        for submission in batch:
+            submission.submitted.set()
+        self.submitCount += len(batch)
+        self.batchCount += 1
+        with self.condition:
+            self.inFlight += [(fence, batch)]
+            self.condition.notify_all()
+
+    # complete every batch whose fence is signalled.
+    # waits up to pollInterval for one
+    def poll(self):
+        with self.condition:
+            inFlight = list(self.inFlight)
+        if not inFlight:
+            return
+
+        try:
+            vk.vkWaitForFences(
+                device=self.device.vkDevice,
+                fenceCount=len(inFlight),
+                pFences=[fence.vkFence for fence, batch in inFlight],
+                waitAll=vk.VK_FALSE,
+                timeout=int(self.pollInterval * 1e9),
+            )
+        except vk.VkTimeout:
+            pass
+
+        for fence, batch in inFlight:
+            if not fence.status():
+                continue
+            fence.reset()
+            with self.condition:
+                self.inFlight.remove((fence, batch))
+                self.freeFences += [fence]
+            for submission in batch:
+                submission.setDone()
+
+    # requests queued or executing
+    def getLoad(self):
+        with self.condition:
+            return len(self.pending) + sum([len(b) for f, b in self.inFlight])
+
+    # average number of requests per vkQueueSubmit
+    def getBatchSize(self):
+        if not self.batchCount:
+            return 0.0
+        return self.submitCount / self.batchCount
+
+    # finishes everything already submitted, then stops the threads
+    def release(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.thread.join()
+        self.fenceThread.join()
+        for fence in self.freeFences:
+            fence.release()
+        self.freeFences = []
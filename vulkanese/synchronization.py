@@ -1,3 +1,5 @@
+import asyncio
+import threading
 from vulkan import *
 
 
@@ -5,6 +7,8 @@ class Semaphore:
     def __init__(self, device, flags=0):
         self.extant = True
         self.device = device
+        # the Submission that last signals this semaphore (see submission.py)
+        self.signalSubmission = None
         self.semaphore_create = VkSemaphoreCreateInfo(
             sType=VK_STRUCTURE_TYPE_SEMAPHORE_CREATE_INFO, flags=flags
         )
@@ -34,18 +38,206 @@ class Fence:
             vkDestroyFence(self.device.vkDevice, self.vkFence, None)
             self.extant = False
 
-    def wait(self):
+    # True once the fence is signalled. never blocks
+    def status(self):
+        try:
+            vkGetFenceStatus(self.device.vkDevice, self.vkFence)
+        except VkNotReady:
+            return False
+        return True
+
+    # block until the fence is signalled, or for at most timeout seconds.
+    # returns whether it was signalled. the fence stays signalled until reset()
+    def wait(self, timeout=None):
 
         # The command will not have finished executing until the fence is signalled.
         # So we wait here.
         # We will directly after this read our buffer from the GPU,
         # and we will not be sure that the command has finished executing unless we wait for the fence.
         # Hence, we use a fence here.
-        vkWaitForFences(
-            device=self.device.vkDevice,
-            fenceCount=1,
-            pFences=[self.vkFence],
-            waitAll=VK_TRUE,
-            timeout=1000000000,
-        )
+        if timeout is None:
+            timeout = 0xFFFFFFFFFFFFFFFF
+        else:
+            timeout = int(timeout * 1e9)
+        try:
+            vkWaitForFences(
+                device=self.device.vkDevice,
+                fenceCount=1,
+                pFences=[self.vkFence],
+                waitAll=VK_TRUE,
+                timeout=timeout,
+            )
+        except VkTimeout:
+            return False
+        return True
+
+    # unsignal the fence, before it is submitted again
+    def reset(self):
         vkResetFences(device=self.device.vkDevice, fenceCount=1, pFences=[self.vkFence])
+
+
+# A handle on one submission, complete once its fence is signalled.
+# Poll it with done(), block with wait(timeout), or await it:
+# a FenceWaiter thread waits on the fence, so the event loop never does.
+# Its owner must call wait() before resetting the fence for a new submission
+class Future:
+    def __init__(self, fence):
+        self.fence = fence
+        self.finished = False
+
+    def done(self):
+        if not self.finished:
+            self.finished = self.fence.status()
+        return self.finished
+
+    def wait(self, timeout=None):
+        if not self.finished:
+            self.finished = self.fence.wait(timeout)
+        return self.finished
+
+    # like concurrent.futures.Future.result. submissions have no value
+    def result(self, timeout=None):
+        if not self.wait(timeout):
+            raise TimeoutError("submission not complete after " + str(timeout) + " s")
+
+    def __await__(self):
+        if not self.done():
+            loop = asyncio.get_running_loop()
+            asyncFuture = loop.create_future()
+
+            def resolve():
+                if not asyncFuture.done():
+                    asyncFuture.set_result(None)
+
+            self.fence.device.getFenceWaiter().add(
+                self, lambda: loop.call_soon_threadsafe(resolve)
+            )
+            yield from asyncFuture.__await__()
+
+
+# One thread per device waiting on every fence that is being awaited.
+# It waits for any of them, with a short timeout so new ones are picked up,
+# and runs a future's callback (on this thread) once it is done
+class FenceWaiter:
+    def __init__(self, device, pollInterval=0.001):
+        self.device = device
+        self.pollInterval = pollInterval
+        self.pending = []
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.thread = threading.Thread(
+            target=self.loop, name="vulkanese fence waiter", daemon=True
+        )
+        self.thread.start()
+
+    def add(self, future, callback):
+        with self.condition:
+            self.pending += [(future, callback)]
+            self.condition.notify()
+
+    def loop(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                pending = list(self.pending)
+
+            try:
+                vkWaitForFences(
+                    device=self.device.vkDevice,
+                    fenceCount=len(pending),
+                    pFences=[future.fence.vkFence for future, callback in pending],
+                    waitAll=VK_FALSE,
+                    timeout=int(self.pollInterval * 1e9),
+                )
+            except VkTimeout:
+                pass
+
+            for future, callback in pending:
+                if future.done():
+                    with self.condition:
+                        self.pending.remove((future, callback))
+                    callback()
+
+    def release(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join()
+
+
+# a single vkCmdPipelineBarrier covering every buffer in vkBuffers
+def bufferBarrier(
+    vkCommandBuffer,
+    vkBuffers,
+    srcStage=VK_PIPELINE_STAGE_COMPUTE_SHADER_BIT,
+    srcAccess=VK_ACCESS_SHADER_WRITE_BIT,
+    dstStage=VK_PIPELINE_STAGE_COMPUTE_SHADER_BIT,
+    dstAccess=VK_ACCESS_SHADER_READ_BIT | VK_ACCESS_SHADER_WRITE_BIT,
+):
+    if not vkBuffers:
+        return
+    vkCmdPipelineBarrier(
+        vkCommandBuffer,
+        srcStage,
+        dstStage,
+        0,
+        0,
+        None,
+        len(vkBuffers),
+        [
+            VkBufferMemoryBarrier(
+                sType=VK_STRUCTURE_TYPE_BUFFER_MEMORY_BARRIER,
+                srcAccessMask=srcAccess,
+                dstAccessMask=dstAccess,
+                srcQueueFamilyIndex=VK_QUEUE_FAMILY_IGNORED,
+                dstQueueFamilyIndex=VK_QUEUE_FAMILY_IGNORED,
+                buffer=vkBuffer,
+                offset=0,
+                size=VK_WHOLE_SIZE,
+            )
+            for vkBuffer in vkBuffers
+        ],
+        0,
+        None,
+    )
+
+
+# compute -> compute execution dependency, with no memory dependency
+def executionBarrier(vkCommandBuffer):
+    vkCmdPipelineBarrier(
+        vkCommandBuffer,
+        VK_PIPELINE_STAGE_COMPUTE_SHADER_BIT,
+        VK_PIPELINE_STAGE_COMPUTE_SHADER_BIT,
+        0,
+        0,
+        None,
+        0,
+        None,
+        0,
+        None,
+    )
+
+
+# make all shader writes visible to the host once the submission completes
+def hostBarrier(vkCommandBuffer):
+    vkCmdPipelineBarrier(
+        vkCommandBuffer,
+        VK_PIPELINE_STAGE_COMPUTE_SHADER_BIT,
+        VK_PIPELINE_STAGE_HOST_BIT,
+        0,
+        1,
+        [
+            VkMemoryBarrier(
+                sType=VK_STRUCTURE_TYPE_MEMORY_BARRIER,
+                srcAccessMask=VK_ACCESS_SHADER_WRITE_BIT,
+                dstAccessMask=VK_ACCESS_HOST_READ_BIT,
+            )
+        ],
+        0,
+        None,
+        0,
+        None,
+    )
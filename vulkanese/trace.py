@@ -0,0 +1,224 @@
+import os
+import json
+import time
+import threading
+import functools
+
+from . import shader
+from . import compute_pipeline
+from . import compute_graph
+from . import submission
+from . import synchronization
+from . import buffer
+from . import transfer
+
+# Host and GPU timelines, as Chrome trace-event JSON
+# (open in chrome://tracing or ui.perfetto.dev).
+#   ve.trace.enable(device)
+#   ...
+#   ve.trace.save("trace.json")
+#
+# enable() wraps each registered method in a span, and disable() puts the
+# originals back, so there is no cost at all while tracing is off.
+# Given devices, it also enables their profilers, and every profiled dispatch
+# becomes a span on a GPU track. The GPU clock is aligned to the host's by
+# the smallest gap seen between a dispatch's end and its completion on the host,
+# so GPU spans may appear a little late, never early.
+
+# (class, method name) traced while enabled
+REGISTRY = [
+    (shader.sinode.Sinode, "dump"),
+    (shader.Shader, "run"),
+    (shader.Shader, "wait"),
+    (compute_pipeline.ComputePipeline, "run"),
+    (compute_pipeline.ComputePipeline, "record"),
+    (compute_graph.ComputeGraph, "run"),
+    (compute_graph.ComputeGraph, "record"),
+    (submission.SubmitQueue, "submitDirect"),
+    (submission.Submission, "wait"),
+    (synchronization.Fence, "wait"),
+    (synchronization.Future, "wait"),
+    (buffer.Buffer, "set"),
+    (buffer.Buffer, "get"),
+    (buffer.Buffer, "flush"),
+    (buffer.Buffer, "invalidate"),
+    (buffer.RingBuffer, "set"),
+    (transfer.TransferContext, "upload"),
+    (transfer.TransferContext, "download"),
+    (transfer.TransferContext, "copy"),
+]
+
+
+# trace another method. takes effect at the next enable()
+def register(cls, methodName):
+    if (cls, methodName) not in REGISTRY:
+        REGISTRY.append((cls, methodName))
+
+
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        # (class, method name) -> original function
+        self.originals = {}
+        self.devices = []
+        self.listeners = {}
+        # device -> whether its profiler was on before tracing
+        self.profilerEnabled = {}
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.startNs = time.perf_counter_ns()
+            # (name, category, start ns, end ns, thread id)
+            self.hostSpans = []
+            # device name -> [(shader name, start ns, end ns, host ns at readback)]
+            self.gpuSpans = {}
+            self.threadNames = {}
+
+    def enable(self, *devices):
+        if not self.enabled:
+            for cls, methodName in REGISTRY:
+                # only methods the class defines itself. inherited ones are
+                # traced through their own class
+                if methodName not in cls.__dict__:
+                    continue
+                original = cls.__dict__[methodName]
+                self.originals[(cls, methodName)] = original
+                setattr(cls, methodName, self.wrap(cls, methodName, original))
+            self.enabled = True
+
+        for device in devices:
+            if device in self.devices:
+                continue
+            self.listeners[device] = self.getGpuListener(device)
+            device.profiler.listeners += [self.listeners[device]]
+            self.profilerEnabled[device] = device.profiler.enabled
+            device.profiler.enable()
+            self.devices += [device]
+
+    def disable(self):
+        for (cls, methodName), original in self.originals.items():
+            setattr(cls, methodName, original)
+        self.originals = {}
+        for device in self.devices:
+            device.profiler.listeners.remove(self.listeners[device])
+            if not self.profilerEnabled[device]:
+                device.profiler.disable()
+        self.devices = []
+        self.listeners = {}
+        self.profilerEnabled = {}
+        self.enabled = False
+
+    def wrap(self, cls, methodName, original):
+        name = cls.__name__ + "." + methodName
+        category = cls.__module__.split(".")[-1]
+
+        @functools.wraps(original)
+        def traced(*args, **kwargs):
+            start = time.perf_counter_ns()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                end = time.perf_counter_ns()
+                thread = threading.current_thread()
+                with self.lock:
+                    self.hostSpans += [(name, category, start, end, thread.ident)]
+                    self.threadNames[thread.ident] = thread.name
+
+        return traced
+
+    def getGpuListener(self, device):
+        def listener(name, start, end):
+            now = time.perf_counter_ns()
+            with self.lock:
+                self.gpuSpans.setdefault(device.name, []).append(
+                    (name, start, end, now)
+                )
+
+        return listener
+
+    # the trace-event list, with times in microseconds from the last clear()
+    def getEvents(self):
+        pid = os.getpid()
+        events = []
+        with self.lock:
+            hostSpans = list(self.hostSpans)
+            gpuSpans = {k: list(v) for k, v in self.gpuSpans.items()}
+            threadNames = dict(self.threadNames)
+
+        events += [
+            {"name": "process_name", "ph": "M", "pid": pid, "args": {"name": "host"}}
+        ]
+        for tid, threadName in threadNames.items():
+            events += [
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": pid,
+                    "tid": tid,
+                    "args": {"name": threadName},
+                }
+            ]
+        for name, category, start, end, tid in hostSpans:
+            events += [
+                {
+                    "name": name,
+                    "cat": category,
+                    "ph": "X",
+                    "ts": (start - self.startNs) / 1000.0,
+                    "dur": (end - start) / 1000.0,
+                    "pid": pid,
+                    "tid": tid,
+                }
+            ]
+
+        # each device is its own process in the viewer
+        for i, (deviceName, spans) in enumerate(gpuSpans.items()):
+            gpuPid = pid + 1 + i
+            offset = min([now - end for name, start, end, now in spans])
+            events += [
+                {
+                    "name": "process_name",
+                    "ph": "M",
+                    "pid": gpuPid,
+                    "args": {"name": "GPU " + deviceName},
+                }
+            ]
+            for name, start, end, now in spans:
+                events += [
+                    {
+                        "name": name,
+                        "cat": "gpu",
+                        "ph": "X",
+                        "ts": (start + offset - self.startNs) / 1000.0,
+                        "dur": (end - start) / 1000.0,
+                        "pid": gpuPid,
+                        "tid": 0,
+                    }
+                ]
+        return events
+
+    def save(self, filename="trace.json"):
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": self.getEvents()}, f)
+
+
+# the process-wide tracer
+tracer = Tracer()
+
+
+def enable(*devices):
+    tracer.enable(*devices)
+
+
+def disable():
+    tracer.disable()
+
+
+def clear():
+    tracer.clear()
+
+
+def save(filename="trace.json"):
+    tracer.save(filename)
@@ -0,0 +1,365 @@
+import threading
+import numpy as np
+import vulkan as vk
+
+from . import synchronization
+from . import submission
+from . import memory
+from . import buffer
+
+# Moves data in and out of buffers that the CPU can't map.
+# Data goes through a pooled host-visible staging buffer,
+# and is copied on the GPU with vkCmdCopyBuffer.
+#
+# upload and download block until the copy is done.
+# uploadAsync and downloadAsync return a Submission right away,
+# and each copy gets a command buffer of its own.
+# An async upload signals a semaphore, which the next compute
+# submission using the buffer waits on (see consume()).
+# The semaphore is only published once the copy is queued, and consume()
+# blocks until that copy reaches the driver, so its wait never comes first.
+# An async download starts once the last compute submission
+# that wrote the buffer is complete.
+
+
+class StagingPool:
+    def __init__(self, device):
+        self.device = device
+        self.lock = threading.Lock()
+        # (size (power of two), intent) -> [free StagingBuffer]
+        self.free = {}
+
+    # uploads want write-combined memory, readbacks want cached memory
+    def acquire(self, sizeBytes, intent="upload"):
+        key = (memory.nextPow2(max(sizeBytes, 256)), intent)
+        with self.lock:
+            if self.free.get(key):
+                return self.free[key].pop()
+        return buffer.StagingBuffer(device=self.device, sizeBytes=key[0], intent=intent)
+
+    def release(self, stagingBuffer):
+        with self.lock:
+            key = (stagingBuffer.sizeBytes, stagingBuffer.intent)
+            self.free.setdefault(key, []).append(stagingBuffer)
+
+
+class TransferContext:
+    def __init__(self, device, queue, queueFamilyIndex, submitQueue):
+        self.device = device
+        self.queue = queue
+        self.queueFamilyIndex = queueFamilyIndex
+        self.submitQueue = submitQueue
+        self.lock = threading.Lock()
+        self.stagingPool = StagingPool(device)
+
+        # command buffers are re-recorded for every copy
+        self.vkCommandPoolCreateInfo = vk.VkCommandPoolCreateInfo(
+            sType=vk.VK_STRUCTURE_TYPE_COMMAND_POOL_CREATE_INFO,
+            queueFamilyIndex=queueFamilyIndex,
+            flags=vk.VK_COMMAND_POOL_CREATE_RESET_COMMAND_BUFFER_BIT
+            | vk.VK_COMMAND_POOL_CREATE_TRANSIENT_BIT,
+        )
+        self.vkCommandPool = vk.vkCreateCommandPool(
+            device=self.device.vkDevice,
+            pCreateInfo=self.vkCommandPoolCreateInfo,
+            pAllocator=None,
+        )
+        self.vkCommandBuffer = vk.vkAllocateCommandBuffers(
+            device=self.device.vkDevice,
+            pAllocateInfo=vk.VkCommandBufferAllocateInfo(
+                sType=vk.VK_STRUCTURE_TYPE_COMMAND_BUFFER_ALLOCATE_INFO,
+                commandPool=self.vkCommandPool,
+                level=vk.VK_COMMAND_BUFFER_LEVEL_PRIMARY,
+                commandBufferCount=1,
+            ),
+        )[0]
+        self.beginInfo = vk.VkCommandBufferBeginInfo(
+            sType=vk.VK_STRUCTURE_TYPE_COMMAND_BUFFER_BEGIN_INFO,
+            flags=vk.VK_COMMAND_BUFFER_USAGE_ONE_TIME_SUBMIT_BIT,
+        )
+        self.submitInfo = vk.VkSubmitInfo(
+            sType=vk.VK_STRUCTURE_TYPE_SUBMIT_INFO,
+            commandBufferCount=1,
+            pCommandBuffers=[self.vkCommandBuffer],
+        )
+        self.fence = synchronization.Fence(device=self.device)
+
+        # recycled by the async copies
+        self.freeCommandBuffers = []
+        self.freeSemaphores = []
+
+    def barrier(self, vkBuffer, srcStage, srcAccess, dstStage, dstAccess):
+        vk.vkCmdPipelineBarrier(
+            self.vkCommandBuffer,
+            srcStage,
+            dstStage,
+            0,
+            0,
+            None,
+            1,
+            [
+                vk.VkBufferMemoryBarrier(
+                    sType=vk.VK_STRUCTURE_TYPE_BUFFER_MEMORY_BARRIER,
+                    srcAccessMask=srcAccess,
+                    dstAccessMask=dstAccess,
+                    srcQueueFamilyIndex=vk.VK_QUEUE_FAMILY_IGNORED,
+                    dstQueueFamilyIndex=vk.VK_QUEUE_FAMILY_IGNORED,
+                    buffer=vkBuffer,
+                    offset=0,
+                    size=vk.VK_WHOLE_SIZE,
+                )
+            ],
+            0,
+            None,
+        )
+
+    def submitAndWait(self):
+        vk.vkEndCommandBuffer(self.vkCommandBuffer)
+        self.fence.reset()
+        self.submitQueue.submitDirect(self.submitInfo, self.fence)
+        self.fence.wait()
+
+    # record a single copy, bracketed by barriers against compute shader access
+    def copy(self, srcBuffer, dstBuffer, size, srcOffset=0, dstOffset=0):
+        with self.lock:
+            vk.vkBeginCommandBuffer(self.vkCommandBuffer, self.beginInfo)
+            self.barrier(
+                srcBuffer.vkBuffer,
+                vk.VK_PIPELINE_STAGE_COMPUTE_SHADER_BIT,
+                vk.VK_ACCESS_SHADER_WRITE_BIT,
+                vk.VK_PIPELINE_STAGE_TRANSFER_BIT,
+                vk.VK_ACCESS_TRANSFER_READ_BIT,
+            )
+            vk.vkCmdCopyBuffer(
+                self.vkCommandBuffer,
+                srcBuffer.vkBuffer,
+                dstBuffer.vkBuffer,
+                1,
+                [vk.VkBufferCopy(srcOffset=srcOffset, dstOffset=dstOffset, size=size)],
+            )
+            self.barrier(
+                dstBuffer.vkBuffer,
+                vk.VK_PIPELINE_STAGE_TRANSFER_BIT,
+                vk.VK_ACCESS_TRANSFER_WRITE_BIT,
+                vk.VK_PIPELINE_STAGE_COMPUTE_SHADER_BIT | vk.VK_PIPELINE_STAGE_HOST_BIT,
+                vk.VK_ACCESS_SHADER_READ_BIT
+                | vk.VK_ACCESS_SHADER_WRITE_BIT
+                | vk.VK_ACCESS_HOST_READ_BIT,
+            )
+            self.submitAndWait()
+
+    def fill(self, dstBuffer, value=0):
+        with self.lock:
+            vk.vkBeginCommandBuffer(self.vkCommandBuffer, self.beginInfo)
+            vk.vkCmdFillBuffer(
+                self.vkCommandBuffer, dstBuffer.vkBuffer, 0, vk.VK_WHOLE_SIZE, value
+            )
+            self.barrier(
+                dstBuffer.vkBuffer,
+                vk.VK_PIPELINE_STAGE_TRANSFER_BIT,
+                vk.VK_ACCESS_TRANSFER_WRITE_BIT,
+                vk.VK_PIPELINE_STAGE_COMPUTE_SHADER_BIT,
+                vk.VK_ACCESS_SHADER_READ_BIT | vk.VK_ACCESS_SHADER_WRITE_BIT,
+            )
+            self.submitAndWait()
+
+    # write data into buffer, starting at startByte
+    def upload(self, buffer, data, startByte=0):
+        data = np.ravel(data)
+        sizeBytes = data.size * buffer.itemSizeBytes
+        staging = self.stagingPool.acquire(sizeBytes)
+        try:
+            np.copyto(
+                staging.view(buffer.pythonType, data.size), data, casting="unsafe"
+            )
+            staging.flush(0, sizeBytes)
+            self.copy(staging, buffer, sizeBytes, dstOffset=startByte)
+        finally:
+            self.stagingPool.release(staging)
+
+    # read itemCount items of buffer, starting at startByte
+    def download(self, buffer, startByte=0, itemCount=None):
+        if itemCount is None:
+            itemCount = int((buffer.sizeBytes - startByte) / buffer.itemSizeBytes)
+        sizeBytes = itemCount * buffer.itemSizeBytes
+        staging = self.stagingPool.acquire(sizeBytes, intent="readback")
+        try:
+            self.copy(buffer, staging, sizeBytes, srcOffset=startByte)
+            staging.invalidate(0, sizeBytes)
+            return staging.view(buffer.pythonType, itemCount).copy()
+        finally:
+            self.stagingPool.release(staging)
+
+    def getCommandBuffer(self):
+        if self.freeCommandBuffers:
+            return self.freeCommandBuffers.pop()
+        return vk.vkAllocateCommandBuffers(
+            device=self.device.vkDevice,
+            pAllocateInfo=vk.VkCommandBufferAllocateInfo(
+                sType=vk.VK_STRUCTURE_TYPE_COMMAND_BUFFER_ALLOCATE_INFO,
+                commandPool=self.vkCommandPool,
+                level=vk.VK_COMMAND_BUFFER_LEVEL_PRIMARY,
+                commandBufferCount=1,
+            ),
+        )[0]
+
+    def getSemaphore(self):
+        if self.freeSemaphores:
+            return self.freeSemaphores.pop()
+        return synchronization.Semaphore(device=self.device)
+
+    def recycleSemaphores(self, semaphores):
+        with self.lock:
+            self.freeSemaphores += semaphores
+
+    # record and submit one copy on its own command buffer.
+    # the command buffer and staging buffer are recycled once it completes,
+    # then finish() runs (on the submit thread) and gives the result
+    def copyAsync(
+        self,
+        srcBuffer,
+        dstBuffer,
+        size,
+        srcOffset=0,
+        dstOffset=0,
+        waitSemaphores=[],
+        signalSemaphores=[],
+        staging=None,
+        finish=None,
+    ):
+        with self.lock:
+            vkCommandBuffer = self.getCommandBuffer()
+            vk.vkBeginCommandBuffer(vkCommandBuffer, self.beginInfo)
+            vk.vkCmdCopyBuffer(
+                vkCommandBuffer,
+                srcBuffer.vkBuffer,
+                dstBuffer.vkBuffer,
+                1,
+                [vk.VkBufferCopy(srcOffset=srcOffset, dstOffset=dstOffset, size=size)],
+            )
+            vk.vkEndCommandBuffer(vkCommandBuffer)
+
+        submission.waitForSignals(waitSemaphores)
+        copySubmission = self.submitQueue.submit(
+            submission.getSubmitInfo(
+                [vkCommandBuffer],
+                waitSemaphores,
+                signalSemaphores,
+                waitStage=vk.VK_PIPELINE_STAGE_TRANSFER_BIT,
+            ),
+            signalSemaphores,
+        )
+        result = submission.Submission(None)
+
+        def done():
+            value = None
+            error = copySubmission.error
+            try:
+                if finish is not None and error is None:
+                    value = finish()
+            except Exception as e:
+                error = e
+            with self.lock:
+                self.freeCommandBuffers += [vkCommandBuffer]
+                self.freeSemaphores += waitSemaphores
+            if staging is not None:
+                self.stagingPool.release(staging)
+            result.setDone(error, value)
+
+        copySubmission.addCallback(done)
+        return result
+
+    # start copying data into buffer. the CPU only fills a staging buffer
+    def uploadAsync(self, buffer, data, startByte=0):
+        data = np.ravel(data)
+        sizeBytes = data.size * buffer.itemSizeBytes
+        staging = self.stagingPool.acquire(sizeBytes)
+        np.copyto(staging.view(buffer.pythonType, data.size), data, casting="unsafe")
+        staging.flush(0, sizeBytes)
+
+        with self.lock:
+            # an earlier upload nobody consumed: order after it
+            waitSemaphores = []
+            if buffer.uploadSemaphore is not None:
+                waitSemaphores = [buffer.uploadSemaphore]
+                buffer.uploadSemaphore = None
+            semaphore = self.getSemaphore()
+
+        uploadFuture = self.copyAsync(
+            staging,
+            buffer,
+            sizeBytes,
+            dstOffset=startByte,
+            waitSemaphores=waitSemaphores,
+            signalSemaphores=[semaphore],
+            staging=staging,
+        )
+        # published only now that the copy which signals it is queued
+        with self.lock:
+            buffer.uploadSemaphore = semaphore
+            buffer.uploadFuture = uploadFuture
+        return uploadFuture
+
+    # start reading buffer back. result() of the returned Submission is the array
+    def downloadAsync(self, buffer, startByte=0, itemCount=None):
+        if itemCount is None:
+            itemCount = int((buffer.sizeBytes - startByte) / buffer.itemSizeBytes)
+        sizeBytes = itemCount * buffer.itemSizeBytes
+        download = submission.Submission(None)
+
+        def start():
+            try:
+                staging = self.stagingPool.acquire(sizeBytes, intent="readback")
+
+                def finish():
+                    staging.invalidate(0, sizeBytes)
+                    return staging.view(buffer.pythonType, itemCount).copy()
+
+                waitSemaphores, waitFutures = self.consume([buffer])
+                for future in waitFutures:
+                    future.wait()
+                copySubmission = self.copyAsync(
+                    buffer,
+                    staging,
+                    sizeBytes,
+                    srcOffset=startByte,
+                    waitSemaphores=waitSemaphores,
+                    staging=staging,
+                    finish=finish,
+                )
+                copySubmission.addCallback(
+                    lambda: download.setDone(copySubmission.error, copySubmission.value)
+                )
+            except Exception as e:
+                download.setDone(e)
+
+        # shaders write on another queue. wait for the last one to complete
+        writer = buffer.lastWrite
+        if writer is None or writer.done():
+            start()
+        else:
+            writer.addCallback(start)
+        return download
+
+    # semaphores of async uploads into buffers that haven't been waited on yet.
+    # the caller's submission must wait on them, and recycle them when done.
+    # returns once the copies signalling them are submitted.
+    # uploads another submission already waits on are returned as futures
+    def consume(self, buffers):
+        semaphores = []
+        futures = []
+        with self.lock:
+            for b in buffers:
+                if b.uploadSemaphore is not None:
+                    semaphores += [b.uploadSemaphore]
+                    b.uploadSemaphore = None
+                elif b.uploadFuture is not None and not b.uploadFuture.done():
+                    futures += [b.uploadFuture]
+        submission.waitForSignals(semaphores)
+        return semaphores, futures
+
+    def release(self):
+        for semaphore in self.freeSemaphores:
+            semaphore.release()
+        self.fence.release()
+        vk.vkDestroyCommandPool(self.device.vkDevice, self.vkCommandPool, None)
@@ -0,0 +1,113 @@
+import os
+import sys
+import time
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.abspath(os.path.join(here, "..", "..")))
+import vulkanese as ve
+import vulkan as vk
+
+# Reports host write and read bandwidth (GB/s) for every memory type the device exposes.
+# Host-visible types are written and read through Buffer.view().
+# Device-only types are measured through the staging path (set/get).
+
+
+def flagsString(propertyFlags):
+    names = []
+    for name in ["DEVICE_LOCAL", "HOST_VISIBLE", "HOST_COHERENT", "HOST_CACHED"]:
+        if propertyFlags & getattr(vk, "VK_MEMORY_PROPERTY_" + name + "_BIT"):
+            names += [name]
+    return "|".join(names)
+
+
+def timeit(fn, iterations):
+    fn()  # warm up
+    start = time.perf_counter()
+    for i in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations
+
+
+def benchmarkType(device, memoryTypeIndex, sizeBytes, iterations):
+    propertyFlags = device.memoryProperties["memoryTypes"][memoryTypeIndex][
+        "propertyFlags"
+    ]
+    hostVisible = bool(propertyFlags & vk.VK_MEMORY_PROPERTY_HOST_VISIBLE_BIT)
+    buffer = ve.buffer.StorageBuffer(
+        device=device,
+        name="bench",
+        memtype="float",
+        shape=[int(sizeBytes / 4)],
+        memoryTypeIndex=memoryTypeIndex,
+        hostVisible=hostVisible,
+    )
+    data = np.random.random(buffer.itemCount).astype(np.float32)
+    out = np.empty_like(data)
+
+    if hostVisible:
+        view = buffer.view()
+
+        def write():
+            np.copyto(view, data)
+            buffer.markDirty()
+            buffer.flush()
+
+        def read():
+            buffer.invalidate()
+            np.copyto(out, view)
+
+    else:
+
+        def write():
+            buffer.set(data)
+
+        def read():
+            np.copyto(out, buffer.get())
+
+    writeTime = timeit(write, iterations)
+    readTime = timeit(read, iterations)
+    buffer.release()
+    return sizeBytes / writeTime / 1e9, sizeBytes / readTime / 1e9
+
+
+def benchmark(device, sizeBytes=64 * 1024 * 1024, iterations=10):
+    results = []
+    for i, mt in enumerate(device.memoryProperties["memoryTypes"]):
+        # lazily allocated memory can't back a storage buffer
+        if mt["propertyFlags"] & vk.VK_MEMORY_PROPERTY_LAZILY_ALLOCATED_BIT:
+            continue
+        if not mt["propertyFlags"] & (
+            vk.VK_MEMORY_PROPERTY_DEVICE_LOCAL_BIT
+            | vk.VK_MEMORY_PROPERTY_HOST_VISIBLE_BIT
+        ):
+            continue
+        try:
+            writeGBs, readGBs = benchmarkType(device, i, sizeBytes, iterations)
+        except Exception as e:
+            print("memory type " + str(i) + " skipped: " + str(e))
+            continue
+        results += [
+            {
+                "memoryTypeIndex": i,
+                "heapIndex": mt["heapIndex"],
+                "flags": flagsString(mt["propertyFlags"]),
+                "writeGBs": writeGBs,
+                "readGBs": readGBs,
+            }
+        ]
+
+    print("%-5s %-5s %-50s %10s %10s" % ("type", "heap", "flags", "write GB/s", "read GB/s"))
+    for r in results:
+        print(
+            "%-5d %-5d %-50s %10.2f %10.2f"
+            % (r["memoryTypeIndex"], r["heapIndex"], r["flags"], r["writeGBs"], r["readGBs"])
+        )
+    return results
+
+
+if __name__ == "__main__":
+    instance = ve.instance.Instance(verbose=False)
+    device = instance.getDevice(0)
+    benchmark(device)
+    instance.release()
@@ -0,0 +1,83 @@
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.abspath(os.path.join(here, "..", "..")))
+import vulkanese as ve
+import vulkan as vk
+
+# Compares compute pipeline creation time with an empty VkPipelineCache (cold)
+# against a cache loaded from the data the cold pass produced (warm).
+# Many drivers also keep their own shader cache on disk.
+# Disable it for a true cold number, eg. MESA_SHADER_CACHE_DISABLE=true
+# or __GL_SHADER_DISK_CACHE=0
+
+
+def getKernels(device, count):
+    x = np.random.random(1024)
+    y = np.random.random(1024)
+    kernels = []
+    for i in range(count):
+        # the literal is inlined into the generated code, so every kernel
+        # has its own SPIR-V, and no two pipelines are identical
+        kernels += [
+            ve.math.fusion.Expression(
+                device=device,
+                expression="sin(x) * " + str(i + 1) + " + y",
+                inputs={"x": x, "y": y},
+                deferCompile=True,
+            )
+        ]
+    device.compileShaders(kernels)
+    return kernels
+
+
+def createPipelines(device, kernels, pipelineCache):
+    start = time.perf_counter()
+    pipelines = [
+        ve.compute_pipeline.ComputePipeline(
+            parent=k,
+            computeShader=k,
+            device=device,
+            constantsDict=k.constantsDict,
+            workgroupCount=k.workgroupCount,
+            pipelineCache=pipelineCache,
+        )
+        for k in kernels
+    ]
+    elapsed = time.perf_counter() - start
+    for p in pipelines:
+        p.release()
+    return elapsed
+
+
+def benchmark(device, count=16):
+    kernels = getKernels(device, count)
+    filename = os.path.join(tempfile.mkdtemp(), "pipeline.bin")
+
+    cold = ve.cache.PipelineCache(device=device, filename=filename, load=False)
+    coldTime = createPipelines(device, kernels, cold)
+    cold.save()
+    cold.release()
+
+    warm = ve.cache.PipelineCache(device=device, filename=filename)
+    warmTime = createPipelines(device, kernels, warm)
+    warm.release()
+    os.remove(filename)
+    for k in kernels:
+        ve.autotune.releaseKernel(k)
+
+    print("pipelines: " + str(count))
+    print("cold: %.2f ms (%.2f ms each)" % (coldTime * 1e3, coldTime * 1e3 / count))
+    print("warm: %.2f ms (%.2f ms each)" % (warmTime * 1e3, warmTime * 1e3 / count))
+    return coldTime, warmTime
+
+
+if __name__ == "__main__":
+    instance = ve.instance.Instance(verbose=False)
+    device = instance.getDevice(0)
+    benchmark(device)
+    instance.release()